@@ -1,14 +1,19 @@
 from pathlib import Path
-from subprocess import run
+
+import xarray
+
+from workflow_tools import ops
 
 
 def main(tp_file, sf_file, outdir):
-    tp_str = tp_file.as_posix()
-    sf_str = sf_file.as_posix()
-    lp_str = (outdir / tp_file.name.replace('tp', 'lp')).as_posix()
-    cmd = f'cdo -setrtoc,-1e9,0,0 -chname,tp,lp -sub {tp_str} {sf_str} {lp_str}'
-    print(cmd)
-    run(cmd, shell=True, check=True)
+    lp_file = outdir / tp_file.name.replace('tp', 'lp')
+    print(f'{tp_file} - {sf_file} -> {lp_file}')
+    with xarray.open_dataset(tp_file) as tp, xarray.open_dataset(sf_file) as sf:
+        # Liquid precipitation is total minus snowfall, without negative values.
+        lp = ops.set_range_to_constant(tp['tp'] - sf['sf'], -1e9, 0, 0)
+        lp.attrs = tp['tp'].attrs
+        lp.encoding = {'dtype': 'float32'}
+        tp.drop_vars('tp').assign(lp=lp).to_netcdf(lp_file)
 
 
 if __name__ == '__main__':
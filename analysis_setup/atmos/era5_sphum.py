@@ -1,7 +1,10 @@
 import os
 from pathlib import Path
 
-from workflow_tools.utils import run_cmd
+import xarray
+
+from workflow_tools import ops
+from workflow_tools.utils import shared_executor
 
 
 def main(d2m_file: Path, sp_file: Path, tmpdir: Path, outdir: Path | str | None = None
@@ -11,19 +14,23 @@ def main(d2m_file: Path, sp_file: Path, tmpdir: Path, outdir: Path | str | None
     # Not critical but ensures str can be represented as a path
     elif isinstance(outdir, str):
         outdir = Path(outdir)
-    svp_file = tmpdir / 'svp_tmp.nc'
     sphum_file = d2m_file.name.replace('d2m', 'sphum') # assuming d2m in name
-    run_cmd(f'gcp {d2m_file} {tmpdir}')
-    run_cmd(f'gcp {sp_file} {tmpdir}')
-    run_cmd(
-        f'cdo expr,"svp=611.2*exp(17.67*(d2m-273.15)/(d2m-29.65))" \
-            {tmpdir / d2m_file.name} {svp_file}'
-    )
-    run_cmd(
-        f'cdo -expr,"_mr=0.622*svp/(msl-svp);sphum=_mr/(1+_mr);" -merge \
-              {svp_file} {tmpdir / sp_file.name} {tmpdir / sphum_file}'
-    )
-    run_cmd(f'gcp {tmpdir / sphum_file} {outdir}')
+    commands = shared_executor()
+    copies = [commands.submit(['gcp', f, tmpdir]) for f in (d2m_file, sp_file)]
+    for copy in copies:
+        copy.result()
+    with (
+        xarray.open_dataset(tmpdir / d2m_file.name) as d2m,
+        xarray.open_dataset(tmpdir / sp_file.name) as sp,
+    ):
+        svp = ops.evaluate(d2m, 'svp=611.2*exp(17.67*(d2m-273.15)/(d2m-29.65))')
+        sphum = ops.evaluate(
+            xarray.merge([svp, sp]), '_mr=0.622*svp/(msl-svp);sphum=_mr/(1+_mr);'
+        )
+        # cdo wrote float32, regardless of how the inputs were packed.
+        sphum['sphum'].encoding = {'dtype': 'float32'}
+        sphum.to_netcdf(tmpdir / sphum_file)
+    commands.run(['gcp', tmpdir / sphum_file, outdir])
 
 
 if __name__ == '__main__':
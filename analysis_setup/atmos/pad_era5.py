@@ -1,21 +1,15 @@
-from concurrent import futures
-from functools import partial
 from pathlib import Path
 
 import pandas as pd
 import xarray
 from loguru import logger
 
+from workflow_tools import ops
 from workflow_tools.io import HSMGet
-from workflow_tools.utils import run_cmd
 
 hsmget = HSMGet(archive=Path('/archive/uda'))
 
 
-# Location to save temporary data to.
-TMP = hsmget.tmp
-
-
 variables = {
     'mean_sea_level_pressure': 'msl',
     'total_precipitation': 'tp',
@@ -29,19 +23,6 @@ variables = {
 }
 
 
-def thread_worker(month_file, region_slice):
-    out_file = TMP / month_file.name
-    # Slice to subregion and make time unlimited
-    run_cmd(
-        f'ncks {region_slice} --mk_rec_dmn time {month_file} -O {out_file}'
-    )
-    # Flip latitude so it is south to north.
-    run_cmd(
-        f'ncpdq -a "time,-latitude,longitude" {out_file} -O {out_file}'
-    )
-    return out_file
-
-
 def main(year, interim_path, output_dir, lon_lat_box):
     for long_name, file_var in variables.items():
         logger.info(file_var)
@@ -56,24 +37,18 @@ def main(year, interim_path, output_dir, lon_lat_box):
                 logger.info(f'Found files for month 1 to {mon - 1}')
                 break
 
+        # The subsetting below is lazy and only runs when the padded file
+        # is written, so there is no work to overlap with staging;
+        # stage all of the months with one hsmget.
         logger.info('hsmget')
-        tmp_files = hsmget(found_files)
-        logger.info('add record dim')
-        # These should be formatted ok if they are floats
-        # (nco requires decimal point)
-        region_slice = f'-d longitude,{lon_lat_box[0]},{lon_lat_box[1]} \
-            -d latitude,{lon_lat_box[2]},{lon_lat_box[3]}'
-        with futures.ThreadPoolExecutor(max_workers=4) as executor:
-            processed_files = sorted(
-                executor.map(
-                    partial(thread_worker, region_slice=region_slice), tmp_files
-                )
-            )
+        staged_files = hsmget(found_files)
 
-        # Join together and format metadata using xarray.
-        # Using xarray partly because ncrcat is strangely slow on these files.
+        # Join together, slice to the subregion, flip latitude so it is
+        # south to north, and format metadata in memory,
+        # so that the data is only written once.
         logger.info('concat')
-        ds = xarray.open_mfdataset(processed_files)
+        ds = xarray.open_mfdataset(staged_files)
+        ds = ops.flip(ops.sel_lonlat_box(ds, *lon_lat_box), 'latitude')
         # pad
         tail = ds.isel(time=-1)
         tail['time'] = tail['time'] + pd.Timedelta(hours=1)
@@ -114,3 +89,4 @@ if __name__ == '__main__':
         float(d.north_lat)
     ]
     main(args.year, interim_path, output_dir, box)
+    hsmget.log_stats()
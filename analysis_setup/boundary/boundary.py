@@ -1,11 +1,14 @@
 import warnings
+from itertools import pairwise
 from os import path
 
+import dask
 import numpy as np
 import xarray
 from loguru import logger
 
 from workflow_tools.grid import reuse_regrid
+from workflow_tools.io import MOM_INPUT
 
 # ignore pandas FutureWarnings raised multiple times by xarray
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -232,6 +235,141 @@ def z_to_dz(ds, max_depth=6500.):
     return da_dz
 
 
+def regrid_uv_to_locstream(usource, vsource, coords, *, method='nearest_s2d',
+                           periodic=False, uvar=None, vvar=None, cache_dir='.'):
+    """Interpolate velocity onto a locstream, without rotating or filling.
+
+    Args:
+        usource (xarray.DataArray): Earth-relative u velocity on source grid.
+        vsource (xarray.DataArray): Earth-relative v velocity on source grid.
+        coords (xarray.Dataset): lon and lat of the locstream.
+        method (str, optional): Method recognized by xesmf to use to regrid.
+            Defaults to 'nearest_s2d'.
+        periodic (bool, optional): Whether the source grid is periodic
+            (passed to xesmf). Defaults to False.
+        uvar (str, optional): If provided, use this var from usource, and assume
+            that coordinates are also provided in usource.
+        vvar (str, optional): If provided, use this var from vsource, and assume
+            that coordinates are also provided in vsource.
+        cache_dir (str, optional): location to save xesmf weights.
+
+    Returns:
+        (u, v) DataArrays with dimension 'locations'.
+    """
+    if not isinstance(usource, xarray.Dataset):
+        usource = usource.to_dataset()
+
+    if not isinstance(vsource, xarray.Dataset):
+        vsource = vsource.to_dataset()
+
+    # Horizontally interpolate velocity to MOM boundary.
+    uregrid = reuse_regrid(
+        usource,
+        coords,
+        method=method,
+        locstream_out=True,
+        periodic=periodic,
+        cache_dir=cache_dir,
+        reuse_weights=True
+    )
+    vregrid = reuse_regrid(
+        vsource,
+        coords,
+        method=method,
+        locstream_out=True,
+        periodic=periodic,
+        cache_dir=cache_dir,
+        reuse_weights=True
+    )
+
+    if uvar is None:
+        udest = uregrid(usource)
+    else:
+        udest = uregrid(usource[uvar])
+
+    if vvar is None:
+        vdest = vregrid(vsource)
+    else:
+        vdest = vregrid(vsource[vvar])
+
+    # if lat and lon are variables in u/vsource, u/vdest will be dataset
+    if isinstance(udest, xarray.Dataset):
+        udest = udest.to_array().squeeze()
+    if isinstance(vdest, xarray.Dataset):
+        vdest = vdest.to_array().squeeze()
+
+    xname = list(udest.dims)[-1]
+    udest = udest.rename({xname: 'locations'})
+    vdest = vdest.rename({xname: 'locations'})
+    return udest, vdest
+
+
+def tracer_source(tsource, source_var=None):
+    """Find the name of a tracer and make sure that it is in a Dataset.
+
+    Args:
+        tsource: xarray DataArray or Dataset containing the tracer.
+        source_var (str, optional): If tsource is a dataset, this is
+            the variable to regrid.
+
+    Returns:
+        (xarray.Dataset, str): Dataset containing the tracer, and its name.
+    """
+    if source_var is None:
+        if hasattr(tsource, 'name'):
+            name = tsource.name
+        elif isinstance(tsource, xarray.Dataset):
+            name = find_datavar(tsource)
+    else:
+        name =  source_var
+
+    if not isinstance(tsource, xarray.Dataset):
+        tsource.name = name
+        tsource = tsource.to_dataset()
+    return tsource, name
+
+
+def regrid_tracer_to_locstream(tsource, name, coords, *, method='nearest_s2d',
+                               periodic=False, xdim='lon', ydim='lat',
+                               cache_dir='.'):
+    """Interpolate a tracer onto a locstream, without filling.
+
+    Args:
+        tsource (xarray.Dataset): Dataset containing the tracer on source grid.
+        name (str): Name of the tracer.
+        coords (xarray.Dataset): lon and lat of the locstream.
+        method (str, optional): Method recognized by xesmf to use to regrid.
+            Defaults to 'nearest_s2d'.
+        periodic (bool, optional): Whether the source grid is periodic
+            (passed to xesmf). Defaults to False.
+        xdim (str, optional): Name of the horizontal x dimension, defaults to 'lon'.
+        ydim (str, optional): Name of the horizontal y dimension, defaults to 'lat'.
+        cache_dir (str, optional): location to save xesmf weights.
+
+    Returns:
+        xarray.Dataset: Dataset containing the tracer, with dimension 'locations'.
+    """
+    regrid = reuse_regrid(
+        tsource,
+        coords,
+        method=method,
+        locstream_out=True,
+        periodic=periodic,
+        cache_dir=cache_dir,
+        reuse_weights=True
+    )
+    tdest = regrid(tsource)
+
+    if not isinstance(tdest, xarray.Dataset):
+        tdest.name = name
+        tdest = tdest.to_dataset()
+    else:
+        tdest = tdest.drop_vars([xdim, ydim], errors='ignore')
+
+    xname = list(tdest.dims)[-1]
+    return tdest.rename({xname: 'locations'})
+
+
 class Segment:
     """One segment of a MOM6 open boundary.
 
@@ -244,27 +382,35 @@ class Segment:
         border (str): which border of the model grid the segment represents
             (north, south, east, or west).
         hgrid: (xarray.Dataset) dataset from opening ocean_hgrid.nc.
-            Contains 'x', 'y', and 'angle_dx'.
+            Contains 'x', 'y', and 'angle_dx'. Only the row or column
+            of the border is used, and hgrid is not kept.
         in_degrees: (bool): is angle_dx in hgrid in units of degrees (True)
             or radians (False)?
         segstr (str): string identifying the segment, used in variable and file names.
         output_dir (str): location to write data for the segment, and location to store
             xesmf weight files.
-        regrid_dir (str): location to save xesmf Regridders. Defaults to output_dir.
+        regrid_dir (str): location to save xesmf weights. Weights are named by a hash
+            of the grids, so segments with the same regrid_dir share identical
+            weights. Defaults to output_dir.
+        lon (numpy.ndarray): longitude of each point on the segment.
+        lat (numpy.ndarray): latitude of each point on the segment.
+        angle (numpy.ndarray): angle relative to true north (radians)
+            of each point on the segment.
+        cos_angle (numpy.ndarray): cosine of angle.
+        sin_angle (numpy.ndarray): sine of angle.
         coords (xarray.Dataset): segment coordinates derived from hgrid
             (lon, lat, angle relative to true north).
         nx (int): Number of data points in the x direction.
         ny (int): Number of data points in the y direction.
+        along_dim (str): name of the dimension along the segment
+            (nx_{segstr} for a south or north border, else ny_{segstr}).
+        across_dim (str): name of the length-1 dimension across the segment.
     """
 
     def __init__(self, num, border, hgrid, in_degrees=True, output_dir='.',
                  regrid_dir=None):
         self.num = num
         self.border = border
-        self.hgrid = hgrid.copy(deep=True)
-        if in_degrees:
-            self.hgrid['angle_dx'] = np.radians(self.hgrid['angle_dx'])
-        check_angle_range(self.hgrid['angle_dx'])
         self.segstr = f'segment_{self.num:03d}'
         self.output_dir = output_dir
 
@@ -273,62 +419,84 @@ class Segment:
         else:
             self.regrid_dir = regrid_dir
 
-    @property
-    def coords(self):
+        # Only the boundary row or column of hgrid is needed,
+        # so compute the geometry of the segment once from it.
         if self.border == 'south':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nyp=0),
-                'lat': self.hgrid['y'].isel(nyp=0),
-                'angle': self.hgrid['angle_dx'].isel(nyp=0)
-            })
+            edge, hdim = {'nyp': 0}, 'nxp'
         elif self.border == 'north':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nyp=-1),
-                'lat': self.hgrid['y'].isel(nyp=-1),
-                'angle': self.hgrid['angle_dx'].isel(nyp=-1)
-            })
+            edge, hdim = {'nyp': -1}, 'nxp'
         elif self.border == 'west':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nxp=0),
-                'lat': self.hgrid['y'].isel(nxp=0),
-                'angle': self.hgrid['angle_dx'].isel(nxp=0)
-            })
+            edge, hdim = {'nxp': 0}, 'nyp'
         elif self.border == 'east':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nxp=-1),
-                'lat': self.hgrid['y'].isel(nxp=-1),
-                'angle': self.hgrid['angle_dx'].isel(nxp=-1)
-            })
+            edge, hdim = {'nxp': -1}, 'nyp'
+        else:
+            raise ValueError(f'Unknown border {self.border}')
+        line = hgrid[['x', 'y', 'angle_dx']].isel(edge)
+        self.lon = np.array(line['x'].values, dtype='float64')
+        self.lat = np.array(line['y'].values, dtype='float64')
+        self.angle = np.array(line['angle_dx'].values, dtype='float64')
+        if in_degrees:
+            self.angle = np.radians(self.angle)
+        check_angle_range(self.angle)
+        self.cos_angle = np.cos(self.angle)
+        self.sin_angle = np.sin(self.angle)
+        self.coords = xarray.Dataset({
+            'lon': (hdim, self.lon),
+            'lat': (hdim, self.lat),
+            'angle': (hdim, self.angle)
+        })
 
-    @property
-    def nx(self):
-        """Number of data points in the x-direction"""
         if self.border in ['south', 'north']:
-            return len(self.coords['lon'])
-        elif self.border in ['west', 'east']:
-            return 1
+            self.nx, self.ny = len(self.lon), 1
+            self.along_dim = f'nx_{self.segstr}'
+            self.across_dim = f'ny_{self.segstr}'
+        else:
+            self.nx, self.ny = 1, len(self.lat)
+            self.along_dim = f'ny_{self.segstr}'
+            self.across_dim = f'nx_{self.segstr}'
 
-    @property
-    def ny(self):
-        """Number of data points in the y-direction"""
-        if self.border in ['south', 'north']:
-            return 1
-        elif self.border in ['west', 'east']:
-            return len(self.coords['lat'])
+    def rotate_uv(self, u, v):
+        """Rotate velocities on the segment from earth-relative to model-relative,
+        like rotate_uv but using the precomputed cosine and sine of the angle.
 
-    def to_netcdf(self, ds, varnames, suffix=None, additional_encoding=None):
+        Args:
+            u: west-east component of velocity, with dimension 'locations'.
+            v: south-north component of velocity, with dimension 'locations'.
+
+        Returns:
+            Model-relative west-east and south-north components of velocity.
+        """
+        cos_angle = xarray.DataArray(self.cos_angle, dims='locations')
+        sin_angle = xarray.DataArray(self.sin_angle, dims='locations')
+        urot = cos_angle * u - sin_angle * v
+        vrot = sin_angle * u + cos_angle * v
+        return urot, vrot
+
+    def to_netcdf(self, ds, varnames, suffix=None, additional_encoding=None, *,
+                  block_size=None, storage=MOM_INPUT):
         """Write data for the segment to file.
+        Data is written in blocks of time records, so that a lazy dataset
+        does not need to be loaded into memory all at once.
 
         Args:
             ds (xarray.Dataset): Segment dataset.
             varnames (str): Name to give the file (e.g. 'temp', 'salt').
             suffix (str, optional): Optional suffix to append to the filename
                 (before .nc). Defaults to None.
+            block_size (int, optional): Number of time records to write at once.
+                Defaults to None (chosen based on the size of the data).
+            storage (StorageFormat, optional): Format to write. Use an
+                intermediate format for files that are combined later
+                (e.g. monthly files). Defaults to MOM_INPUT (NETCDF3_64BIT).
+
+        Returns:
+            WriteStats: number of bytes written and time taken.
         """
         for v in ds:
             ds[v].encoding['_FillValue']= 1.0e20
-        fname = f'{varnames}_{self.num:03d}_{suffix}.nc' if suffix is not None else \
-            f'{varnames}_{self.num:03d}.nc'
+        fname = f'{varnames}_{self.num:03d}_{suffix}' if suffix is not None else \
+            f'{varnames}_{self.num:03d}'
+        fname += storage.suffix
         # Set format and attributes for coordinates, including time if it does not
         # already have calendar attribute
         # (may change this to detect whether time is a time type or a float).
@@ -351,12 +519,12 @@ class Segment:
         if additional_encoding is not None:
             encoding.update(additional_encoding)
 
-        ds.to_netcdf(
+        return storage.write(
+            ds,
             path.join(self.output_dir, fname),
-            format='NETCDF3_64BIT',
-            engine='netcdf4',
             encoding=encoding,
-            unlimited_dims='time'
+            unlimited_dim='time',
+            block_size=block_size
         )
 
     def expand_dims(self, ds):
@@ -380,9 +548,9 @@ class Segment:
         else:
             offset = 1
         if self.border in ['south', 'north']:
-            return ds.expand_dims(f'ny_{self.segstr}', 2-offset)
+            return ds.expand_dims(self.across_dim, 2-offset)
         elif self.border in ['west', 'east']:
-            return ds.expand_dims(f'nx_{self.segstr}', 3-offset)
+            return ds.expand_dims(self.across_dim, 3-offset)
 
     def rename_dims(self, ds):
         """Rename dimensions to be unique to the segment.
@@ -403,10 +571,7 @@ class Segment:
             ds = ds.rename({
                 'z': f'nz_{self.segstr}'
             })
-        if self.border in ['south', 'north']:
-            return ds.rename({'locations': f'nx_{self.segstr}'})
-        elif self.border in ['west', 'east']:
-            return ds.rename({'locations': f'ny_{self.segstr}'})
+        return ds.rename({'locations': self.along_dim})
 
     def zeros(self, time, nz=0):
         """Create an appropriately shaped DataArray of zeros.
@@ -437,20 +602,8 @@ class Segment:
 
     def add_coords(self, ds):
         """Add segment lat and lon coordinates to a dataset."""
-        if self.border in ['south', 'north']:
-            ds[f'lon_{self.segstr}'] = (
-                (f'nx_{self.segstr}', ), self.coords['lon'].data
-            )
-            ds[f'lat_{self.segstr}'] = (
-                (f'nx_{self.segstr}', ), self.coords['lat'].data
-            )
-        elif self.border in ['west', 'east']:
-            ds[f'lon_{self.segstr}'] = (
-                (f'ny_{self.segstr}', ), self.coords['lon'].data
-            )
-            ds[f'lat_{self.segstr}'] = (
-                (f'ny_{self.segstr}', ), self.coords['lat'].data
-            )
+        ds[f'lon_{self.segstr}'] = ((self.along_dim, ), self.lon)
+        ds[f'lat_{self.segstr}'] = ((self.along_dim, ), self.lat)
         return ds
 
     def regrid_velocity(
@@ -480,59 +633,38 @@ class Segment:
         Returns:
             xarray.Dataset: Dataset of regridded boundary data.
         """
-        if not isinstance(usource, xarray.Dataset):
-            usource = usource.to_dataset()
-
-        if not isinstance(vsource, xarray.Dataset):
-            vsource = vsource.to_dataset()
-
-        # Horizontally interpolate velocity to MOM boundary.
-        uregrid = reuse_regrid(
-            usource,
-            self.coords,
-            method=method,
-            locstream_out=True,
-            periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_u.nc'),
-            reuse_weights=True
+        udest, vdest = regrid_uv_to_locstream(
+            usource, vsource, self.coords,
+            method=method, periodic=periodic, uvar=uvar, vvar=vvar,
+            cache_dir=self.regrid_dir
         )
-        vregrid = reuse_regrid(
-            vsource,
-            self.coords,
-            method=method,
-            locstream_out=True,
-            periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_v.nc'),
-            reuse_weights=True
+        return self.finish_velocity(
+            udest, vdest, write=write, fill=fill, rotate=rotate, **kwargs
         )
 
-        if uvar is None:
-            udest = uregrid(usource)
-        else:
-            udest = uregrid(usource[uvar])
-
-        if vvar is None:
-            vdest = vregrid(vsource)
-        else:
-            vdest = vregrid(vsource[vvar])
+    def finish_velocity(self, udest, vdest, write=True, fill='b', rotate=True,
+                        **kwargs):
+        """Rotate, fill, and (optionally) write velocity that has already been
+        regridded onto the segment.
 
-        # if lat and lon are variables in u/vsource, u/vdest will be dataset
-        if isinstance(udest, xarray.Dataset):
-            udest = udest.to_array().squeeze()
-        if isinstance(vdest, xarray.Dataset):
-            vdest = vdest.to_array().squeeze()
-
-        xname = list(udest.dims)[-1]
-        udest = udest.rename({xname: 'locations'})
-        vdest = vdest.rename({xname: 'locations'})
+        Args:
+            udest (xarray.DataArray): Earth-relative u velocity with dimension
+                'locations' along the segment.
+            vdest (xarray.DataArray): Earth-relative v velocity with dimension
+                'locations' along the segment.
+            write (bool, optional): Write the results to file. Defaults to True.
+            fill (str, optional): Method to use for filling data horizontally
+                (b for bfill or f for ffill).
+            rotate(bool, optional): Rotate to the model grid, assuming input is
+                on earth grid.
+            **kwargs: additional keyword arguments passed to Segment.to_netcdf().
 
+        Returns:
+            xarray.Dataset: Dataset of regridded boundary data.
+        """
         # Rotate velocities to be model-relative.
         if rotate:
-            if self.border in ['south', 'north']:
-                angle = self.coords['angle'].rename({'nxp': 'locations'})
-            elif self.border in ['west', 'east']:
-                angle = self.coords['angle'].rename({'nyp': 'locations'})
-            udest, vdest = rotate_uv(udest, vdest, angle)
+            udest, vdest = self.rotate_uv(udest, vdest)
 
         ds_uv = xarray.Dataset({
             f'u_{self.segstr}': udest,
@@ -558,8 +690,8 @@ class Segment:
 
         ds_uv = self.expand_dims(ds_uv)
 
-        ds_uv['lon'] = (('locations', ), self.coords['lon'].data)
-        ds_uv['lat'] = (('locations', ), self.coords['lat'].data)
+        ds_uv['lon'] = (('locations', ), self.lon)
+        ds_uv['lat'] = (('locations', ), self.lat)
 
         ds_uv = self.rename_dims(ds_uv)
 
@@ -587,9 +719,8 @@ class Segment:
                 (b for bfill or f for ffill).
             xdim (str, optional): Name of the horizontal x dimension, defaults to 'lon'.
             ydim (str, optional): Name of the horizontal y dimension, defaults to 'lat'.
-            regrid_suffix (str, optional): Suffix to add to xesmf weight file name.
-                Useful when regridding multiple tracers from different datasets.
-                Defaults to 't'.
+            regrid_suffix (str, optional): Unused, since xesmf weight files are
+                named by a hash of the grids. Defaults to 't'.
             source_var (str, optional): If tsource is a dataset, this is
                 the variable to regrid.
             **kwargs: additional keyword arguments passed to Segment.to_netcdf().
@@ -597,40 +728,31 @@ class Segment:
         Returns:
             xarray.Dataset: Dataset of regridded boundary data.
         """
-        if source_var is None:
-            if hasattr(tsource, 'name'):
-                name = tsource.name
-            elif isinstance(tsource, xarray.Dataset):
-                name = find_datavar(tsource)
-        else:
-            name =  source_var
-
-        if not isinstance(tsource, xarray.Dataset):
-            tsource.name = name
-            tsource = tsource.to_dataset()
-
-        regrid = reuse_regrid(
-            tsource,
-            self.coords,
-            method=method,
-            locstream_out=True,
-            periodic=periodic,
-            filename=path.join(self.regrid_dir,
-                               f'regrid_{self.segstr}_{regrid_suffix}.nc'),
-            reuse_weights=True
+        tsource, name = tracer_source(tsource, source_var)
+        tdest = regrid_tracer_to_locstream(
+            tsource, name, self.coords,
+            method=method, periodic=periodic, xdim=xdim, ydim=ydim,
+            cache_dir=self.regrid_dir
         )
-        tdest = regrid(tsource)
+        return self.finish_tracer(tdest, name, write=write, fill=fill, **kwargs)
 
-        if not isinstance(tdest, xarray.Dataset):
-            tdest.name = name
-            tdest = tdest.to_dataset()
-        else:
-            tdest = tdest.drop_vars([xdim, ydim], errors='ignore')
+    def finish_tracer(self, tdest, name, write=True, fill='b', **kwargs):
+        """Fill and (optionally) write a tracer that has already been regridded
+        onto the segment.
 
-        xname = list(tdest.dims)[-1]
-        tdest = tdest.rename({xname: 'locations'})
+        Args:
+            tdest (xarray.Dataset): Dataset containing the tracer, with
+                dimension 'locations' along the segment.
+            name (str): Name of the tracer.
+            write (bool, optional): Write the results to file. Defaults to True.
+            fill (str, optional): Method to use for filling data horizontally
+                (b for bfill or f for ffill).
+            **kwargs: additional keyword arguments passed to Segment.to_netcdf().
 
-        if 'z' in tsource.coords:
+        Returns:
+            xarray.Dataset: Dataset of regridded boundary data.
+        """
+        if 'z' in tdest.coords:
             tdest = fill_missing(tdest, fill=fill)
             # Need to transpose so that time is first,
             # so that it can be the unlimited dimension
@@ -646,8 +768,8 @@ class Segment:
 
         tdest = self.expand_dims(tdest)
 
-        tdest['lon'] = (('locations', ), self.coords['lon'].data)
-        tdest['lat'] = (('locations', ), self.coords['lat'].data)
+        tdest['lon'] = (('locations', ), self.lon)
+        tdest['lat'] = (('locations', ), self.lat)
 
         tdest = self.rename_dims(tdest)
         tdest = tdest.rename({name: f'{name}_{self.segstr}'})
@@ -692,6 +814,7 @@ class Segment:
             method=method,
             locstream_out=True,
             periodic=periodic,
+            cache_dir=self.regrid_dir,
             filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_tidal_elev.nc'),
             reuse_weights=True
         )
@@ -727,8 +850,8 @@ class Segment:
 
         ds_ap = self.expand_dims(ds_ap)
 
-        ds_ap['lon'] = (('locations', ), self.coords['lon'].data)
-        ds_ap['lat'] = (('locations', ), self.coords['lat'].data)
+        ds_ap['lon'] = (('locations', ), self.lon)
+        ds_ap['lat'] = (('locations', ), self.lat)
 
         ds_ap = self.rename_dims(ds_ap)
 
@@ -782,6 +905,7 @@ class Segment:
             method=method,
             locstream_out=True,
             periodic=periodic,
+            cache_dir=self.regrid_dir,
             filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_tidal_u.nc'),
             reuse_weights=True
         )
@@ -792,6 +916,7 @@ class Segment:
             method=method,
             locstream_out=True,
             periodic=periodic,
+            cache_dir=self.regrid_dir,
             filename=path.join(
                 self.regrid_dir, f'regrid_{self.segstr}_tidal_v.nc'),
             reuse_weights=True
@@ -829,16 +954,12 @@ class Segment:
         # and convert ellipse back to amplitude and phase.
         # There is probably a complicated trig identity for this? But
         # this works too.
-        if self.border in ['south', 'north']:
-            angle = self.coords['angle'].rename({'nxp': 'locations'})
-        elif self.border in ['west', 'east']:
-            angle = self.coords['angle'].rename({'nyp': 'locations'})
         SEMA, ECC, INC, PHA = ap2ep(ucplex, vcplex)  # noqa: N806
 
         # Rotate to the model grid by adjusting the inclination.
         # Requries that angle is in radians.
         # INC is np array but angle is xarray
-        INC -= angle.data[np.newaxis, :]  # noqa: N806
+        INC -= self.angle[np.newaxis, :]  # noqa: N806
         ua, va, up, vp = ep2ap(SEMA, ECC, INC, PHA)
 
         ds_ap = xarray.Dataset({
@@ -859,8 +980,8 @@ class Segment:
         ds_ap = fill_missing(ds_ap, zdim=None)
 
         ds_ap = self.expand_dims(ds_ap)
-        ds_ap['lon'] = (('locations', ), self.coords['lon'].data)
-        ds_ap['lat'] = (('locations', ), self.coords['lat'].data)
+        ds_ap['lon'] = (('locations', ), self.lon)
+        ds_ap['lat'] = (('locations', ), self.lat)
 
         ds_ap = self.rename_dims(ds_ap)
 
@@ -869,3 +990,110 @@ class Segment:
             self.to_netcdf(ds_ap, 'tu', **kwargs)
 
         return ds_ap
+
+
+class SegmentSet:
+    """All of the segments of an open boundary, regridded together.
+
+    The locations of every segment are joined into one locstream, so that
+    each variable is interpolated from the source grid once instead of
+    once per segment. The result is computed once and then split back
+    into segments before filling missing data, so the data and files for
+    each segment are the same as from the methods of Segment.
+
+    Attributes:
+        segments (list[Segment]): the segments, in order.
+        coords (xarray.Dataset): lon and lat of all of the segments
+            along the dimension 'locations'.
+        offsets (numpy.ndarray): index in 'locations' where each segment starts,
+            followed by the total number of locations.
+        regrid_dir (str): location to save xesmf weights.
+            Defaults to the regrid_dir of the first segment.
+    """
+
+    def __init__(self, segments, regrid_dir=None):
+        self.segments = list(segments)
+        if len(self.segments) == 0:
+            raise ValueError('SegmentSet needs at least one segment')
+        self.offsets = np.cumsum([0] + [len(seg.lon) for seg in self.segments])
+        self.coords = xarray.Dataset({
+            'lon': ('locations', np.concatenate([seg.lon for seg in self.segments])),
+            'lat': ('locations', np.concatenate([seg.lat for seg in self.segments]))
+        })
+        if regrid_dir is None:
+            self.regrid_dir = self.segments[0].regrid_dir
+        else:
+            self.regrid_dir = regrid_dir
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def split(self, ds):
+        """Split data on all segments into a list with the data for each segment.
+
+        Args:
+            ds: xarray DataArray or Dataset with dimension 'locations'.
+
+        Returns:
+            list: one DataArray or Dataset for each segment.
+        """
+        return [
+            ds.isel(locations=slice(start, end))
+            for start, end in pairwise(self.offsets)
+        ]
+
+    def regrid_velocity(
+            self, usource, vsource, *,
+            method='nearest_s2d', periodic=False, write=True,
+            fill='b', rotate=True,
+            uvar=None, vvar=None, **kwargs):
+        """Interpolate velocity onto every segment and (optionally) write to file.
+        Arguments are the same as Segment.regrid_velocity.
+
+        Returns:
+            list[xarray.Dataset]: Dataset of regridded boundary data
+                for each segment.
+        """
+        udest, vdest = regrid_uv_to_locstream(
+            usource, vsource, self.coords,
+            method=method, periodic=periodic, uvar=uvar, vvar=vvar,
+            cache_dir=self.regrid_dir
+        )
+        # Read the source data once for all segments.
+        udest, vdest = dask.compute(udest, vdest)
+        return [
+            seg.finish_velocity(
+                u, v, write=write, fill=fill, rotate=rotate, **kwargs
+            )
+            for seg, u, v in zip(
+                self.segments, self.split(udest), self.split(vdest), strict=True
+            )
+        ]
+
+    def regrid_tracer(
+            self, tsource, *,
+            method='nearest_s2d', periodic=False, write=True,
+            fill='b', xdim='lon', ydim='lat',
+            source_var=None, **kwargs):
+        """Regrid a tracer onto every segment and (optionally) write to file.
+        Arguments are the same as Segment.regrid_tracer.
+
+        Returns:
+            list[xarray.Dataset]: Dataset of regridded boundary data
+                for each segment.
+        """
+        tsource, name = tracer_source(tsource, source_var)
+        tdest = regrid_tracer_to_locstream(
+            tsource, name, self.coords,
+            method=method, periodic=periodic, xdim=xdim, ydim=ydim,
+            cache_dir=self.regrid_dir
+        )
+        # Read the source data once for all segments.
+        tdest = tdest.compute()
+        return [
+            seg.finish_tracer(t, name, write=write, fill=fill, **kwargs)
+            for seg, t in zip(self.segments, self.split(tdest), strict=True)
+        ]
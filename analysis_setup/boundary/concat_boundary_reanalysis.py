@@ -1,8 +1,14 @@
+from contextlib import ExitStack
 from pathlib import Path
 
+import pandas as pd
+import xarray
 from loguru import logger
 
-from workflow_tools.utils import run_cmd
+from workflow_tools import ops
+from workflow_tools.io import MOM_INPUT
+
+ONE_DAY = pd.Timedelta(days=1)
 
 
 def main(year: int, input_dir: Path, output_dir: Path, n_segments: int) -> None:
@@ -10,59 +16,68 @@ def main(year: int, input_dir: Path, output_dir: Path, n_segments: int) -> None:
         logger.info('Working on {var}', var=var)
         for seg in range(1, n_segments + 1):
             logger.trace('Segment {seg:03d}', seg=seg)
-            available_months = []
-            # Search for December of the previous year to use
-            # to pad the beginning of the yearly file.
-            # If not found, roll the time of the first day back by one.
-            prev_month = input_dir / f'{var}_{seg:03d}_{year - 1}-12.nc'
-            if prev_month.exists():
-                tail_file = prev_month.with_suffix('.tail.nc')
-                run_cmd(f'ncks {prev_month} -d time,-1,-1 -O {tail_file}')
-            else:
-                logger.info('Padding with first time')
-                first_file = input_dir / f'{var}_{seg:03d}_{year}-01.nc'
-                tail_file = first_file.with_suffix('.tail.nc')
-                # Pick out the first time from the first month.
-                run_cmd(f'ncks {first_file} -d time,0,0 -O {tail_file}')
-                # Pad by subtracting one day from the time.
-                run_cmd(f'ncap2 -s "time-=24" {tail_file} -O {tail_file}')
-            available_months.append(tail_file)
-            # Search for the months of this year, stopping
-            # if one month is not found.
-            for mon in range(1, 13):
-                expected_file = input_dir / f'{var}_{seg:03d}_{year}-{mon:02d}.nc'
-                if expected_file.exists():
-                    available_months.append(expected_file)
-                else:
-                    break
-            if len(available_months) < 2:  # end of prev year plus this year
-                raise Exception('Did not find data')
-            # Search for January of the next year to use
-            # to pad the end of the yearly file.
-            # If not found, roll the time of the last day forward by one.
-            next_month = input_dir / f'{var}_{seg:03d}_{year + 1}-01.nc'
-            if len(available_months) == 13 and next_month.exists():
-                head_file = next_month.with_suffix('.head.nc')
-                run_cmd(f'ncks {next_month} -d time,0,0 -O {head_file}')
+            concat_segment(year, var, seg, input_dir, output_dir)
+
+
+def concat_segment(
+    year: int, var: str, seg: int, input_dir: Path, output_dir: Path
+) -> None:
+    """
+    Join the monthly files for one segment into a yearly file,
+    padded with a day from the neighboring years at each end.
+    """
+    with ExitStack() as stack:
+
+        def open_month(path: Path) -> xarray.Dataset:
+            # Open lazily, so that records are read as they are written.
+            return stack.enter_context(
+                xarray.open_dataset(path, chunks={'time': 1}, decode_timedelta=False)
+            )
+
+        available_months = []
+        # Search for the months of this year, stopping
+        # if one month is not found.
+        for mon in range(1, 13):
+            expected_file = input_dir / f'{var}_{seg:03d}_{year}-{mon:02d}.nc'
+            if expected_file.exists():
+                available_months.append(open_month(expected_file))
             else:
-                logger.info('Padding with last time')
-                last_file = available_months[-1]
-                head_file = last_file.with_suffix('.head.nc')
-                # Pick out the first time from the first month.
-                run_cmd(f'ncks {last_file} -d time,-1,-1 -O {head_file}')
-                # Pad by subtracting one day from the time.
-                run_cmd(f'ncap2 -s "time+=24" {head_file} -O {head_file}')
-            available_months.append(head_file)
-            output_file = output_dir / f'{var}_{seg:03d}_{year}.nc'
-            cmd = f'ncrcat {" ".join(map(str, available_months))} -O {output_file}'
-            run_cmd(cmd)
-            # TODO: proleptic_gregorian attribute carries over because of setting
-            # the time units when extracting.
-            # Fix it here for now.
-            # Also, time is an int but this could be ok since it's not int64.
-            run_cmd(f'ncatted -a calendar,time,o,c,gregorian -O {output_file}')
-            tail_file.unlink()
-            head_file.unlink()
+                break
+        if len(available_months) == 0:
+            raise Exception('Did not find data')
+        # Search for December of the previous year to use
+        # to pad the beginning of the yearly file.
+        # If not found, roll the time of the first day back by one.
+        prev_month = input_dir / f'{var}_{seg:03d}_{year - 1}-12.nc'
+        if prev_month.exists():
+            tail = open_month(prev_month).isel(time=[-1])
+        else:
+            logger.info('Padding with first time')
+            tail = available_months[0].isel(time=[0])
+            tail = tail.assign_coords(time=tail['time'] - ONE_DAY)
+        # Search for January of the next year to use
+        # to pad the end of the yearly file.
+        # If not found, roll the time of the last day forward by one.
+        next_month = input_dir / f'{var}_{seg:03d}_{year + 1}-01.nc'
+        if len(available_months) == 12 and next_month.exists():
+            head = open_month(next_month).isel(time=[0])
+        else:
+            logger.info('Padding with last time')
+            head = available_months[-1].isel(time=[-1])
+            head = head.assign_coords(time=head['time'] + ONE_DAY)
+        ds = ops.concat_records([tail, *available_months, head], dim='time')
+        # TODO: proleptic_gregorian attribute carries over because of setting
+        # the time units when extracting.
+        # Fix it here for now.
+        # Also, time is an int but this could be ok since it's not int64.
+        ds['time'].encoding = {
+            **available_months[0]['time'].encoding,
+            'calendar': 'gregorian',
+        }
+        output_file = output_dir / f'{var}_{seg:03d}_{year}.nc'
+        # The monthly files may be compressed netcdf4 intermediates;
+        # the yearly file is read by MOM6, so write it as NETCDF3_64BIT.
+        MOM_INPUT.write(ds, output_file, unlimited_dim='time')
 
 
 if __name__ == '__main__':
@@ -1,18 +1,21 @@
 from calendar import monthrange
-from concurrent import futures
 from functools import partial
 from pathlib import Path
 
+import dask
 import xarray
-from boundary import Segment
+from boundary import Segment, SegmentSet
 from loguru import logger
 
-from workflow_tools.grid import round_coords
-from workflow_tools.io import HSMGet
-from workflow_tools.utils import run_cmd
+from workflow_tools import ops
+from workflow_tools.grid import REGRIDDERS, round_coords
+from workflow_tools.io import HSMGet, storage_format
 
 hsmget = HSMGet(archive=Path('/archive/uda'))
-TMP = hsmget.tmp
+# The monthly sponge and boundary files are only intermediates
+# that are combined later, so they are compressed netcdf4 instead of
+# the NETCDF3 used for files that MOM6 reads.
+INTERMEDIATE = storage_format(final=False)
 
 
 def find_best_files(
@@ -103,29 +106,24 @@ def find_best_files(
     return files
 
 
-def thread_worker(
-    in_file: Path,
-    out_dir: Path,
-    lon_lat_box: tuple[float, float, float, float]
-) -> Path:
-    out_file = out_dir / in_file.name
-    lonmin, lonmax, latmin, latmax = lon_lat_box
-    if '_2D_' in in_file.name:
-        run_cmd(
-            f'cdo setmisstonn '
-            f'-sellonlatbox,{lonmin},{lonmax},{latmin},{latmax} '
-            f'{in_file.as_posix()} {out_file.as_posix()}',
-            escape=True
-        )
-    else:
-        run_cmd(
-            f'cdo setmisstonn -sellevidx,1/49 '
-            f'-sellonlatbox,{lonmin},{lonmax},{latmin},{latmax} '
-            f'{in_file.as_posix()} {out_file.as_posix()}',
-            escape=True
-        )
-    # out_file.with_suffix('.tmp').rename(out_file)
-    return out_file
+def subset_day(
+    ds: xarray.Dataset, lon_lat_box: tuple[float, float, float, float]
+) -> xarray.Dataset:
+    """
+    Subset one daily file to the domain and the top 49 levels, and fill
+    missing values with the nearest valid point
+    (in place of cdo setmisstonn -sellevidx,1/49 -sellonlatbox).
+    """
+    ds = ops.sel_lonlat_box(ds, *lon_lat_box)
+    if 'depth' in ds.dims:
+        ds = ops.sel_levidx(ds, 1, 49)
+    ds = round_coords(ds, to=12)
+    return ds.map(
+        lambda v: ops.fill_missing_nearest(v)
+        if {'latitude', 'longitude'} <= set(v.dims)
+        else v,
+        keep_attrs=True,
+    )
 
 
 def main(
@@ -136,7 +134,7 @@ def main(
     analysis_path: Path,
     reanalysis_path: Path,
     lon_lat_box: tuple[float, float, float, float],
-    segments: list[Segment],
+    segments: SegmentSet,
     update: bool = False,
     dry: bool = False,
 ):
@@ -189,51 +187,48 @@ def main(
                 if len(files) != n_expected:
                     logger.warning(f'Number of files found ({len(files)}) is not '
                                    'the same as expected ({n_expected})')
-                copied_files = hsmget(files)
-
-                with futures.ThreadPoolExecutor(max_workers=threads) as executor:
-                    processed_files = sorted(
-                        executor.map(
-                            partial(
-                                thread_worker, out_dir=TMP, lon_lat_box=lon_lat_box
-                            ),
-                            copied_files,
-                        )
+                # Subsetting and filling run in dask threads.
+                with dask.config.set(num_workers=threads):
+                    # Each day is subset and filled lazily as it is read,
+                    # instead of writing a temporary file for each day.
+                    # Nothing is computed until the month is written, so there
+                    # is no work to overlap with staging; stage the month with
+                    # one hsmget.
+                    staged_files = hsmget(files)
+                    ds = xarray.open_mfdataset(
+                        staged_files,
+                        preprocess=partial(subset_day, lon_lat_box=lon_lat_box),
                     )
-
-                # Save data for use with sponge. TODO: config output path
-                if var in ['so', 'thetao']:
-                    file_strs = " ".join(x.as_posix() for x in processed_files)
-                    run_cmd(
-                        f'cdo timavg -cat {file_strs} '
-                        f'/work/acr/mom6/nwa12/analysis_input_data/sponge/monthly_filled/glorys_{var}_{year}-{mon:02d}.nc',
-                        escape=True
-                    )
-                ds = xarray.open_mfdataset(
-                    processed_files, preprocess=partial(round_coords, to=12)
-                ).rename({'latitude': 'lat', 'longitude': 'lon'})
-                if 'depth' in ds.coords:
-                    ds = ds.rename({'depth': 'z'})
-                for seg in segments:
+                    # Save data for use with sponge. TODO: config output path
+                    if var in ['so', 'thetao']:
+                        INTERMEDIATE.write(
+                            ds[[var]].resample(time='1MS').mean(keep_attrs=True),
+                            f'/work/acr/mom6/nwa12/analysis_input_data/sponge/monthly_filled/glorys_{var}_{year}-{mon:02d}.nc',
+                        )
+                    ds = ds.rename({'latitude': 'lat', 'longitude': 'lon'})
+                    if 'depth' in ds.coords:
+                        ds = ds.rename({'depth': 'z'})
+                    # All segments are regridded at once, so the source data
+                    # is only read once, then written to a file for each segment.
                     if var == 'uv':
-                        seg.regrid_velocity(
+                        segments.regrid_velocity(
                             ds['uo'],
                             ds['vo'],
                             suffix=f'{year}-{mon:02d}',
                             additional_encoding={
                                 'time': {'units': 'hours since 1990-01-01 00:00:00'}
                             },
+                            storage=INTERMEDIATE,
                         )
                     else:
-                        seg.regrid_tracer(
+                        segments.regrid_tracer(
                             ds[var],
                             suffix=f'{year}-{mon:02d}',
                             additional_encoding={
                                 'time': {'units': 'hours since 1990-01-01 00:00:00'}
                             },
+                            storage=INTERMEDIATE,
                         )
-                for f in processed_files:
-                    f.unlink()
 
 if __name__ == '__main__':
     import argparse
@@ -263,10 +258,10 @@ if __name__ == '__main__':
     dom = config.domain
     hgrid = xarray.open_dataset(dom.hgrid_file)
     output_dir = config.filesystem.nowcast_input_data/ 'boundary' / 'monthly'
-    segments = [
+    segments = SegmentSet(
         Segment(num, edge, hgrid, output_dir=output_dir)
         for num, edge in dom.boundaries.items()
-    ]
+    )
     main(
         args.year,
         args.month,
@@ -279,3 +274,5 @@ if __name__ == '__main__':
         update=args.update,
         dry=args.dry,
     )
+    REGRIDDERS.log_stats()
+    hsmget.log_stats()
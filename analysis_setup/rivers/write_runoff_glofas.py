@@ -1,4 +1,3 @@
-import os
 from functools import partial
 from pathlib import Path
 
@@ -73,7 +72,9 @@ def regrid_runoff(  # noqa: PLR0915
     glofas_mask: np.ndarray,
     hgrid: xarray.Dataset,
     coast_mask: np.ndarray,
-    modify: bool = True
+    modify: bool = True,
+    *,
+    workers: int = 1,
 ) -> xarray.Dataset:
     # Assuming grid spacing of 0.05 deg here and below;
     # eventually should detect from file (there are attributes for this)
@@ -99,7 +100,8 @@ def regrid_runoff(  # noqa: PLR0915
     glofas_area = dx * dy
     glofas_kg = glofas * 1000.0 / glofas_area
 
-    # Conservatively interpolate runoff onto MOM grid
+    # Conservatively interpolate runoff onto MOM grid.
+    # The weights are built in tiles by workers processes.
     glofas_to_mom_con = reuse_regrid(
         {
             'lon': glofas.lon,
@@ -111,7 +113,7 @@ def regrid_runoff(  # noqa: PLR0915
         method='conservative',
         periodic=True,
         reuse_weights=True,
-        filename=os.path.join(os.environ['TMPDIR'], 'glofas_to_mom.nc'),
+        workers=workers,
     )
     # Interpolate only from GloFAS points that are river end points.
     glofas_regridded = glofas_to_mom_con(glofas_kg.where(glofas_mask > 0).fillna(0.0))
@@ -168,7 +170,6 @@ def regrid_runoff(  # noqa: PLR0915
         method='nearest_s2d',
         locstream_in=True,
         reuse_weights=True,
-        filename=os.path.join(os.environ['TMPDIR'], 'coast_to_mom.nc'),
     )
     coast_id = mom_id[flat_mask]
     nearest_coast = coast_to_mom(coast_id)
@@ -258,6 +259,8 @@ def main(  # noqa: PLR0915
     extension_climo: Path,
     outdir: Path,
     modify: bool = True,
+    *,
+    workers: int = 1,
 ) -> None:
     ocean_mask = xarray.open_dataarray(mask_file)
     mom_coast_mask = get_coast_mask(ocean_mask)
@@ -340,7 +343,14 @@ def main(  # noqa: PLR0915
         shifted_time[0] = shifted_time[0] - pd.Timedelta(hours=12)
     glofas['time'] = shifted_time
 
-    res = regrid_runoff(glofas, glofas_coast_mask, hgrid, mom_coast_mask, modify=modify)
+    res = regrid_runoff(
+        glofas,
+        glofas_coast_mask,
+        hgrid,
+        mom_coast_mask,
+        modify=modify,
+        workers=workers,
+    )
 
     # If the next year is not available for padding,
     # pad using the climatology.
@@ -393,6 +403,16 @@ if __name__ == '__main__':
         action='store_true',
         help='Apply corrections for location and bias',
     )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='Number of processes used to build the regridding weights. '
+        'Values above 1 build the weights in tiles, which has not yet been '
+        'checked against a single ESMF build with periodic=True '
+        '(see benchmarks/bench_conservative_weights.py)',
+    )
     args = parser.parse_args()
     config = load_config(args.config)
     dom = config.domain
@@ -411,5 +431,6 @@ if __name__ == '__main__':
         glofas_subset=subset,
         extension_climo=config.filesystem.interim_data.GloFAS_extension_climatology,
         outdir=config.filesystem.nowcast_input_data / 'rivers',
-        modify=args.modify
+        modify=args.modify,
+        workers=args.workers,
     )
@@ -2,9 +2,8 @@ from pathlib import Path
 
 import pandas as pd
 import xarray
-from xesmf import Regridder
 
-from workflow_tools.grid import round_coords
+from workflow_tools.grid import reuse_regrid, round_coords
 
 VARIABLES = ['thetao', 'so']
 
@@ -51,11 +50,13 @@ def main(
         ]
     ).load()
     print('Interpolating')
-    glorys_to_t = Regridder(
+    # The GLORYS grid is the same every year, so the weights
+    # are built once and then loaded from the cache.
+    glorys_to_t = reuse_regrid(
         glorys,
         target_grid,
         method='nearest_s2d',
-        reuse_weights=False,  #! Not reusing
+        reuse_weights=True,
         periodic=False,
     )
     interped = glorys_to_t(glorys).drop_vars(['lon', 'lat'], errors='ignore').compute()
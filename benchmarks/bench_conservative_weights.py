@@ -0,0 +1,104 @@
+"""
+Compare conservative weights built in tiles by a pool of processes
+(workflow_tools.grid.conservative_weights) with weights built by one call
+to ESMF through xesmf, for a grid pair like the GloFAS to NWA12 regridding
+in write_runoff_glofas: a regional 0.05 degree source onto a rotated grid,
+with periodic=True as in regrid_runoff.
+Checks that the weights, and the sum of the weights for each
+destination cell, are the same.
+
+python benchmarks/bench_conservative_weights.py --resolution 20 --ny 845 --nx 775
+"""
+import time
+
+import numpy as np
+import xarray
+import xesmf
+
+from workflow_tools.grid import _regridder_weights, conservative_weights
+
+WEST, EAST, SOUTH, NORTH = -100.0, -30.0, 0.0, 60.0
+
+
+def make_source(resolution: int) -> dict[str, np.ndarray]:
+    """Rectilinear source grid with latitude from north to south, like GloFAS."""
+    lon_b = np.linspace(WEST, EAST, int((EAST - WEST) * resolution) + 1)
+    lat_b = np.linspace(NORTH, SOUTH, int((NORTH - SOUTH) * resolution) + 1)
+    return {
+        'lon': 0.5 * (lon_b[:-1] + lon_b[1:]),
+        'lat': 0.5 * (lat_b[:-1] + lat_b[1:]),
+        'lon_b': lon_b,
+        'lat_b': lat_b,
+    }
+
+
+def make_curvilinear(ny: int, nx: int) -> dict[str, np.ndarray]:
+    """A rotated grid inside the source domain, like the NWA12 grid."""
+
+    def rotate(x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        return WEST + 5 + 55 * x + 5 * y, SOUTH + 5 + 45 * y + 3 * x
+
+    x_b, y_b = np.meshgrid(np.linspace(0, 1, nx + 1), np.linspace(0, 1, ny + 1))
+    x, y = 0.5 * (x_b[1:, 1:] + x_b[:-1, :-1]), 0.5 * (y_b[1:, 1:] + y_b[:-1, :-1])
+    lon, lat = rotate(x, y)
+    lon_b, lat_b = rotate(x_b, y_b)
+    return {'lon': lon, 'lat': lat, 'lon_b': lon_b, 'lat_b': lat_b}
+
+
+def to_sparse(weights: xarray.Dataset) -> dict[tuple[int, int], float]:
+    return dict(
+        zip(
+            zip(weights['row'].values, weights['col'].values, strict=True),
+            weights['S'].values,
+            strict=True,
+        )
+    )
+
+
+def row_sums(weights: xarray.Dataset) -> np.ndarray:
+    return np.bincount(
+        weights['row'].values - 1,
+        weights=weights['S'].values,
+        minlength=weights.attrs['n_out'],
+    )
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolution', type=int, default=20)
+    parser.add_argument('--ny', type=int, default=845)
+    parser.add_argument('--nx', type=int, default=775)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--tiles', type=int, default=None)
+    args = parser.parse_args()
+
+    source = make_source(args.resolution)
+    dest = make_curvilinear(args.ny, args.nx)
+    print(f'Source points: {source["lon"].size * source["lat"].size}')
+    print(f'Destination points: {dest["lon"].size}')
+
+    tstart = time.perf_counter()
+    regrid = xesmf.Regridder(source, dest, 'conservative', periodic=True)
+    whole = _regridder_weights(regrid)
+    t_whole = time.perf_counter() - tstart
+    print(f'One ESMF call: {t_whole:.1f} s ({whole.sizes["n_s"]} weights)')
+
+    tstart = time.perf_counter()
+    tiled = conservative_weights(
+        source, dest, periodic=True, workers=args.workers, tiles=args.tiles
+    )
+    t_tiled = time.perf_counter() - tstart
+    print(
+        f'Tiled with {args.workers} workers: {t_tiled:.1f} s '
+        f'({tiled.sizes["n_s"]} weights, {t_whole / t_tiled:.1f}x)'
+    )
+
+    sums_whole, sums_tiled = row_sums(whole), row_sums(tiled)
+    print(f'Sum of weights (one call): {sums_whole.sum():.6f}')
+    print(f'Sum of weights (tiled): {sums_tiled.sum():.6f}')
+    print(f'Max difference in row sums: {np.abs(sums_whole - sums_tiled).max():.3g}')
+    a, b = to_sparse(whole), to_sparse(tiled)
+    diff = max(abs(a.get(k, 0.0) - b.get(k, 0.0)) for k in a.keys() | b.keys())
+    print(f'Max difference in weights: {diff:.3g}')
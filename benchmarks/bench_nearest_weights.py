@@ -0,0 +1,115 @@
+"""
+Compare nearest_s2d weights from workflow_tools.grid.nearest_weights
+(a KD-tree on the unit sphere) with weights from ESMF through xesmf,
+on grids the size of the NWA12 regridding:
+- GLORYS (1/12 degree) onto an open boundary segment (a locstream),
+  like each Segment regridder.
+- GLORYS onto a curvilinear grid the size of the NWA12 tracer grid,
+  like the sponge regridder in write_nudging_data.
+
+python benchmarks/bench_nearest_weights.py --resolution 12 --ny 845 --nx 775
+"""
+import time
+
+import numpy as np
+import xarray
+import xesmf
+
+from workflow_tools.grid import nearest_weights
+
+WEST, EAST, SOUTH, NORTH = -100.0, -30.0, 0.0, 60.0
+
+
+def make_source(resolution: int, land_fraction: float) -> xarray.Dataset:
+    """Rectilinear source grid with a mask, like GLORYS."""
+    rng = np.random.default_rng(0)
+    lon = np.arange(WEST, EAST, 1 / resolution)
+    lat = np.arange(SOUTH, NORTH, 1 / resolution)
+    mask = (rng.random((lat.size, lon.size)) > land_fraction).astype('int32')
+    return xarray.Dataset(
+        {'mask': (('lat', 'lon'), mask)}, coords={'lon': lon, 'lat': lat}
+    )
+
+
+def make_curvilinear(ny: int, nx: int) -> xarray.Dataset:
+    """A rotated grid inside the source domain, like the NWA12 grid."""
+    x, y = np.meshgrid(np.linspace(0, 1, nx), np.linspace(0, 1, ny))
+    lon = WEST + 5 + 55 * x + 5 * y
+    lat = SOUTH + 5 + 45 * y + 3 * x
+    return xarray.Dataset({'lon': (('y', 'x'), lon), 'lat': (('y', 'x'), lat)})
+
+
+def make_segment(grid: xarray.Dataset) -> xarray.Dataset:
+    """The eastern edge of grid, as a locstream."""
+    return xarray.Dataset(
+        {
+            'lon': ('nyp', grid['lon'].values[:, -1]),
+            'lat': ('nyp', grid['lat'].values[:, -1]),
+        }
+    )
+
+
+def esmf_weights(
+    source: xarray.Dataset, dest: xarray.Dataset, locstream_out: bool
+) -> xarray.Dataset:
+    regrid = xesmf.Regridder(
+        source, dest, 'nearest_s2d', locstream_out=locstream_out, periodic=False
+    )
+    w = regrid.weights.data
+    return xarray.Dataset(
+        {
+            'S': ('n_s', w.data),
+            'col': ('n_s', w.coords[1, :] + 1),
+            'row': ('n_s', w.coords[0, :] + 1),
+        }
+    )
+
+
+def timeit(fun, repeat: int) -> tuple[float, xarray.Dataset]:
+    times = []
+    for _ in range(repeat):
+        tstart = time.perf_counter()
+        out = fun()
+        times.append(time.perf_counter() - tstart)
+    return min(times), out
+
+
+def compare(
+    name: str,
+    source: xarray.Dataset,
+    dest: xarray.Dataset,
+    locstream_out: bool,
+    repeat: int,
+) -> None:
+    t_kd, kd = timeit(
+        lambda: nearest_weights(source, dest, locstream_out=locstream_out), repeat
+    )
+    print(f'{name} KD-tree: {t_kd:.3f} s ({kd.sizes["n_s"]} weights)')
+    t_esmf, esmf = timeit(lambda: esmf_weights(source, dest, locstream_out), repeat)
+    print(f'{name} ESMF: {t_esmf:.3f} s ({t_esmf / t_kd:.1f}x)')
+    # Source point for each destination point, or 0 if unmapped.
+    n_out = dest['lon'].size
+    kd_cols = np.zeros(n_out + 1, dtype='int64')
+    kd_cols[kd['row'].values] = kd['col'].values
+    esmf_cols = np.zeros(n_out + 1, dtype='int64')
+    esmf_cols[esmf['row'].values] = esmf['col'].values
+    same = np.mean(kd_cols[1:] == esmf_cols[1:])
+    print(f'{name} same source point as ESMF: {same:.2%}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolution', type=int, default=12)
+    parser.add_argument('--ny', type=int, default=845)
+    parser.add_argument('--nx', type=int, default=775)
+    parser.add_argument('--land-fraction', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    source = make_source(args.resolution, args.land_fraction)
+    grid = make_curvilinear(args.ny, args.nx)
+    print(f'Source points: {source["mask"].size}; grid points: {grid["lon"].size}')
+    compare('segment', source, make_segment(grid), True, args.repeat)
+    compare('grid', source, grid, False, args.repeat)
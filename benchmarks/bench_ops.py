@@ -0,0 +1,200 @@
+"""
+Compare the in-memory operators in workflow_tools.ops with the cdo and nco
+subprocess pipelines that they replace:
+- write_boundary_reanalysis: cdo setmisstonn -sellevidx -sellonlatbox
+  for each daily file, then open_mfdataset on the subsets.
+- pad_era5: ncks -d to subset and ncpdq -a -latitude to flip each
+  monthly file, then open_mfdataset on the results.
+Each pipeline ends by writing one netcdf file.
+The subprocess pipelines are skipped if cdo or nco are not installed.
+
+python benchmarks/bench_ops.py --days 10 --ny 400 --nx 600
+"""
+import shutil
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray
+
+from workflow_tools import ops
+from workflow_tools.utils import shared_executor
+
+BOX = (-80.0, -50.0, 20.0, 45.0)
+# The same box, with longitudes in [0, 360) like ERA5.
+BOX_360 = (BOX[0] % 360, BOX[1] % 360, BOX[2], BOX[3])
+
+
+def make_daily_files(
+    tmp: Path, days: int, ny: int, nx: int, nz: int
+) -> list[Path]:
+    """Files like the daily GLORYS files, with land as missing values."""
+    rng = np.random.default_rng(0)
+    lat = np.linspace(0, 60, ny)
+    lon = np.linspace(-100, -30, nx)
+    land = rng.random((ny, nx)) < 0.2
+    land[: ny // 4, : nx // 4] = True
+    files = []
+    for day, t in enumerate(pd.date_range('2020-01-01', periods=days)):
+        data = rng.normal(size=(1, nz, ny, nx)).astype('float32')
+        data[..., land] = np.nan
+        ds = xarray.Dataset(
+            {'thetao': (('time', 'depth', 'latitude', 'longitude'), data)},
+            coords={
+                'time': [t],
+                'depth': np.arange(nz, dtype='float32'),
+                'latitude': lat,
+                'longitude': lon,
+            },
+        )
+        files.append(tmp / f'glorys_{day:03d}.nc')
+        ds.to_netcdf(files[-1], unlimited_dims='time')
+    return files
+
+
+def make_era5_file(tmp: Path, hours: int, ny: int, nx: int) -> Path:
+    """A file like the ERA5 files, with latitude from north to south."""
+    rng = np.random.default_rng(1)
+    ds = xarray.Dataset(
+        {
+            't2m': (
+                ('time', 'latitude', 'longitude'),
+                rng.normal(size=(hours, ny, nx)).astype('float32'),
+            )
+        },
+        coords={
+            'time': pd.date_range('2020-01-01', periods=hours, freq='h'),
+            'latitude': np.linspace(60, 0, ny),
+            'longitude': np.linspace(260, 330, nx),
+        },
+    )
+    path = tmp / 'era5.nc'
+    ds.to_netcdf(path)
+    return path
+
+
+def boundary_cdo(files: list[Path], tmp: Path, nz: int) -> Path:
+    commands = shared_executor()
+    lonmin, lonmax, latmin, latmax = BOX
+    jobs = [
+        commands.submit(
+            [
+                'cdo',
+                'setmisstonn',
+                f'-sellevidx,1/{nz - 1}',
+                f'-sellonlatbox,{lonmin},{lonmax},{latmin},{latmax}',
+                f,
+                tmp / f'cdo_{f.name}',
+            ]
+        )
+        for f in files
+    ]
+    for job in jobs:
+        job.result()
+    out = tmp / 'boundary_cdo.nc'
+    with xarray.open_mfdataset([tmp / f'cdo_{f.name}' for f in files]) as ds:
+        ds.to_netcdf(out)
+    return out
+
+
+def _subset(ds: xarray.Dataset, nz: int) -> xarray.Dataset:
+    ds = ops.sel_levidx(ops.sel_lonlat_box(ds, *BOX), 1, nz - 1)
+    return ds.map(ops.fill_missing_nearest, keep_attrs=True)
+
+
+def boundary_ops(files: list[Path], tmp: Path, nz: int) -> Path:
+    out = tmp / 'boundary_ops.nc'
+    with xarray.open_mfdataset(files, preprocess=partial(_subset, nz=nz)) as ds:
+        ds.to_netcdf(out)
+    return out
+
+
+def era5_nco(era5: Path, tmp: Path) -> Path:
+    commands = shared_executor()
+    lonmin, lonmax, latmin, latmax = BOX_360
+    sliced = tmp / 'nco_sliced.nc'
+    commands.run(
+        [
+            'ncks',
+            '-d',
+            f'longitude,{lonmin},{lonmax}',
+            '-d',
+            f'latitude,{latmin},{latmax}',
+            '--mk_rec_dmn',
+            'time',
+            era5,
+            '-O',
+            sliced,
+        ]
+    )
+    commands.run(['ncpdq', '-a', 'time,-latitude,longitude', sliced, '-O', sliced])
+    out = tmp / 'era5_nco.nc'
+    with xarray.open_mfdataset([sliced]) as ds:
+        ds.to_netcdf(out)
+    return out
+
+
+def era5_ops(era5: Path, tmp: Path) -> Path:
+    out = tmp / 'era5_ops.nc'
+    with xarray.open_mfdataset([era5]) as ds:
+        ops.flip(ops.sel_lonlat_box(ds, *BOX_360), 'latitude').to_netcdf(out)
+    return out
+
+
+def timeit(fun, repeat: int) -> tuple[float, Path]:
+    times = []
+    for _ in range(repeat):
+        tstart = time.perf_counter()
+        out = fun()
+        times.append(time.perf_counter() - tstart)
+    return min(times), out
+
+
+def compare(name: str, old, new, repeat: int, tools: list[str]) -> None:
+    t_new, out_new = timeit(new, repeat)
+    print(f'{name} ops: {t_new:.3f} s')
+    missing = [t for t in tools if shutil.which(t) is None]
+    if len(missing) > 0:
+        print(f'{name} subprocess: skipped ({", ".join(missing)} not found)')
+        return
+    t_old, out_old = timeit(old, repeat)
+    print(f'{name} subprocess: {t_old:.3f} s ({t_old / t_new:.1f}x)')
+    with xarray.open_dataset(out_old) as a, xarray.open_dataset(out_new) as b:
+        for var in b.data_vars:
+            diff = np.nanmax(np.abs(a[var].values - b[var].values))
+            print(f'{name} max difference in {var}: {diff:.3g}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--ny', type=int, default=400)
+    parser.add_argument('--nx', type=int, default=600)
+    parser.add_argument('--nz', type=int, default=20)
+    parser.add_argument('--hours', type=int, default=24 * 31)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp = Path(tmpdir)
+        files = make_daily_files(tmp, args.days, args.ny, args.nx, args.nz)
+        compare(
+            'boundary',
+            partial(boundary_cdo, files, tmp, args.nz),
+            partial(boundary_ops, files, tmp, args.nz),
+            args.repeat,
+            ['cdo'],
+        )
+        era5 = make_era5_file(tmp, args.hours, args.ny, args.nx)
+        compare(
+            'era5',
+            partial(era5_nco, era5, tmp),
+            partial(era5_ops, era5, tmp),
+            args.repeat,
+            ['ncks', 'ncpdq'],
+        )
@@ -0,0 +1,88 @@
+"""
+Compare smooth_climatology with the previous implementation,
+which padded with xarray.concat and used two passes of rolling().mean().
+
+python benchmarks/bench_smooth_climatology.py --ny 200 --nx 200
+"""
+import time
+
+import numpy as np
+import xarray
+
+from workflow_tools.utils import smooth_climatology
+
+
+def smooth_climatology_concat(
+    da: xarray.DataArray, window: int = 5, dim: str = 'dayofyear'
+) -> xarray.DataArray:
+    """The previous implementation of smooth_climatology."""
+    smooth = da.copy()
+    for _ in range(2):
+        smooth = xarray.concat(
+            [
+                smooth.isel(**{dim: slice(-window, None)}),
+                smooth,
+                smooth.isel(**{dim: slice(None, window)}),
+            ],
+            dim,
+        )
+        smooth = (
+            smooth.rolling(**{dim: (window * 2 + 1)}, center=True, min_periods=1)
+            .mean()
+            .isel(**{dim: slice(window, -window)})
+        )
+    return smooth
+
+
+def make_climatology(ny: int, nx: int, nan_fraction: float) -> xarray.DataArray:
+    rng = np.random.default_rng(0)
+    doy = np.arange(1, 366)
+    data = (
+        np.sin(2 * np.pi * doy / 365)[:, None, None]
+        + rng.normal(size=(len(doy), ny, nx))
+    ).astype('float32')
+    data[:, rng.random((ny, nx)) < nan_fraction] = np.nan
+    data[rng.random(data.shape) < nan_fraction / 10] = np.nan
+    return xarray.DataArray(
+        data, dims=['dayofyear', 'yh', 'xh'], coords={'dayofyear': doy}, name='tos'
+    )
+
+
+def timeit(fun, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        tstart = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - tstart)
+    return min(times)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ny', type=int, default=200)
+    parser.add_argument('--nx', type=int, default=200)
+    parser.add_argument('--window', type=int, default=5)
+    parser.add_argument('--nan-fraction', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    clim = make_climatology(args.ny, args.nx, args.nan_fraction)
+    old = smooth_climatology_concat(clim, window=args.window)
+    new = smooth_climatology(clim, window=args.window)
+    diff = float(np.nanmax(np.abs(old - new)))
+    same_nans = bool((old.isnull() == new.isnull()).all())
+    print(f'Max difference: {diff:.3g}; same NaNs: {same_nans}')
+
+    t_old = timeit(lambda: smooth_climatology_concat(clim, window=args.window),
+                   args.repeat)
+    t_new = timeit(lambda: smooth_climatology(clim, window=args.window), args.repeat)
+    print(f'concat + rolling: {t_old:.3f} s')
+    print(f'cumulative sum:   {t_new:.3f} s ({t_old / t_new:.1f}x)')
+
+    lazy = clim.chunk({'yh': max(1, args.ny // 4)})
+    t_lazy = timeit(
+        lambda: smooth_climatology(lazy, window=args.window).compute(), args.repeat
+    )
+    print(f'cumulative sum (dask, chunked in yh): {t_lazy:.3f} s')
@@ -3,7 +3,6 @@ import os
 from argparse import ArgumentParser, Namespace
 from functools import partial
 from pathlib import Path
-from subprocess import CompletedProcess, run
 from typing import Any
 
 import numpy as np
@@ -11,13 +10,19 @@ import xarray
 from loguru import logger
 
 from workflow_tools.config import Config, load_config
-from workflow_tools.utils import smooth_climatology
+from workflow_tools.utils import CommandExecutor, smooth_climatology
 
 
-def run_nco(nco_tool: str, var: str, in_files: str, out_file: Path) -> CompletedProcess:
-    cmd = f'{nco_tool} -v {var} -h {in_files} -O {out_file}'
-    logger.debug(cmd)
-    return run(cmd, shell=True, check=True)
+def nco_args(nco_tool: str, var: str, in_files: list[Path], out_file: Path) -> list:
+    return [nco_tool, '-v', var, '-h', *in_files, '-O', out_file]
+
+
+def nco_executor(threads: int) -> CommandExecutor:
+    """Executor that runs up to threads nco commands at once."""
+    return CommandExecutor(
+        max_workers=threads,
+        limits={'ncks': threads, 'ncea': threads, 'ncrcat': threads},
+    )
 
 
 def check_futures(futures: list[concurrent.futures.Future]) -> None:
@@ -32,10 +37,9 @@ def process_ensmean(config: Config, cmdargs: Namespace, var: str) -> list[Path]:
     # Large files: ensemble average, then concatenate averages
     tmp = Path(os.environ['TMPDIR'])
     model_output_data = config.filesystem.forecast_output_data
-    threads = cmdargs.threads
-    members = []
-    futures = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+    with nco_executor(cmdargs.threads) as executor:
+        members = []
+        futures = []
         for m in config.retrospective_forecasts.months:
             for y in range(
                 config.retrospective_forecasts.first_year,
@@ -50,21 +54,21 @@ def process_ensmean(config: Config, cmdargs: Namespace, var: str) -> list[Path]:
                 )
                 if len(files) == 1:  # single ensemble member
                     futures.append(
-                        executor.submit(run_nco, 'ncks', var, str(files[0]), month_file)
+                        executor.submit(nco_args('ncks', var, files, month_file))
                     )
                     members.append(month_file)
                 elif len(files) > 1:
                     logger.trace(
                         'Found {l} files for {y}-{m:02d}', l=len(files), y=y, m=m
                     )
-                    file_str = ' '.join(x.as_posix() for x in files)
                     futures.append(
-                        executor.submit(run_nco, 'ncea', var, file_str, month_file)
+                        executor.submit(nco_args('ncea', var, files, month_file))
                     )
                     members.append(month_file)
                 else:
                     logger.info('No files found for {y}-{m:02d}', y=y, m=m)
-    check_futures(futures)
+        check_futures(futures)
+        executor.log_stats()
     return members
 
 
@@ -72,10 +76,9 @@ def process_all_members(config: Any, cmdargs: Namespace, var: str) -> list[Path]
     nens = config.retrospective_forecasts.ensemble_size
     tmp = Path(os.environ['TMPDIR'])
     model_output_data = config.filesystem.forecast_output_data
-    threads = cmdargs.threads
-    members = []
-    futures = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+    with nco_executor(cmdargs.threads) as executor:
+        members = []
+        futures = []
         # Regular files: concatenate initializations together
         for e in range(1, nens + 1):
             out_file = tmp / f'{cmdargs.domain}_{var}_e{e:02d}.nc'
@@ -95,14 +98,14 @@ def process_all_members(config: Any, cmdargs: Namespace, var: str) -> list[Path]
                         if tentative.is_file():
                             files.append(tentative)
                 if len(files) > 0:
-                    file_str = ' '.join(x.as_posix() for x in files)
                     futures.append(
                         executor.submit(
-                            run_nco, 'ncrcat', f'{var},member', file_str, out_file
+                            nco_args('ncrcat', f'{var},member', files, out_file)
                         )
                     )
             members.append(out_file)
-    check_futures(futures)
+        check_futures(futures)
+        executor.log_stats()
     return members
 
 
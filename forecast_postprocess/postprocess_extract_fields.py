@@ -4,18 +4,89 @@ sbatch --export=ALL --wrap="python postprocess_extract_fields.py
     -c config_nwa12_physics.yaml -d ocean_daily -y 2019 -m 3
 """
 import datetime as dt
-import subprocess
+import errno
 from argparse import ArgumentParser, Namespace
+from collections.abc import Iterator
+from concurrent import futures
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from getpass import getuser
 from os import environ
 from pathlib import Path
+from threading import Condition
+from typing import Any
 
 import numpy as np
 import xarray
 from loguru import logger
 
 from workflow_tools.config import load_config
-from workflow_tools.forecast import ForecastRun
+from workflow_tools.forecast import ForecastRun, copy_runs_from_ptmp
+from workflow_tools.io import bisect_dmget
+from workflow_tools.tarindex import TarIndex
+
+DEFAULT_SCRATCH_GB = 200.0
+
+
+@dataclass
+class ScratchBudget:
+    """
+    Limit on the bytes of extracted files on scratch (vftmp) at once,
+    shared by the runs that are processed concurrently.
+    A run that needs more than the whole budget waits until
+    it can run by itself.
+    used: bytes reserved by runs that are in progress.
+    kept: bytes of files left on scratch by finished runs
+        (when they are not cleaned up) or found there at startup.
+    strict: if False, kept files only produce a warning when they
+        push scratch over the budget, and only the runs in progress
+        are limited.
+    """
+
+    nbytes: int
+    used: int = 0
+    kept: int = 0
+    strict: bool = True
+    _warned: bool = field(default=False, init=False, repr=False)
+    _cond: Condition = field(default_factory=Condition, init=False, repr=False)
+
+    def _fits(self, nbytes: int) -> bool:
+        kept = self.kept if self.strict else 0
+        return self.used + kept + nbytes <= self.nbytes
+
+    @contextmanager
+    def reserve(self, nbytes: int, keep: bool = False) -> Iterator[None]:
+        """
+        Wait until nbytes fit within the budget and reserve them while
+        the block runs. If keep, the files stay on scratch afterwards,
+        so the bytes are not given back.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._fits(nbytes) or self.used == 0)
+            if not self._fits(nbytes) and self.kept > 0:
+                # Nothing in progress can free space, so waiting would hang.
+                raise OSError(
+                    errno.ENOSPC,
+                    'Scratch budget is used up by extracted files that were kept',
+                    f'{self.kept / 1024**3:.1f} GB kept, '
+                    f'{nbytes / 1024**3:.1f} GB needed',
+                )
+            if not self._warned and self.used + self.kept + nbytes > self.nbytes:
+                logger.warning(
+                    f'Extracted files kept on scratch ({self.kept / 1024**3:.1f} GB) '
+                    f'exceed the {self.nbytes / 1024**3:.1f} GB scratch budget; '
+                    'continuing. Use --tmp or set --scratch-gb to enforce it.'
+                )
+                self._warned = True
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= nbytes
+                if keep:
+                    self.kept += nbytes
+                self._cond.notify_all()
 
 
 def process_file(
@@ -23,13 +94,25 @@ def process_file(
     variables: list[str] | None = None,
     infile: Path | str | None = None,
     outfile: Path | str | None = None,
+    from_archive: bool = False,
 ) -> None:
-    if infile is None:
-        infile = forecast.vftmp_dir / forecast.file_name
+    """
+    Subset the variables from a forecast history file and save them
+    with init, lead, and member coordinates.
+    from_archive: read the file directly from the tar file on archive
+        instead of from infile.
+    """
+    if from_archive:
+        infile = forecast.archive_dir / forecast.tar_file / forecast.file_name
+        opened = forecast.open_from_archive(decode_timedelta=False)
+    else:
+        if infile is None:
+            infile = forecast.vftmp_dir / forecast.file_name
+        opened = xarray.open_dataset(infile, decode_timedelta=False)
     if outfile is None:
         outfile = forecast.outdir / forecast.out_name
     logger.info(f'process_file({infile})')
-    with xarray.open_dataset(infile, decode_timedelta=False) as ds:
+    with opened as ds:
         logger.trace('Opened {f}', f=infile)
         if variables is None:
             variables = list(ds.data_vars)
@@ -58,38 +141,117 @@ def process_file(
         logger.trace('Finished writing to {f}', f=outfile)
 
 def process_run(
-    forecast: ForecastRun,
-    variables: list[str],
+    forecasts: list[ForecastRun],
+    variables: dict[str, list[str]],
+    *,
     rerun: bool = False,
     clean: bool = False,
+    direct: bool = False,
+    use_ptmp: bool = True,
 ) -> None:
-    # Check if a processed file exists
-    if not (forecast.outdir / forecast.out_name).is_file() or rerun:
+    """
+    Extract and process the files for one or more domains of the same
+    forecast run. Files that are not on vftmp or ptmp yet are
+    extracted together, so the tar file on archive is only read once.
+    variables: variables to extract for each domain.
+    direct: instead of extracting files that are not on vftmp or ptmp,
+        read them directly from the tar file on archive.
+    use_ptmp: extract files to the ptmp cache and copy them to vftmp.
+        If False, files are extracted straight to vftmp.
+    """
+    # Check if processed files exist
+    forecasts = [
+        f for f in forecasts if not (f.outdir / f.out_name).is_file() or rerun
+    ]
+    if len(forecasts) == 0:
+        return
+    # Check if extracted data files or cached tar files exist
+    to_extract = [
+        f.domain
+        for f in forecasts
+        if not (f.vftmp_dir / f.file_name).is_file()
+        and not (f.ptmp_dir / f.file_name).is_file()
+    ]
+    if len(to_extract) > 0 and not forecasts[0].exists:
+        # Skip only the domains that need the tar file;
+        # the others are already on vftmp or ptmp.
+        logger.info(
+            f'{forecasts[0].archive_dir / forecasts[0].tar_file} not found; '
+            f'skipping {", ".join(to_extract)}.'
+        )
+        forecasts = [f for f in forecasts if f.domain not in to_extract]
+        to_extract = []
+    if len(to_extract) > 0:
+        logger.trace(
+            'Files for {d} are on archive but not on vftmp or ptmp', d=to_extract
+        )
+        if not direct:
+            forecasts[0].copy_from_archive(domains=to_extract, to_vftmp=not use_ptmp)
+    # Copy all of the files that are only on ptmp together.
+    on_ptmp = [
+        f
+        for f in forecasts
+        if not (direct and f.domain in to_extract)
+        and not (f.vftmp_dir / f.file_name).is_file()
+    ]
+    if len(on_ptmp) > 0:
+        logger.trace(
+            'Files for {d} are not on vftmp but are on ptmp',
+            d=[f.domain for f in on_ptmp],
+        )
+        copy_runs_from_ptmp(on_ptmp)
+    for forecast in forecasts:
         vftmp_file = forecast.vftmp_dir / forecast.file_name
-        # Check if an extracted data file exists
-        if vftmp_file.is_file():
-            logger.trace('File {f} already exists on vftmp', f=vftmp_file)
-            process_file(forecast, variables=variables)
-        # Check if a cached tar file exists
-        elif (forecast.ptmp_dir / forecast.file_name).is_file():
-            logger.trace('File is not on vftmp but is on ptmp')
-            forecast.copy_from_ptmp()
-            process_file(forecast, variables=variables)
-        elif forecast.exists:
-            logger.trace('File is on archive but not on vftmp or ptmp')
-            forecast.copy_from_archive()
-            forecast.copy_from_ptmp()
-            process_file(forecast, variables=variables)
-        else:
-            logger.info(
-                f'{forecast.archive_dir / forecast.tar_file} not found; skipping.'
+        if direct and forecast.domain in to_extract:
+            process_file(
+                forecast, variables=variables[forecast.domain], from_archive=True
             )
-            return
+            continue
+        process_file(forecast, variables=variables[forecast.domain])
         if clean:
             logger.info('Cleaning file')
             vftmp_file.unlink()
 
 
+def scratch_bytes(
+    forecasts: list[ForecastRun], rerun: bool = False, direct: bool = False
+) -> int:
+    """Estimate the bytes that process_run will write to vftmp for a run."""
+    total = 0
+    for f in forecasts:
+        if (f.outdir / f.out_name).is_file() and not rerun:
+            continue
+        if (f.vftmp_dir / f.file_name).is_file():
+            continue
+        if (f.ptmp_dir / f.file_name).is_file():
+            total += (f.ptmp_dir / f.file_name).stat().st_size
+        elif f.exists and not direct:
+            total += TarIndex(f.archive_dir / f.tar_file).member(f.file_name)[1]
+    return total
+
+
+def kept_bytes(all_runs: list[list[ForecastRun]]) -> int:
+    """Bytes of the extracted files for all_runs that are already on vftmp."""
+    total = 0
+    for forecasts in all_runs:
+        for f in forecasts:
+            if (f.vftmp_dir / f.file_name).is_file():
+                total += (f.vftmp_dir / f.file_name).stat().st_size
+    return total
+
+
+def budgeted_process_run(
+    forecasts: list[ForecastRun], budget: ScratchBudget, **kwargs: Any
+) -> None:
+    """Run process_run once its files fit within the scratch budget."""
+    nbytes = scratch_bytes(
+        forecasts, rerun=kwargs.get('rerun', False), direct=kwargs.get('direct', False)
+    )
+    # Without clean, the extracted files stay on vftmp after the run.
+    with budget.reserve(nbytes, keep=not kwargs.get('clean', False)):
+        process_run(forecasts, **kwargs)
+
+
 def main(args: Namespace) -> None:
     config = load_config(args.config)
     if args.new:
@@ -117,87 +279,106 @@ def main(args: Namespace) -> None:
             else config.retrospective_forecasts.months
         )
         nens = config.retrospective_forecasts.ensemble_size
-    outdir = (
-        config.filesystem.forecast_output_data / 'extracted' / args.domain
-    )
-    outdir.mkdir(exist_ok=True, parents=True)
-    variables = config.variables[args.domain]
+    domains = args.domain.split(',')
+    outdirs = {
+        d: config.filesystem.forecast_output_data / 'extracted' / d for d in domains
+    }
+    for outdir in outdirs.values():
+        outdir.mkdir(exist_ok=True, parents=True)
+    variables = {d: config.variables[d] for d in domains}
     if args.tmp:
         vftmp = Path(environ['TMPDIR'])
     else:
         vftmp = Path('/vftmp') / getuser()
+    # Each item has one ForecastRun for each domain,
+    # which all come from the same tar file.
     all_runs = [
-        ForecastRun(
-            ystart=ystart,
-            mstart=mstart,
-            ens=ens,
-            name=config.name,
-            template=config.filesystem.forecast_history,
-            domain=args.domain,
-            outdir=outdir,
-            vftmp=vftmp,
-        )
+        [
+            ForecastRun(
+                ystart=ystart,
+                mstart=mstart,
+                ens=ens,
+                name=config.name,
+                template=config.filesystem.forecast_history,
+                domain=domain,
+                outdir=outdirs[domain],
+                vftmp=vftmp,
+            )
+            for domain in domains
+        ]
         for ystart in range(first_year, last_year + 1)
         for mstart in months
         for ens in range(1, nens + 1)
     ]
     # Prefer to dmget all files that need it in one command, if possible.
     runs_to_dmget = []
-    for run in all_runs:
-        if not (run.outdir / run.out_name).is_file() or args.rerun:
-            if run.needs_dmget:
-                runs_to_dmget.append(run)  # (run.archive_dir / run.tar_file))
+    for runs in all_runs:
+        if any(
+            (not (run.outdir / run.out_name).is_file() or args.rerun)
+            and run.needs_dmget
+            for run in runs
+        ):
+            runs_to_dmget.append(runs)
 
     # Try running one dmget command for all files.
+    # If a tape is bad, the single dmget will fail, and the bad files
+    # are found by splitting the files into smaller groups.
+    # Runs with files that can't be recalled are removed
+    # from the all_runs list so that they are not extracted or worked on later.
     if len(runs_to_dmget) > 0:
         logger.info(f'dmgetting {len(runs_to_dmget)} files')
-        file_names = [str(run.archive_dir / run.tar_file) for run in runs_to_dmget]
-        dmget = subprocess.run(
-            [f'dmget {" ".join(file_names)}'],
-            shell=True,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        # If a tape is bad, the single dmget will fail.
-        # Try running dmget separately for each individual file.
-        # If the dmget fails, remove the run from the all_runs list
-        # so that it is not extracted or worked on later.
-        if dmget.returncode > 0:
-            if 'unable to recall the requested file' in dmget.stderr:
-                logger.warning('dmget failed. Running dmget separately for each file.')
-                for run in runs_to_dmget:
-                    try:
-                        subprocess.run(
-                            [f'dmget {run.archive_dir / run.tar_file}'],
-                            shell=True,
-                            check=True
-                        )
-                    except subprocess.CalledProcessError:
-                        logger.error(
-                            f'Could not dmget {run.archive_dir / run.tar_file}. \
-                                Removing from list of files to extract.'
-                        )
-                        all_runs.remove(run)
-            else:
-                # dmget failed, but not with the usual error
-                # associated with a bad file/tape.
-                raise subprocess.CalledProcessError(
-                    dmget.returncode,
-                    str(dmget.args),
-                    output=dmget.stdout,
-                    stderr=dmget.stderr,
+        file_names = [r[0].archive_dir / r[0].tar_file for r in runs_to_dmget]
+        _, bad_files = bisect_dmget(file_names)
+        for runs in runs_to_dmget:
+            if runs[0].archive_dir / runs[0].tar_file in bad_files:
+                logger.error(
+                    f'Could not dmget {runs[0].archive_dir / runs[0].tar_file}. \
+                        Removing from list of files to extract.'
                 )
+                all_runs.remove(runs)
     else:
         logger.info('No files to dmget')
 
-    for run in all_runs:
-        process_run(run, variables, rerun=args.rerun, clean=args.tmp)
+    # Process several runs at once, so that extracting the files for one run
+    # overlaps with compressing and writing the output for another.
+    # Runs that keep their files can only be held to the budget if it was
+    # asked for; otherwise a long retrospective would stop partway through.
+    scratch_gb = DEFAULT_SCRATCH_GB if args.scratch_gb is None else args.scratch_gb
+    budget = ScratchBudget(
+        int(scratch_gb * 1024**3),
+        # Files left over from earlier runs are removed with --tmp,
+        # but not counted back, so only count them when they stay.
+        kept=0 if args.tmp else kept_bytes(all_runs),
+        strict=args.tmp or args.scratch_gb is not None,
+    )
+    with futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        jobs = [
+            executor.submit(
+                budgeted_process_run,
+                runs,
+                budget,
+                variables=variables,
+                rerun=args.rerun,
+                clean=args.tmp,
+                direct=args.direct,
+                use_ptmp=not args.no_ptmp,
+            )
+            for runs in all_runs
+        ]
+        for j in futures.as_completed(jobs):
+            j.result()
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-c', '--config', type=str, required=True)
-    parser.add_argument('-d', '--domain', type=str, default='ocean_month')
+    parser.add_argument(
+        '-d',
+        '--domain',
+        type=str,
+        default='ocean_month',
+        help='Domain to extract, or a comma-separated list of domains '
+        'to extract in one pass through each tar file',
+    )
     parser.add_argument(
         '-y',
         '--year',
@@ -222,5 +403,33 @@ if __name__ == '__main__':
         action='store_true',
         help='Store data in $TMPDIR instead of top level /vftmp/$USER',
     )
+    parser.add_argument(
+        '--direct',
+        action='store_true',
+        help='Read files directly from the tar files on archive '
+        'instead of extracting them to ptmp and vftmp first',
+    )
+    parser.add_argument(
+        '--no-ptmp',
+        action='store_true',
+        help='Extract files straight to vftmp instead of caching them on ptmp',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=2,
+        help='Number of forecast runs to process at once',
+    )
+    parser.add_argument(
+        '--scratch-gb',
+        type=float,
+        default=None,
+        help='Limit on the size (GB) of extracted files on vftmp '
+        f'(default {DEFAULT_SCRATCH_GB:g}). '
+        'Without --tmp, extracted files are kept and count against the limit '
+        'until the end, and going over it only logs a warning '
+        'unless the limit is given explicitly',
+    )
     args = parser.parse_args()
     main(args)
@@ -1,6 +1,5 @@
 import datetime as dt
 import os
-import tarfile
 from pathlib import Path
 
 import numpy as np
@@ -8,7 +7,8 @@ import xarray
 from loguru import logger
 
 from workflow_tools.config import Config, load_config
-from workflow_tools.utils import run_cmd
+from workflow_tools.tarindex import TarIndex
+from workflow_tools.utils import shared_executor
 
 # Path to store temporary output to:
 TMP = Path(os.environ['TMPDIR'])
@@ -103,11 +103,9 @@ def ics_from_snapshot(component, history, ystart, mstart, force_extract=False):
     # extract the snapshot from the tar file to tmp
     if force_extract or not (TMP / f'./{yfile}0101.{component}_snap.nc').exists():
         # dmget the tar file
-        run_cmd(f'dmget {snapshot_file.as_posix()}')
+        shared_executor().run(['dmget', snapshot_file])
         logger.info('extracting')
-        tar = tarfile.open(snapshot_file, mode='r:')
-        member = tar.getmember(f'./{yfile}0101.{component}_snap.nc')
-        tar.extractall(path=TMP, members=[member])
+        TarIndex(snapshot_file).extract([f'{yfile}0101.{component}_snap.nc'], TMP)
 
     # open and modify the tmp snapshot file
     logger.info('modifying')
@@ -194,10 +192,10 @@ def main(config: Config, year: int, month: int, now: bool):
         ics_from_snapshot(c, history, year, month)
         for c in config.snapshots
     ]
-    file_str = ' '.join(x.name for x in tmp_files)
-    tarfile = f'{outdir.as_posix()}/forecast_ics_{year}-{month:02d}.tar'
-    cmd = f'tar cvf {tarfile} -C {TMP} {file_str}'
-    run_cmd(cmd)
+    tarfile = outdir / f'forecast_ics_{year}-{month:02d}.tar'
+    shared_executor().run(
+        ['tar', 'cvf', tarfile, '-C', TMP, *(x.name for x in tmp_files)]
+    )
     for f in tmp_files:
         f.unlink()
     logger.success(tarfile)
@@ -1,5 +1,4 @@
 import os
-import subprocess
 from pathlib import Path
 
 import numpy as np
@@ -7,10 +6,13 @@ import xarray
 from loguru import logger
 
 from workflow_tools.io import HSMGet, write_ds
-from workflow_tools.spear import SPEAR_ROOT, get_spear_paths
-from workflow_tools.utils import pad_ds
+from workflow_tools.spear import SPEAR_ROOT, SpearManifest, get_spear_paths
+from workflow_tools.utils import pad_ds, shared_executor
 
 hsmget = HSMGet(archive=SPEAR_ROOT)
+# Saved listing of the SPEAR archive directories, to avoid checking
+# archive for each file.
+manifest = SpearManifest(SPEAR_ROOT)
 
 
 def get_files_to_extract(ystart: int, mstart: int, ens: int) -> list[Path]:
@@ -21,10 +23,18 @@ def get_files_to_extract(ystart: int, mstart: int, ens: int) -> list[Path]:
         'atmos_daily',
         'daily',
         ens=ens,
+        manifest=manifest,
     )
     files += get_spear_paths(
-        ['u_ref', 'v_ref'], ystart, mstart, 'atmos_4xdaily', '6hr', ens=ens
+        ['u_ref', 'v_ref'],
+        ystart,
+        mstart,
+        'atmos_4xdaily',
+        '6hr',
+        ens=ens,
+        manifest=manifest,
     )
+    manifest.save()
     return files
 
 
@@ -75,7 +85,7 @@ def write_atmos(
 
         logger.info('vftmp -> work')
         out_dir.mkdir(exist_ok=True)
-        subprocess.run([f'gcp {tmpdir}/atmos*.nc {out_dir}'], shell=True, check=True)
+        shared_executor().run(['gcp', *sorted(tmpdir.glob('atmos*.nc')), out_dir])
     else:
         logger.warning(f'Already found data for {out_dir.as_posix()}')
 
@@ -104,8 +114,7 @@ def write_atmos_all_members(
     # dmget everything at once instead of separately by member
     # to reduce the change of dmget failing
     logger.info(f' dmget {len(members)} members')
-    all_file_strs = ' '.join(x.as_posix() for x in sum(members.values(), []))  # noqa: RUF017
-    subprocess.run(['dmget ' + all_file_strs], shell=True, check=True)
+    shared_executor().run(['dmget', *sum(members.values(), [])])  # noqa: RUF017
     tmpdir = (
         Path(os.environ['TMPDIR']) / 'atmos_raw' / f'{ystart}-{mstart:02d}-e{ens:02d}'
     )
@@ -140,8 +149,8 @@ def write_atmos_all_members(
 #            fout.with_suffix(fout.suffix + '.new').rename(fout) # Commented out for Great Lakes - PA
             logger.info('vftmp -> work')
             out_dir.mkdir(exist_ok=True)
-            subprocess.run(
-                [f'gcp {tmpdir}/atmos*.nc {out_dir}'], shell=True, check=True
+            shared_executor().run(
+                ['gcp', *sorted(tmpdir.glob('atmos*.nc')), out_dir]
             )
 
 
@@ -193,3 +202,4 @@ if __name__ == '__main__':
             xslice,
             rerun=args.rerun,
         )
+    hsmget.log_stats()
@@ -1,16 +1,18 @@
 import os
-import subprocess
 from pathlib import Path
 
 import numpy as np
 import xarray
 from loguru import logger
 
-from workflow_tools.io import HSMGet, write_ds
-from workflow_tools.spear import SPEAR_ROOT, get_spear_paths
-from workflow_tools.utils import pad_ds
+from workflow_tools.io import HSMGet, bisect_dmget, write_ds
+from workflow_tools.spear import SPEAR_ROOT, SpearManifest, get_spear_paths
+from workflow_tools.utils import pad_ds, shared_executor
 
 hsmget = HSMGet(archive=SPEAR_ROOT)
+# Saved listing of the SPEAR archive directories, to avoid checking
+# archive for each file.
+manifest = SpearManifest(SPEAR_ROOT)
 
 
 def get_files_to_extract(ystart: int, mstart: int, ens: int) -> list[Path]:
@@ -21,10 +23,18 @@ def get_files_to_extract(ystart: int, mstart: int, ens: int) -> list[Path]:
         'atmos_daily',
         'daily',
         ens=ens,
+        manifest=manifest,
     )
     files += get_spear_paths(
-        ['u_ref', 'v_ref'], ystart, mstart, 'atmos_4xdaily', '6hr', ens=ens
+        ['u_ref', 'v_ref'],
+        ystart,
+        mstart,
+        'atmos_4xdaily',
+        '6hr',
+        ens=ens,
+        manifest=manifest,
     )
+    manifest.save()
     return files
 
 
@@ -42,16 +52,15 @@ def write_atmos(
         # Read mask for flooding
         static = xarray.open_dataset('/work/acr/spear/atmos.static.nc')
         is_ocean = np.invert(static.land_mask.astype('bool'))
-        logger.info('extract from archive or ptmp')
-        extracted_files = hsmget(get_files_to_extract(ystart, mstart, ens))
-        logger.info('pad and save')
+        logger.info('extract from archive or ptmp, then pad and save')
         tmpdir = (
             Path(os.environ['TMPDIR'])
             / 'atmos_raw'
             / f'{ystart}-{mstart:02d}-e{ens:02d}'
         )
         tmpdir.mkdir(exist_ok=True, parents=True)
-        for f in extracted_files:
+        # Pad each file as soon as it is staged
+        for f in hsmget.iter_staged(get_files_to_extract(ystart, mstart, ens)):
             logger.info('    ' + str(f))
             # open
             ds = xarray.open_dataset(f).sel(lat=lat_slice, lon=lon_slice)
@@ -63,19 +72,24 @@ def write_atmos(
             fout = tmpdir / f.name
             write_ds(padded, fout)
             # cdo doesn't like if the input is also the output here
-            subprocess.run(
+            shared_executor().run(
                 [
-                    f'cdo -O replace {fout} -setmisstodis,3 -selvar,{main_var} {fout} {fout}.new'  # noqa: E501
-                ],
-                shell=True,
-                check=True,
+                    'cdo',
+                    '-O',
+                    'replace',
+                    fout,
+                    '-setmisstodis,3',
+                    f'-selvar,{main_var}',
+                    fout,
+                    f'{fout}.new',
+                ]
             )
             # Rename the file generated by cdo to the output file
             fout.with_suffix(fout.suffix + '.new').rename(fout)
 
         logger.info('vftmp -> work')
         out_dir.mkdir(exist_ok=True)
-        subprocess.run([f'gcp {tmpdir}/atmos*.nc {out_dir}'], shell=True, check=True)
+        shared_executor().run(['gcp', *sorted(tmpdir.glob('atmos*.nc')), out_dir])
     else:
         logger.warning(f'Already found data for {out_dir.as_posix()}')
 
@@ -102,10 +116,14 @@ def write_atmos_all_members(
         return None
 
     # dmget everything at once instead of separately by member
-    # to reduce the change of dmget failing
+    # to reduce the change of dmget failing.
+    # Skip any members with files that are on a bad tape.
     logger.info(f' dmget {len(members)} members')
-    all_file_strs = ' '.join(x.as_posix() for x in sum(members.values(), []))  # noqa: RUF017
-    subprocess.run(['dmget ' + all_file_strs], shell=True, check=True)
+    _, bad_files = bisect_dmget(sum(members.values(), []))  # noqa: RUF017
+    for member, member_files in list(members.items()):
+        if any(f in bad_files for f in member_files):
+            logger.error(f'Could not dmget files for member {member}; skipping.')
+            del members[member]
     tmpdir = (
         Path(os.environ['TMPDIR']) / 'atmos_raw' / f'{ystart}-{mstart:02d}-e{ens:02d}'
     )
@@ -113,11 +131,9 @@ def write_atmos_all_members(
 
     for ens, source_files in members.items():
         logger.info(f'---{ens:02d}---')
-        logger.info('extract from archive or ptmp')
-        extracted_files = hsmget(source_files)
-        logger.info('pad and save')
+        logger.info('extract from archive or ptmp, then pad and save')
         out_dir = work_dir / f'{ystart}-{mstart:02d}-e{ens:02d}'
-        for f in extracted_files:
+        for f in hsmget.iter_staged(source_files):
             logger.info('    ' + str(f))
             ds = xarray.open_dataset(f).sel(lat=lat_slice, lon=lon_slice)
             # Need to mask just the variable of interest and not the
@@ -128,20 +144,24 @@ def write_atmos_all_members(
             fout = tmpdir / f.name
             write_ds(padded, fout)
             # cdo doesn't like if the input is also the output here
-            subprocess.run(
+            shared_executor().run(
                 [
-                    f'cdo -O replace {fout} -setmisstodis,3 -selvar,{main_var} '
-                    f'{fout} {fout}.new'
-                ],
-                shell=True,
-                check=True,
+                    'cdo',
+                    '-O',
+                    'replace',
+                    fout,
+                    '-setmisstodis,3',
+                    f'-selvar,{main_var}',
+                    fout,
+                    f'{fout}.new',
+                ]
             )
             # Rename the file generated by cdo to the output file
             fout.with_suffix(fout.suffix + '.new').rename(fout)
             logger.info('vftmp -> work')
             out_dir.mkdir(exist_ok=True)
-            subprocess.run(
-                [f'gcp {tmpdir}/atmos*.nc {out_dir}'], shell=True, check=True
+            shared_executor().run(
+                ['gcp', *sorted(tmpdir.glob('atmos*.nc')), out_dir]
             )
 
 
@@ -193,3 +213,4 @@ if __name__ == '__main__':
             xslice,
             rerun=args.rerun,
         )
+    hsmget.log_stats()
@@ -0,0 +1,182 @@
+import errno
+import json
+import os
+from dataclasses import dataclass, field
+from hashlib import sha1
+from pathlib import Path
+from typing import Any
+
+from loguru import logger
+
+# Location to store catalogs, since pp directories on archive
+# are usually not writable.
+CATALOG_DIR = (
+    Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'))
+    / 'workflow_tools'
+    / 'pp_catalog'
+)
+
+
+def pp_freq(kind: str) -> str:
+    """Frequency subdirectory used by frepp for a post-processing component."""
+    return 'daily' if 'daily' in kind else 'monthly'
+
+
+def _parse_file_name(kind: str, name: str) -> tuple[str, str, str] | None:
+    """
+    Split a frepp time series file name like
+    ocean_month.199301-199712.tos.nc into variable, start, and end.
+    """
+    prefix = f'{kind}.'
+    if not name.startswith(prefix) or not name.endswith('.nc'):
+        return None
+    parts = name[len(prefix):-3].split('.', 1)
+    if len(parts) != 2 or '-' not in parts[0]:
+        return None
+    start, end = parts[0].split('-', 1)
+    return parts[1], start, end
+
+
+@dataclass
+class PPCatalog:
+    """
+    Index of the time series files in a frepp post-processing directory,
+    recording the chunk sizes, date ranges, and file names available
+    for each component (kind) and variable, so that finding files
+    does not require searching the pp directory every time.
+    The catalog is saved to index (by default, a file in CATALOG_DIR named
+    after pp_root) and is updated when chunk directories
+    are added or modified.
+    pp_root: directory containing the pp directory.
+    """
+
+    pp_root: Path
+    index: Path | None = None
+    kinds: dict[str, Any] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        if self.index is None:
+            key = sha1(self.pp_root.as_posix().encode()).hexdigest()[0:16]
+            self.index = CATALOG_DIR / f'{key}.json'
+        if self.index.is_file():
+            with open(self.index) as f:
+                saved = json.load(f)
+            if saved.get('pp_root') == self.pp_root.as_posix():
+                self.kinds = saved['kinds']
+
+    def save(self) -> None:
+        self.index.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.index.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(
+                {'pp_root': self.pp_root.as_posix(), 'kinds': self.kinds},
+                f,
+                separators=(',', ':'),
+            )
+        tmp.replace(self.index)
+
+    def pp_dir(self, kind: str) -> Path:
+        return self.pp_root / 'pp' / kind / 'ts' / pp_freq(kind)
+
+    def _scan_chunk(self, kind: str, chunk: Path) -> dict[str, list[list[str]]]:
+        files: dict[str, list[list[str]]] = {}
+        with os.scandir(chunk) as it:
+            for entry in it:
+                parsed = _parse_file_name(kind, entry.name)
+                if parsed is not None:
+                    var, start, end = parsed
+                    files.setdefault(var, []).append([entry.name, start, end])
+        for v in files.values():
+            v.sort()
+        return files
+
+    def refresh(self, kind: str) -> None:
+        """
+        Update the catalog for one kind, only listing the chunk directories
+        that are new or have been modified since they were last cataloged.
+        """
+        pp_dir = self.pp_dir(kind)
+        if not pp_dir.is_dir():
+            raise FileNotFoundError(
+                errno.ENOENT, 'Could not find post-processed directory', str(pp_dir)
+            )
+        old = self.kinds.get(kind, {'mtime': None, 'chunks': {}})
+        dir_mtime = pp_dir.stat().st_mtime
+        # Only list the pp directory again if chunks have been added or removed.
+        # Assuming chunks in units of years
+        if dir_mtime == old['mtime']:
+            available_chunks = [pp_dir / name for name in old['chunks']]
+        else:
+            available_chunks = list(pp_dir.glob('*yr'))
+        chunks = {}
+        changed = dir_mtime != old['mtime']
+        for chunk in available_chunks:
+            mtime = chunk.stat().st_mtime
+            previous = old['chunks'].get(chunk.name)
+            if previous is not None and previous['mtime'] == mtime:
+                chunks[chunk.name] = previous
+            else:
+                logger.debug('Cataloging {c}', c=chunk)
+                chunks[chunk.name] = {
+                    'years': int(chunk.name[0:-2]),
+                    'mtime': mtime,
+                    'files': self._scan_chunk(kind, chunk),
+                }
+                changed = True
+        if changed:
+            self.kinds[kind] = {
+                'freq': pp_freq(kind),
+                'mtime': dir_mtime,
+                'chunks': chunks,
+            }
+            self.save()
+
+    def build(self) -> None:
+        """Catalog every component in the pp directory."""
+        for kind_dir in sorted((self.pp_root / 'pp').iterdir()):
+            if self.pp_dir(kind_dir.name).is_dir():
+                self.refresh(kind_dir.name)
+
+    def files(self, kind: str, var: str, refresh: bool = True) -> list[Path]:
+        """
+        Find the files for a variable from the largest chunk
+        that has any files for it.
+        """
+        if refresh or kind not in self.kinds:
+            self.refresh(kind)
+        chunks = self.kinds[kind]['chunks']
+        if len(chunks) == 0:
+            raise FileNotFoundError(
+                errno.ENOENT, 'Could not find post-processed chunk subdirectory'
+            )
+        # Sort from longest to shortest chunk
+        for name, chunk in sorted(
+            chunks.items(), key=lambda x: x[1]['years'], reverse=True
+        ):
+            if var in chunk['files']:
+                return [
+                    self.pp_dir(kind) / name / f[0] for f in chunk['files'][var]
+                ]
+        raise FileNotFoundError(
+            errno.ENOENT,
+            'Could not find any post-processed files. Check if frepp failed.',
+        )
+
+    def date_range(self, kind: str, var: str) -> tuple[str, str]:
+        """First and last dates covered by the files for a variable."""
+        files = self.files(kind, var)
+        chunk = self.kinds[kind]['chunks'][files[0].parent.name]
+        entries = chunk['files'][var]
+        return entries[0][1], entries[-1][2]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pp_root', nargs='+', type=Path)
+    args = parser.parse_args()
+    for root in args.pp_root:
+        catalog = PPCatalog(root)
+        catalog.build()
+        logger.info(f'Cataloged {root} to {catalog.index}')
@@ -1,10 +1,19 @@
 # Using ptmp to cache full history files
-from dataclasses import dataclass
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
 from getpass import getuser
 from os import devnull
 from pathlib import Path
+from typing import Any
 
-from .utils import run_cmd
+import netCDF4
+import xarray
+from xarray.backends import NetCDF4DataStore
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+
+from .tarindex import TarIndex
+from .transfer import CopyResult, ParallelCopier
 
 
 @dataclass
@@ -83,25 +92,94 @@ class ForecastRun:
             and not (self.ptmp_dir / self.file_name).is_file()
         )
 
-    def copy_from_archive(self) -> None:
+    def with_domain(self, domain: str, outdir: Path | None = None) -> 'ForecastRun':
+        """
+        The same forecast run, but for a different domain
+        (another file in the same tar file).
+        """
+        return replace(
+            self, domain=domain, outdir=self.outdir if outdir is None else outdir
+        )
+
+    def copy_from_archive(
+        self, domains: list[str] | None = None, to_vftmp: bool = False
+    ) -> None:
         """
         Extract the file for this domain, from the tar file on archive,
         to the path on /ptmp.
+        If domains is given, the files for all of these domains are extracted
+        instead, in one pass through the tar file.
+        If to_vftmp, the files are extracted straight to the path on vftmp,
+        skipping the ptmp cache.
+        Members are read directly using the tar index,
+        without scanning the rest of the tar file.
+        """
+        if not self.exists:
+            raise FileNotFoundError(
+                f'File {(self.archive_dir / self.tar_file)} does not exist.'
+            )
+        if domains is None:
+            domains = [self.domain]
+        members = [self.with_domain(d).file_name for d in domains]
+        dest = self.vftmp_dir if to_vftmp else self.ptmp_dir
+        TarIndex(self.archive_dir / self.tar_file).extract(members, dest)
+
+    @contextmanager
+    def open_from_archive(self, **kwargs: Any) -> Iterator[xarray.Dataset]:
+        """
+        Open the file for this domain directly from the tar file on archive,
+        reading it in place instead of extracting and copying it first.
+        The dataset can only be used inside the with block.
+        kwargs are passed to xarray.open_dataset.
         """
         if not self.exists:
             raise FileNotFoundError(
                 f'File {(self.archive_dir / self.tar_file)} does not exist.'
             )
-        self.ptmp_dir.mkdir(parents=True, exist_ok=True)
-        cmd = f'tar xf {(self.archive_dir / self.tar_file).as_posix()} -C \
-            {self.ptmp_dir.as_posix()} ./{self.file_name}'
-        run_cmd(cmd)
+        tar_index = TarIndex(self.archive_dir / self.tar_file)
+        with tar_index.open_member(self.file_name) as buf:
+            # Opening is not thread safe, so hold the lock that xarray uses
+            # for netCDF4 while opening. The lock is not reentrant, so the
+            # store only starts using it once open_dataset has returned.
+            with NETCDF4_PYTHON_LOCK:
+                nc = netCDF4.Dataset(self.file_name, memory=buf)
+                try:
+                    store = NetCDF4DataStore(nc, lock=False)
+                    ds = xarray.open_dataset(store, **kwargs)
+                except BaseException:
+                    nc.close()
+                    raise
+            store.lock = NETCDF4_PYTHON_LOCK
+            try:
+                yield ds
+            finally:
+                # nc has to be closed before the buffer is released.
+                # Closing the dataset closes nc, holding the lock.
+                try:
+                    ds.close()
+                finally:
+                    with NETCDF4_PYTHON_LOCK:
+                        if nc.isopen():
+                            nc.close()
 
-    def copy_from_ptmp(self) -> None:
+    def copy_from_ptmp(self, copier: ParallelCopier | None = None) -> None:
         """
         Copy the file for this domain from ptmp to vftmp.
         """
-        self.vftmp_dir.mkdir(parents=True, exist_ok=True)
-        cmd = f'gcp {(self.ptmp_dir / self.file_name).as_posix()} \
-            {self.vftmp_dir.as_posix()}'
-        run_cmd(cmd)
+        copy_runs_from_ptmp([self], copier=copier)
+
+
+def copy_runs_from_ptmp(
+    runs: list[ForecastRun], copier: ParallelCopier | None = None
+) -> list[CopyResult]:
+    """
+    Copy the files for many forecast runs from ptmp to vftmp at once,
+    with the chunks of all of the files copied in parallel.
+    """
+    if copier is None:
+        copier = ParallelCopier()
+    for run in runs:
+        run.vftmp_dir.mkdir(parents=True, exist_ok=True)
+    return copier.copy(
+        [(run.ptmp_dir / run.file_name, run.vftmp_dir / run.file_name) for run in runs]
+    )
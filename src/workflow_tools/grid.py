@@ -1,9 +1,35 @@
+import json
 import os
-from typing import Any
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from hashlib import blake2b
+from itertools import pairwise
+from multiprocessing import get_context
+from pathlib import Path
+from threading import Lock
+from typing import Any, Self
 
 import numpy as np
 import xarray
 import xesmf
+from loguru import logger
+from scipy.spatial import cKDTree
+
+from .utils import XarrayData
+
+# Default location to store regridding weights, shared by all grids and stages.
+# Set REGRID_WEIGHT_DIR to use another directory. Nothing removes old
+# weight files from this directory, so it should be somewhere that is
+# cleaned up (such as $TMPDIR) or pruned by hand.
+WEIGHT_DIR = Path(
+    os.environ.get(
+        'REGRID_WEIGHT_DIR',
+        Path(os.environ.get('TMPDIR', '/tmp')) / 'regrid_weights',
+    )
+)
 
 
 def center_to_outer(center: xarray.DataArray, left=None, right=None) -> np.ndarray:
@@ -20,22 +46,512 @@ def center_to_outer(center: xarray.DataArray, left=None, right=None) -> np.ndarr
     return outer
 
 
-def reuse_regrid(*args: Any, **kwargs: Any) -> xesmf.Regridder:
+def _grid_arrays(grid: Any) -> dict[str, np.ndarray] | None:
+    """
+    The coordinates and mask of a grid passed to xesmf,
+    or None if the grid does not use the lon/lat names.
+    """
+    if isinstance(grid, xarray.DataArray):
+        grid = grid.coords
+    arrays = {
+        name: np.asarray(grid[name])
+        for name in ['lon', 'lat', 'lon_b', 'lat_b', 'mask']
+        if name in grid
+    }
+    if 'lon' not in arrays or 'lat' not in arrays:
+        return None
+    return arrays
+
+
+def regrid_key(*args: Any, **kwargs: Any) -> str | None:
+    """
+    Hash of everything that determines the weights of a regridder:
+    the source and destination coordinates and masks, the method, and
+    options such as periodic, locstream_in, and locstream_out.
+    Takes the same arguments as xesmf.Regridder.
+    Returns None if the coordinates of either grid can't be found.
+    """
+    grid_in, grid_out, *rest = args
+    options = dict(kwargs)
+    if len(rest) > 0:
+        options['method'] = rest[0]
+    digest = blake2b(digest_size=16)
+    digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+    for grid in [grid_in, grid_out]:
+        arrays = _grid_arrays(grid)
+        if arrays is None:
+            return None
+        for name, arr in arrays.items():
+            digest.update(f'{name}{arr.dtype.str}{arr.shape}'.encode())
+            digest.update(np.ascontiguousarray(arr).tobytes())
+    return digest.hexdigest()
+
+
+def _load_weights(path: Path, key: str) -> xarray.Dataset | None:
+    """Weights saved by _save_weights, or None if missing or not valid."""
+    if not path.is_file():
+        return None
+    try:
+        with xarray.open_dataset(path) as ds:
+            weights = ds.load()
+    except (OSError, ValueError) as err:
+        logger.warning('Could not read regrid weights {p}: {e}', p=path, e=err)
+        return None
+    n_in = weights.attrs.get('n_in', 0)
+    n_out = weights.attrs.get('n_out', 0)
+    if (
+        weights.attrs.get('regrid_key') != key
+        or not {'col', 'row', 'S'} <= set(weights.data_vars)
+        or (weights['col'].size > 0 and int(weights['col'].max()) > n_in)
+        or (weights['row'].size > 0 and int(weights['row'].max()) > n_out)
+        or not np.isfinite(weights['S']).all()
+    ):
+        logger.warning('Regrid weights {p} are not valid; rebuilding', p=path)
+        return None
+    logger.debug('Reusing regrid weights {p}', p=path)
+    return weights
+
+
+def _regridder_weights(regrid: xesmf.Regridder) -> xarray.Dataset:
+    """Weights of a Regridder, in the format of Regridder.to_netcdf."""
+    w = regrid.weights.data
+    n_out, n_in = w.shape
+    return xarray.Dataset(
+        {
+            'S': ('n_s', w.data),
+            'col': ('n_s', w.coords[1, :] + 1),
+            'row': ('n_s', w.coords[0, :] + 1),
+        },
+        attrs={'method': regrid.method, 'n_in': n_in, 'n_out': n_out},
+    )
+
+
+def _save_weights(weights: xarray.Dataset, path: Path, key: str) -> None:
+    """Save weights with the key that they were built for."""
+    weights = weights.assign_attrs(regrid_key=key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    weights.to_netcdf(tmp)
+    tmp.replace(path)
+
+
+def _points(
+    grid: Any, locstream: bool
+) -> tuple[np.ndarray, np.ndarray, np.ndarray | None]:
+    """Flattened lon, lat, and mask of a grid, in the order xesmf uses."""
+    arrays = _grid_arrays(grid)
+    lon = arrays['lon'].astype('float64')
+    lat = arrays['lat'].astype('float64')
+    if lon.ndim == 1 and not locstream:
+        lon, lat = np.meshgrid(lon, lat)
+    mask = arrays['mask'].ravel() != 0 if 'mask' in arrays else None
+    return lon.ravel(), lat.ravel(), mask
+
+
+def _unit_vectors(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    lon_r = np.deg2rad(lon)
+    lat_r = np.deg2rad(lat)
+    cos_lat = np.cos(lat_r)
+    return np.column_stack(
+        [cos_lat * np.cos(lon_r), cos_lat * np.sin(lon_r), np.sin(lat_r)]
+    )
+
+
+def nearest_weights(
+    grid_in: Any,
+    grid_out: Any,
+    locstream_in: bool = False,
+    locstream_out: bool = False,
+) -> xarray.Dataset:
+    """
+    Weights for nearest_s2d regridding (each destination point takes the
+    value of the nearest source point), found with a KD-tree of points on
+    the unit sphere instead of with ESMF.
+    Source points where mask is 0 are never used, and destination points
+    where mask is 0 are left unmapped.
+    Returns weights in the format that xesmf reads and writes
+    (1-based col, row, and S).
+    """
+    lon_in, lat_in, mask_in = _points(grid_in, locstream_in)
+    lon_out, lat_out, mask_out = _points(grid_out, locstream_out)
+    valid = np.flatnonzero(mask_in) if mask_in is not None else np.arange(lon_in.size)
+    rows = (
+        np.flatnonzero(mask_out) if mask_out is not None else np.arange(lon_out.size)
+    )
+    if valid.size == 0:
+        rows = rows[:0]
+        cols = rows
+    else:
+        # Distance between unit vectors increases with great circle distance,
+        # so the nearest vector is the nearest point on the sphere.
+        tree = cKDTree(_unit_vectors(lon_in[valid], lat_in[valid]))
+        _, nearest = tree.query(_unit_vectors(lon_out[rows], lat_out[rows]), workers=-1)
+        cols = valid[nearest]
+    return xarray.Dataset(
+        {
+            'S': ('n_s', np.ones(rows.size)),
+            'col': ('n_s', cols + 1),
+            'row': ('n_s', rows + 1),
+        },
+        attrs={'method': 'nearest_s2d', 'n_in': lon_in.size, 'n_out': lon_out.size},
+    )
+
+
+def _as_2d(arrays: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """Grid arrays with 1D coordinates and bounds expanded to 2D."""
+    out = dict(arrays)
+    for lon, lat in [('lon', 'lat'), ('lon_b', 'lat_b')]:
+        if out[lon].ndim == 1:
+            out[lon], out[lat] = np.meshgrid(out[lon], out[lat])
+    return out
+
+
+def _cell_extent(b: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Minimum and maximum of the corners of each cell, from 2D bounds."""
+    corners = [b[:-1, :-1], b[1:, :-1], b[:-1, 1:], b[1:, 1:]]
+    return np.minimum.reduce(corners), np.maximum.reduce(corners)
+
+
+def _conservative_tile(
+    grid_in: dict[str, np.ndarray], grid_out: dict[str, np.ndarray], periodic: bool
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """0-based S, col, and row of conservative weights for one tile."""
+    regrid = xesmf.Regridder(grid_in, grid_out, 'conservative', periodic=periodic)
+    w = regrid.weights.data
+    return w.data, w.coords[1, :], w.coords[0, :]
+
+
+def conservative_weights(
+    grid_in: Any,
+    grid_out: Any,
+    periodic: bool = False,
+    workers: int = 4,
+    tiles: int | None = None,
+) -> xarray.Dataset:
+    """
+    Weights for conservative regridding, built by splitting the destination
+    grid into blocks of rows (tiles, by default 2 per worker) and running
+    ESMF on each tile and the box of source cells that overlap it,
+    in a pool of worker processes.
+    Every destination cell is in exactly one tile with all of the source
+    cells that overlap it, so the merged weights are the same as the
+    weights for the whole grid.
+    Longitudes of both grids must be in the same range (e.g., -180 to 180).
+    Returns weights in the format that xesmf reads and writes
+    (1-based col, row, and S).
+    """
+    src = _as_2d(_grid_arrays(grid_in))
+    dst = _as_2d(_grid_arrays(grid_out))
+    ny_in, nx_in = src['lon'].shape
+    ny_out, nx_out = dst['lon'].shape
+    lon_lo, lon_hi = _cell_extent(src['lon_b'])
+    lat_lo, lat_hi = _cell_extent(src['lat_b'])
+    tiles = min(tiles or 2 * workers, ny_out)
+    edges = np.linspace(0, ny_out, tiles + 1).astype('int64')
+    jobs = []
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=get_context('spawn')
+    ) as executor:
+        for j0, j1 in pairwise(edges):
+            tile_out = {
+                name: arr[j0 : j1 + 1] if name.endswith('_b') else arr[j0:j1]
+                for name, arr in dst.items()
+            }
+            overlaps = (
+                (lon_hi >= tile_out['lon_b'].min())
+                & (lon_lo <= tile_out['lon_b'].max())
+                & (lat_hi >= tile_out['lat_b'].min())
+                & (lat_lo <= tile_out['lat_b'].max())
+            )
+            rows = np.flatnonzero(overlaps.any(axis=1))
+            cols = np.flatnonzero(overlaps.any(axis=0))
+            if rows.size == 0:
+                continue
+            # One extra source cell on each side, to be safe at the edges.
+            r0, r1 = max(rows[0] - 1, 0), min(rows[-1] + 2, ny_in)
+            c0, c1 = max(cols[0] - 1, 0), min(cols[-1] + 2, nx_in)
+            tile_in = {
+                name: arr[r0 : r1 + 1, c0 : c1 + 1]
+                if name.endswith('_b')
+                else arr[r0:r1, c0:c1]
+                for name, arr in src.items()
+            }
+            # A box that doesn't span the source grid doesn't wrap around.
+            tile_periodic = periodic and c0 == 0 and c1 == nx_in
+            future = executor.submit(
+                _conservative_tile, tile_in, tile_out, tile_periodic
+            )
+            jobs.append((future, j0, r0, c0, c1 - c0))
+        if len(jobs) == 0:
+            raise ValueError(
+                'No destination cells overlap the source grid: '
+                f'source longitudes are {lon_lo.min():g} to {lon_hi.max():g} and '
+                f'destination longitudes are {dst["lon_b"].min():g} to '
+                f'{dst["lon_b"].max():g}. Convert both to the same range '
+                '(e.g., -180 to 180) first.'
+            )
+        s, col, row = [], [], []
+        for future, j0, r0, c0, nx_tile in jobs:
+            s_tile, col_tile, row_tile = future.result()
+            s.append(s_tile)
+            # Map indices in the tile to indices in the whole grids.
+            col.append((col_tile // nx_tile + r0) * nx_in + col_tile % nx_tile + c0)
+            row.append(row_tile + j0 * nx_out)
+    logger.debug('Built conservative weights in {n} tiles', n=len(jobs))
+    return xarray.Dataset(
+        {
+            'S': ('n_s', np.concatenate(s)),
+            'col': ('n_s', np.concatenate(col) + 1),
+            'row': ('n_s', np.concatenate(row) + 1),
+        },
+        attrs={
+            'method': 'conservative',
+            'n_in': ny_in * nx_in,
+            'n_out': ny_out * nx_out,
+        },
+    )
+
+
+def _horiz_dims(grid: Any, locstream: bool) -> tuple[str, ...] | None:
+    """Horizontal dimensions of a source grid, in the order xesmf flattens them."""
+    lon, lat = grid['lon'], grid['lat']
+    if not isinstance(lon, xarray.DataArray) or not isinstance(lat, xarray.DataArray):
+        return None
+    if lon.ndim == 1 and not locstream:
+        return (lat.dims[0], lon.dims[0])
+    return tuple(lat.dims)
+
+
+@dataclass
+class GatherRegridder:
+    """
+    Applies nearest-neighbor weights onto a locstream as a gather of one
+    source point for each output location, instead of a sparse matrix
+    multiply over the whole source field. Called like an xesmf.Regridder,
+    and the cost only depends on the number of output locations.
+    indices: flattened source index for each location, or -1 if unmapped.
+    """
+
+    indices: np.ndarray
+    in_dims: tuple[str, ...]
+    in_shape: tuple[int, ...]
+    lon: np.ndarray
+    lat: np.ndarray
+    method: str
+    out_dim: str = 'locations'
+
+    @classmethod
+    def from_weights(
+        cls, weights: xarray.Dataset, grid_in: Any, grid_out: Any, **kwargs: Any
+    ) -> Self | None:
+        """
+        A GatherRegridder that applies weights (in the format of
+        Regridder.to_netcdf), or None if the weights do not map onto a locstream
+        or have weights other than one 1 per location.
+        kwargs: the options passed to xesmf.Regridder.
+        """
+        if not kwargs.get('locstream_out', False):
+            return None
+        in_dims = _horiz_dims(grid_in, kwargs.get('locstream_in', False))
+        if in_dims is None:
+            return None
+        n_in = weights.attrs['n_in']
+        n_out = weights.attrs['n_out']
+        rows = weights['row'].values.astype('int64') - 1
+        cols = weights['col'].values.astype('int64') - 1
+        counts = np.bincount(rows, minlength=n_out)
+        if (len(counts) > 0 and counts.max() > 1) or not np.all(weights['S'] == 1):
+            return None
+        sizes = {**grid_in['lat'].sizes, **grid_in['lon'].sizes}
+        in_shape = tuple(sizes[d] for d in in_dims)
+        if int(np.prod(in_shape)) != n_in:
+            return None
+        indices = np.full(n_out, -1, dtype='int64')
+        indices[rows] = cols
+        return cls(
+            indices=indices,
+            in_dims=in_dims,
+            in_shape=in_shape,
+            lon=np.asarray(grid_out['lon']).ravel(),
+            lat=np.asarray(grid_out['lat']).ravel(),
+            method=weights.attrs['method'],
+        )
+
+    def _regrid_array(self, da: xarray.DataArray) -> xarray.DataArray:
+        other = [d for d in da.dims if d not in self.in_dims]
+        da = da.transpose(*other, *self.in_dims)
+        mapped = self.indices >= 0
+        points = np.unravel_index(np.where(mapped, self.indices, 0), self.in_shape)
+        # Vectorized (pointwise) indexing, which dask does chunk by chunk.
+        out = da.isel(
+            {
+                d: xarray.DataArray(p, dims=self.out_dim)
+                for d, p in zip(self.in_dims, points, strict=True)
+            }
+        )
+        out = out.drop_vars(
+            [c for c in out.coords if self.out_dim in out[c].dims]
+        )
+        if not mapped.all():
+            out = out.where(xarray.DataArray(mapped, dims=self.out_dim))
+        return out
+
+    def __call__(self, data: XarrayData) -> XarrayData:
+        if isinstance(data, xarray.DataArray):
+            out = self._regrid_array(data)
+        else:
+            # Like xesmf, variables without the horizontal dimensions are dropped.
+            out = xarray.Dataset(
+                {
+                    name: self._regrid_array(var)
+                    for name, var in data.data_vars.items()
+                    if set(self.in_dims) <= set(var.dims)
+                }
+            )
+        out.attrs = {'regrid_method': self.method}
+        # Added after the data so that out_dim stays the last dimension.
+        return out.assign_coords(
+            lon=(self.out_dim, self.lon), lat=(self.out_dim, self.lat)
+        )
+
+
+@dataclass
+class RegridderRegistry:
+    """
+    Regridders that have already been built in this process, keyed by
+    regrid_key, so that repeated grid pairs (e.g., the same segment for
+    every month and variable) reuse one Regridder.
+    The least recently used regridder is dropped when there are more
+    than maxsize.
+    """
+
+    maxsize: int = 64
+    hits: int = 0
+    misses: int = 0
+    _regridders: OrderedDict[str, xesmf.Regridder | GatherRegridder] = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+    _lock: Lock = field(default_factory=Lock, init=False, repr=False)
+
+    def get(
+        self, key: str, build: Callable[[], xesmf.Regridder | GatherRegridder]
+    ) -> xesmf.Regridder | GatherRegridder:
+        """The regridder for key, calling build to create it if needed."""
+        with self._lock:
+            if key in self._regridders:
+                self.hits += 1
+                self._regridders.move_to_end(key)
+                return self._regridders[key]
+            self.misses += 1
+        regrid = build()
+        with self._lock:
+            self._regridders[key] = regrid
+            self._regridders.move_to_end(key)
+            while len(self._regridders) > self.maxsize:
+                self._regridders.popitem(last=False)
+        return regrid
+
+    def clear(self) -> None:
+        with self._lock:
+            self._regridders.clear()
+            self.hits = self.misses = 0
+
+    def log_stats(self) -> None:
+        logger.info(
+            'Regridders: {h} reused, {m} built or loaded, {n} in memory',
+            h=self.hits,
+            m=self.misses,
+            n=len(self._regridders),
+        )
+
+
+# Regridders shared by all calls to reuse_regrid in this process.
+REGRIDDERS = RegridderRegistry()
+
+
+def _build_regrid(
+    args: tuple,
+    kwargs: dict[str, Any],
+    key: str,
+    reuse_weights: bool,
+    path: Path,
+    *,
+    workers: int,
+) -> xesmf.Regridder | GatherRegridder:
+    method = args[2] if len(args) > 2 else kwargs.get('method')
+    regrid = None
+    weights = _load_weights(path, key) if reuse_weights else None
+    if weights is None:
+        if method == 'nearest_s2d':
+            weights = nearest_weights(
+                args[0],
+                args[1],
+                locstream_in=kwargs.get('locstream_in', False),
+                locstream_out=kwargs.get('locstream_out', False),
+            )
+        elif method == 'conservative' and workers > 1:
+            weights = conservative_weights(
+                args[0],
+                args[1],
+                periodic=kwargs.get('periodic', False),
+                workers=workers,
+            )
+        else:
+            regrid = xesmf.Regridder(*args, **kwargs)
+            weights = _regridder_weights(regrid)
+        if reuse_weights:
+            _save_weights(weights, path, key)
+    gather = GatherRegridder.from_weights(weights, args[0], args[1], **kwargs)
+    if gather is not None:
+        return gather
+    if regrid is None:
+        regrid = xesmf.Regridder(*args, weights=weights, **kwargs)
+    return regrid
+
+
+def reuse_regrid(*args: Any, **kwargs: Any) -> xesmf.Regridder | GatherRegridder:
+    """
+    Create an xesmf.Regridder, reusing weights if reuse_weights is True.
+    Weights are saved in cache_dir (by default, WEIGHT_DIR) under a hash of
+    the grids and options, so identical grids share one weight file and
+    weights are rebuilt if a grid changes.
+    Regridders are also kept in REGRIDDERS, so a repeated grid pair
+    returns the Regridder that was already built in this process.
+    nearest_s2d weights are found with nearest_weights instead of ESMF,
+    and nearest-neighbor regridding onto a locstream returns a GatherRegridder.
+    If workers > 1, conservative weights are built in tiles by that many
+    processes with conservative_weights.
+    If the grids don't have lon and lat (for example, when xesmf finds the
+    coordinates with cf_xarray), weights are reused by filename instead.
+    """
     filename = kwargs.pop('filename', None)
     reuse_weights = kwargs.pop('reuse_weights', False)
+    cache_dir = Path(kwargs.pop('cache_dir', WEIGHT_DIR))
+    workers = kwargs.pop('workers', 1)
 
-    if reuse_weights:
+    key = regrid_key(*args, **kwargs)
+    if key is None:
+        if not reuse_weights or filename is None:
+            return xesmf.Regridder(*args, **kwargs)
         if os.path.isfile(filename):
             return xesmf.Regridder(
                 *args, reuse_weights=True, filename=filename, **kwargs
             )
-        else:
-            regrid = xesmf.Regridder(*args, **kwargs)
-            regrid.to_netcdf(filename)
-            return regrid
-    else:
         regrid = xesmf.Regridder(*args, **kwargs)
+        regrid.to_netcdf(filename)
         return regrid
+    return REGRIDDERS.get(
+        key,
+        partial(
+            _build_regrid,
+            args,
+            kwargs,
+            key,
+            reuse_weights,
+            cache_dir / f'{key}.nc',
+            workers=workers,
+        ),
+    )
 
 
 def round_coords(
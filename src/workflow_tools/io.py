@@ -1,31 +1,193 @@
 import errno
-from dataclasses import dataclass
+import shutil
+import time
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
 from functools import singledispatchmethod
 from getpass import getuser
 from os import environ
 from pathlib import Path
+from queue import Queue
 from shutil import which
+from subprocess import CalledProcessError
+from threading import Lock, Thread
 from typing import Any
 
+import netCDF4
+import numpy as np
 import xarray
 from loguru import logger
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+from xarray.conventions import encode_cf_variable
 
-from .utils import run_cmd
+from .catalog import PPCatalog
+from .staging import StagingCache
+from .utils import shared_executor
 
+# Error printed by dmget when a file is on a bad tape.
+RECALL_ERROR = 'unable to recall the requested file'
 
-def _run_cmd_silently(cmd: str) -> None:
+
+def _run_cmd_silently(args: list[str | Path], retries: int = 0) -> None:
     """
     Runs a command, with the output of the job sent to
     the logger instead of printed out.
     """
-    res = run_cmd(cmd, text=True, capture_output=True)
+    res = shared_executor().run(args, retries=retries)
     logger.debug(res.stdout)
 
+@dataclass
+class HSMCommands:
+    """
+    Backend for HSMGet that shells out to the dmget and hsmget
+    command line tools.
+    """
+
+    def available(self) -> bool:
+        return which('hsmget') is not None
+
+    def dmget(self, paths: list[Path]) -> None:
+        """Recall files from tape without copying them anywhere."""
+        # Not retried, since bisect_dmget relies on failures to find bad tapes.
+        _run_cmd_silently(['dmget', *paths])
+
+    def hsmget(
+        self, archive: Path, tmp: Path, ptmp: Path, relative: list[Path]
+    ) -> None:
+        """Copy files, given relative to archive, to tmp (using ptmp as a cache)."""
+        _run_cmd_silently(
+            ['hsmget', '-q', '-a', archive, '-w', tmp, '-p', ptmp, *relative],
+            retries=2,
+        )
+
+
+@dataclass
+class LocalHSM(HSMCommands):
+    """
+    Stand-in for the HSM tools that copies files from a local
+    directory tree, waiting to simulate the time needed to recall
+    files from tape. Useful for testing without access to archive.
+    latency: seconds to wait for every dmget or hsmget call.
+    per_file: additional seconds to wait for every file in a call.
+    bad: files that fail to be recalled, as if they were on a bad tape.
+    """
+
+    latency: float = 0.0
+    per_file: float = 0.0
+    bad: set[Path] = field(default_factory=set)
+
+    def available(self) -> bool:
+        return True
+
+    def dmget(self, paths: list[Path]) -> None:
+        time.sleep(self.latency + self.per_file * len(paths))
+        failed = [p for p in paths if p in self.bad]
+        if len(failed) > 0:
+            raise CalledProcessError(
+                1,
+                'dmget',
+                stderr='\n'.join(f'dmget: {p}: {RECALL_ERROR}' for p in failed),
+            )
+
+    def hsmget(
+        self, archive: Path, tmp: Path, ptmp: Path, relative: list[Path]
+    ) -> None:
+        time.sleep(self.latency + self.per_file * len(relative))
+        # hsmget recalls the files first, which fails for a bad tape.
+        failed = [r for r in relative if archive / r in self.bad]
+        if len(failed) > 0:
+            raise CalledProcessError(
+                1,
+                'hsmget',
+                stderr='\n'.join(f'hsmget: {r}: {RECALL_ERROR}' for r in failed),
+            )
+        for r in relative:
+            dest = tmp / r
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(archive / r, dest)
+
+
+def bisect_dmget(
+    paths: list[Path], backend: HSMCommands | None = None
+) -> tuple[list[Path], list[Path]]:
+    """
+    Recall files from tape, returning the files that were recalled
+    and the files that could not be recalled because of a bad tape.
+    One dmget is tried for all of the files. If it fails, the files
+    are split in half and each half is tried again, so that a few bad
+    files are found with a small number of extra dmgets instead of
+    one dmget for every file.
+    Errors other than a bad tape are raised.
+    """
+    if backend is None:
+        backend = HSMCommands()
+    if len(paths) == 0:
+        return [], []
+    try:
+        backend.dmget(paths)
+    except CalledProcessError as err:
+        if err.stderr is None or RECALL_ERROR not in err.stderr:
+            raise
+        if len(paths) == 1:
+            logger.error(f'Could not dmget {paths[0]}')
+            return [], list(paths)
+        logger.warning(f'dmget failed for {len(paths)} files. Splitting in half.')
+        # Files recalled by the failed dmget are not recalled twice,
+        # so retrying the good half is quick.
+        half = len(paths) // 2
+        good_first, bad_first = bisect_dmget(paths[:half], backend)
+        good_last, bad_last = bisect_dmget(paths[half:], backend)
+        return good_first + good_last, bad_first + bad_last
+    return list(paths), []
+
+
+def _not_recalled(recall: Future) -> set[Path]:
+    """Files that a bisect_dmget future could not recall."""
+    try:
+        return set(recall.result()[1])
+    except Exception:
+        return set()
+
+
+def _log_recall(recall: Future) -> None:
+    err = recall.exception()
+    if err is not None:
+        logger.error('dmget failed while prefetching: {e}', e=err)
+        return
+    _, bad = recall.result()
+    if len(bad) > 0:
+        logger.error(
+            'Could not recall {n} files from tape: {f}',
+            n=len(bad),
+            f=' '.join(p.as_posix() for p in bad),
+        )
+
+
 @dataclass
 class HSMGet:
     archive: Path = Path('/')  # hopefully this will duplicate paths used by frepp
     ptmp: Path = Path('/ptmp') / getuser()
     tmp: Path = Path(environ.get('TMPDIR', ptmp))
+    backend: HSMCommands = field(default_factory=HSMCommands)
+    # Number of files to hsmget at the same time when prefetching
+    max_workers: int = 4
+    # Index of files already staged to tmp. By default, this is kept
+    # in tmp and is shared by every HSMGet that uses the same tmp.
+    cache: StagingCache | None = None
+    use_cache: bool = True
+    # Delete least recently used files to keep the cache within its budget.
+    # Off by default: paths returned by earlier calls may still be open
+    # (for example lazily by xarray), so only turn this on in scripts that
+    # are done with each file before staging more. Only files staged by
+    # this HSMGet are ever deleted.
+    evict: bool = False
+    _staged_here: set[Path] = field(default_factory=set, init=False, repr=False)
+    _lock: Lock = field(default_factory=Lock, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.cache is None and self.use_cache:
+            self.cache = StagingCache(self.tmp / '.hsmget_cache.sqlite')
 
     @singledispatchmethod
     def __call__(self, path_or_paths: Any) -> Any:
@@ -40,82 +202,542 @@ class HSMGet:
 
     @__call__.register
     def _call_path(self, path: Path) -> Path:
-        if which('hsmget') is None:
+        if not self.backend.available():
             logger.info('Not using hsmget')
             return path
-        relative = path.relative_to(self.archive)
-        # hsmget will do the dmget first and this is fine since it's one file
-        cmd = f'hsmget -q -a {self.archive} -w {self.tmp} -p {self.ptmp} {relative}'
-        _run_cmd_silently(cmd)
-        return self.tmp / relative
+        staged = self.tmp / path.relative_to(self.archive)
+        return self._stage_one(path, keep=[staged])
 
     @__call__.register
     def _call_paths(self, paths: list) -> list[Path]:
-        if which('hsmget') is None:
+        if not self.backend.available():
             logger.info('Not using hsmget')
             return paths
-        p_str = ' '.join([p.as_posix() for p in paths])
-        _run_cmd_silently(f'dmget {p_str}')
-        relative = [p.relative_to(self.archive) for p in paths]
-        rel_str = ' '.join([r.as_posix() for r in relative])
-        cmd = f'hsmget -q -a {self.archive} -w {self.tmp} -p {self.ptmp} {rel_str}'
-        _run_cmd_silently(cmd)
-        return [self.tmp / r for r in relative]
+        staged = [self.tmp / p.relative_to(self.archive) for p in paths]
+        if self.cache is not None:
+            missing = [p for p in paths if self.cache.lookup(p) is None]
+        else:
+            missing = paths
+        relative = [p.relative_to(self.archive) for p in missing]
+        if len(missing) > 0:
+            _, bad = bisect_dmget(missing, self.backend)
+            if len(bad) > 0:
+                raise OSError(
+                    errno.EIO,
+                    'Could not recall files from tape',
+                    ' '.join(p.as_posix() for p in bad),
+                )
+            self.backend.hsmget(self.archive, self.tmp, self.ptmp, relative)
+        if self.cache is not None:
+            for p, r in zip(missing, relative, strict=True):
+                self.cache.add(p, self.tmp / r)
+            self._evict(staged, [self.tmp / r for r in relative])
+        return staged
+
+    def _stage_one(self, path: Path, keep: list[Path]) -> Path:
+        """
+        hsmget one file if it is not already staged, and then
+        (if evict) make room in the cache without removing any
+        of the files in keep.
+        """
+        if self.cache is not None:
+            cached = self.cache.lookup(path)
+            if cached is not None:
+                return cached
+        relative = path.relative_to(self.archive)
+        # hsmget will do the dmget first and this is fine since it's one file
+        self.backend.hsmget(self.archive, self.tmp, self.ptmp, [relative])
+        staged = self.tmp / relative
+        if self.cache is not None:
+            self.cache.add(path, staged)
+            self._evict(keep, [staged])
+        return staged
+
+    def _evict(self, keep: list[Path], new: list[Path]) -> None:
+        with self._lock:
+            self._staged_here.update(new)
+            only = list(self._staged_here)
+        if self.evict and self.cache is not None:
+            self.cache.evict(keep=keep, only=only)
+
+    def log_stats(self) -> None:
+        if self.cache is not None:
+            self.cache.log_stats()
+
+    def prefetch(self, paths: list[Path]) -> list[Future[Path]]:
+        """
+        Start staging files in the background and return immediately.
+        All of the files are requested from tape in one dmget, so that
+        the tapes can be read in the best order, while the files are
+        copied to tmp one at a time (up to max_workers at once)
+        in the order given. Returns one future per path, in the same order,
+        that resolves to the staged path, or raises OSError if the file
+        could not be recalled from tape. Files that could not be recalled
+        are also logged when the dmget finishes.
+        """
+        if not self.backend.available():
+            logger.info('Not using hsmget')
+            done = []
+            for p in paths:
+                fut: Future[Path] = Future()
+                fut.set_result(p)
+                done.append(fut)
+            return done
+        if self.cache is not None:
+            missing = [p for p in paths if self.cache.lookup(p, count=False) is None]
+        else:
+            missing = list(paths)
+        # hsmget will wait for each file that is still being recalled
+        # by this dmget, so staging doesn't wait for the whole dmget.
+        recall = None
+        if len(missing) > 0:
+            dmget_executor = ThreadPoolExecutor(max_workers=1)
+            recall = dmget_executor.submit(bisect_dmget, missing, self.backend)
+            recall.add_done_callback(_log_recall)
+            dmget_executor.shutdown(wait=False)
+        missing_set = set(missing)
+        keep = [self.tmp / p.relative_to(self.archive) for p in paths]
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        staged = [
+            executor.submit(
+                self._stage_prefetched, p, keep, recall if p in missing_set else None
+            )
+            for p in paths
+        ]
+        # Queued files will still be staged after shutdown.
+        executor.shutdown(wait=False)
+        return staged
+
+    def _stage_prefetched(
+        self, path: Path, keep: list[Path], recall: Future | None
+    ) -> Path:
+        """
+        Stage one prefetched file, raising OSError if the dmget in recall
+        could not recall it from tape.
+        """
+        if recall is not None and recall.done() and path in _not_recalled(recall):
+            raise OSError(errno.EIO, 'Could not recall file from tape', str(path))
+        try:
+            return self._stage_one(path, keep)
+        except Exception as err:
+            if recall is not None and path in _not_recalled(recall):
+                raise OSError(
+                    errno.EIO, 'Could not recall file from tape', str(path)
+                ) from err
+            raise
+
+    def iter_staged(self, paths: list[Path], ordered: bool = True) -> Iterator[Path]:
+        """
+        Yield staged files as soon as they are available,
+        so that work on the first files can start while later files
+        are still being recalled from tape.
+        If ordered, files are yielded in the same order as paths;
+        otherwise, they are yielded in the order that they finish staging.
+        """
+        staged = self.prefetch(paths)
+        if not ordered:
+            staged = as_completed(staged)
+        for fut in staged:
+            yield fut.result()
 
 
 def open_var(
-    pp_root: Path, kind: str, var: str, hsmget: HSMGet | None = None
+    pp_root: Path,
+    kind: str,
+    var: str,
+    hsmget: HSMGet | None = None,
+    catalog: PPCatalog | None = None,
 ) -> xarray.DataArray:
     if hsmget is None:
         hsmget = HSMGet()
-    freq = 'daily' if 'daily' in kind else 'monthly'
-    pp_dir = pp_root / 'pp' / kind / 'ts' / freq
-    if not pp_dir.is_dir():
-        raise FileNotFoundError(
-            errno.ENOENT, 'Could not find post-processed directory', str(pp_dir)
-        )
-    # Get all of the available post-processing chunk directories
-    # (assuming chunks in units of years)
-    available_chunks = list(pp_dir.glob('*yr'))
-    if len(available_chunks) == 0:
-        raise FileNotFoundError(
-            errno.ENOENT, 'Could not find post-processed chunk subdirectory'
-        )
-    # Sort from longest to shortest chunk
-    sorted_chunks = sorted(
-        available_chunks, key=lambda x: int(x.name[0:-2]), reverse=True
+    if catalog is None:
+        catalog = PPCatalog(pp_root)
+    # Files from the largest chunk that has file(s),
+    # refreshing the catalog if chunks were added.
+    matching_files = catalog.files(kind, var)
+    # Treat 1 and > 1 files separately,
+    # though the > 1 case could probably handle both.
+    if len(matching_files) > 1:
+        tmpfiles = hsmget(sorted(matching_files))
+        return xarray.open_mfdataset(tmpfiles, decode_timedelta=True)[
+            var
+        ]  # Avoid FutureWarning about decode_timedelta
+    else:
+        tmpfile = hsmget(matching_files[0])
+        return xarray.open_dataset(tmpfile, decode_timedelta=True)[
+            var
+        ]  # Avoid FutureWarning about decode_timedelta
+
+
+def open_vars(
+    pp_root: Path,
+    kind: str,
+    variables: list[str],
+    hsmget: HSMGet | None = None,
+    catalog: PPCatalog | None = None,
+) -> xarray.Dataset:
+    """
+    Open several variables from the same post-processing component
+    as one dataset. The files for all of the variables are found first
+    and staged with one hsmget, and then opened together in parallel.
+    """
+    if hsmget is None:
+        hsmget = HSMGet()
+    if catalog is None:
+        catalog = PPCatalog(pp_root)
+    matching_files = sorted(
+        {f for var in variables for f in catalog.files(kind, var)}
+    )
+    tmpfiles = hsmget(matching_files)
+    # Files for different variables share the same time-related variables
+    # (e.g., time_bnds), so these are taken from the first file
+    # instead of being compared.
+    ds = xarray.open_mfdataset(
+        tmpfiles,
+        combine='by_coords',
+        data_vars='minimal',
+        coords='minimal',
+        compat='override',
+        parallel=True,
+        chunks={},
+        decode_timedelta=True,  # Avoid FutureWarning about decode_timedelta
     )
-    for chunk in sorted_chunks:
-        # Look through the available chunks and return for the
-        # largest chunk that has file(s).
-        matching_files = list(chunk.glob(f'{kind}.*.{var}.nc'))
-        # Treat 1 and > 1 files separately,
-        # though the > 1 case could probably handle both.
-        if len(matching_files) > 1:
-            tmpfiles = hsmget(sorted(matching_files))
-            return xarray.open_mfdataset(tmpfiles, decode_timedelta=True)[
-                var
-            ]  # Avoid FutureWarning about decode_timedelta
-        elif len(matching_files) == 1:
-            tmpfile = hsmget(matching_files[0])
-            return xarray.open_dataset(tmpfile, decode_timedelta=True)[
-                var
-            ]  # Avoid FutureWarning about decode_timedelta
-    raise FileNotFoundError(
-        errno.ENOENT,
-        'Could not find any post-processed files. Check if frepp failed.',
+    return ds[variables]
+
+
+@dataclass
+class WriteStats:
+    nbytes: int
+    seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """Write throughput in MB/s."""
+        return self.nbytes / 1e6 / max(self.seconds, 1e-9)
+
+
+def _block_size(ds: xarray.Dataset, dim: str, target_bytes: int) -> int:
+    """Number of records along dim that fit within roughly target_bytes."""
+    record_bytes = sum(
+        v.nbytes // max(v.sizes[dim], 1) for v in ds.variables.values() if dim in v.dims
     )
+    return max(1, target_bytes // max(record_bytes, 1))
+
+
+def stream_netcdf(
+    ds: xarray.Dataset,
+    fout: str | Path,
+    *,
+    encoding: dict[str, dict[str, Any]] | None = None,
+    unlimited_dim: str = 'time',
+    block_size: int | None = None,
+    target_bytes: int = 256 * 1024**2,
+    file_format: str = 'NETCDF3_64BIT',
+) -> WriteStats:
+    """
+    Write a (possibly lazy) dataset to netcdf a block of records at a time
+    along the unlimited dimension, so that the full dataset never needs
+    to be in memory. Each block is computed while the previous block
+    is being written by a background thread.
+    The first block is written with to_netcdf, which sets up the file
+    and the encodings, and the remaining blocks are appended to it.
+    block_size: number of records in each block. By default, this is
+        chosen so that each block is about target_bytes.
+    """
+    if encoding is None:
+        encoding = {}
+    tstart = time.perf_counter()
+    if unlimited_dim not in ds.dims:
+        ds.to_netcdf(fout, format=file_format, engine='netcdf4', encoding=encoding)
+        stats = WriteStats(ds.nbytes, time.perf_counter() - tstart)
+    else:
+        nrec = ds.sizes[unlimited_dim]
+        if block_size is None:
+            block_size = _block_size(ds, unlimited_dim, target_bytes)
+        first = ds.isel({unlimited_dim: slice(0, block_size)})
+        first.to_netcdf(
+            fout,
+            format=file_format,
+            engine='netcdf4',
+            encoding=encoding,
+            unlimited_dims=[unlimited_dim],
+        )
+        nbytes = first.nbytes
+        record_vars = [n for n, v in ds.variables.items() if unlimited_dim in v.dims]
+        # Encode the remaining blocks the same way that the first block was
+        # encoded, using the dtypes, fill values, and time units in the file.
+        var_encoding = _record_encoding(fout, record_vars)
+        queue: Queue = Queue(maxsize=2)
+        writer = Thread(target=_write_records, args=(fout, queue), daemon=True)
+        writer.start()
+        try:
+            for i in range(block_size, nrec, block_size):
+                block = ds.isel({unlimited_dim: slice(i, i + block_size)}).compute()
+                records = {}
+                for name in record_vars:
+                    values = _encode_records(block.variables[name], name, var_encoding)
+                    index = tuple(
+                        slice(i, i + block.sizes[unlimited_dim])
+                        if d == unlimited_dim
+                        else slice(None)
+                        for d in block.variables[name].dims
+                    )
+                    records[name] = (index, values)
+                    nbytes += values.nbytes
+                queue.put(records)
+        finally:
+            # Always stop the writer, so that it closes the file
+            # even if computing or encoding a block failed.
+            queue.put(None)
+            writer.join()
+        if isinstance(queue.get(), BaseException):
+            raise RuntimeError(f'Failed while writing {fout}')
+        if unlimited_dim in ds.coords and ds[unlimited_dim].ndim == 1:
+            check = [unlimited_dim]
+            bounds = ds[unlimited_dim].attrs.get(
+                'bounds', ds[unlimited_dim].encoding.get('bounds')
+            )
+            if bounds in record_vars:
+                check.append(bounds)
+            _check_records(fout, ds, check, var_encoding)
+        stats = WriteStats(nbytes, time.perf_counter() - tstart)
+    logger.info(
+        'Wrote {b:.1f} MB to {f} at {t:.1f} MB/s',
+        b=stats.nbytes / 1e6,
+        f=fout,
+        t=stats.throughput,
+    )
+    return stats
+
+
+def _record_encoding(
+    fout: str | Path, record_vars: list[str]
+) -> dict[str, dict[str, Any]]:
+    """
+    Encoding of each record variable in the file: the dtype, fill value,
+    packing, and time units and calendar.
+    """
+    with NETCDF4_PYTHON_LOCK, netCDF4.Dataset(fout) as nc:
+        # CF bounds variables (e.g., time_bnds) don't have their own
+        # units, and use the units of the variable that they bound.
+        parents = {
+            ncvar.getncattr('bounds'): ncvar
+            for ncvar in nc.variables.values()
+            if 'bounds' in ncvar.ncattrs()
+        }
+        var_encoding = {}
+        for name in record_vars:
+            ncvar = nc.variables[name]
+            attrs = ncvar.ncattrs()
+            enc = {
+                'dtype': ncvar.dtype,
+                '_FillValue': ncvar.getncattr('_FillValue')
+                if '_FillValue' in attrs
+                else None,
+            }
+            for key in ['scale_factor', 'add_offset']:
+                if key in attrs:
+                    enc[key] = ncvar.getncattr(key)
+            # Times (datetime64 or cftime objects) must be encoded
+            # with the units of the file, not of each block.
+            for key in ['units', 'calendar']:
+                if key in attrs:
+                    enc[key] = ncvar.getncattr(key)
+                elif name in parents and key in parents[name].ncattrs():
+                    enc[key] = parents[name].getncattr(key)
+            var_encoding[name] = enc
+    return var_encoding
+
+
+def _encode_records(
+    var: xarray.Variable, name: str, var_encoding: dict[str, dict[str, Any]]
+) -> np.ndarray:
+    """Values of var encoded like the variable that is already in the file."""
+    var = var.copy(deep=False)
+    var.encoding = var_encoding[name]
+    encoded = encode_cf_variable(var, name=name)
+    return np.asarray(encoded.values).astype(var_encoding[name]['dtype'])
+
+
+def _check_records(
+    fout: str | Path,
+    ds: xarray.Dataset,
+    names: list[str],
+    var_encoding: dict[str, dict[str, Any]],
+) -> None:
+    """
+    Check that the record variables names (the record coordinate and its
+    bounds) in the file match ds encoded with the units in the file,
+    so that a block written with different units (e.g., cftime dates)
+    is not silently wrong.
+    """
+    expected = {
+        name: _encode_records(ds.variables[name], name, var_encoding)
+        for name in names
+    }
+    with NETCDF4_PYTHON_LOCK, netCDF4.Dataset(fout) as nc:
+        nc.set_auto_maskandscale(False)
+        written = {name: np.asarray(nc.variables[name][:]) for name in names}
+    for name in names:
+        if written[name].shape != expected[name].shape or not np.allclose(
+            written[name], expected[name], equal_nan=True
+        ):
+            raise RuntimeError(f'{name} in {fout} does not match the data written')
+
+
+def _write_records(fout: str | Path, queue: Queue) -> None:
+    """Write blocks of records from the queue until None is received."""
+    try:
+        # Reading netcdf files from other threads is not safe while
+        # opening, writing, or closing this one, so take the same lock
+        # (in the same order) that xarray takes for netCDF4.
+        with NETCDF4_PYTHON_LOCK:
+            nc = netCDF4.Dataset(fout, mode='a')
+        try:
+            # Data has already been encoded.
+            nc.set_auto_maskandscale(False)
+            while (records := queue.get()) is not None:
+                with NETCDF4_PYTHON_LOCK:
+                    for name, (index, values) in records.items():
+                        nc.variables[name][index] = values
+        finally:
+            with NETCDF4_PYTHON_LOCK:
+                nc.close()
+        queue.put(None)
+    except BaseException as err:
+        logger.exception(err)
+        # Drain the queue so that the producer does not block forever.
+        while queue.get() is not None:
+            pass
+        queue.put(err)
 
 
-def write_ds(ds: xarray.Dataset, fout: str | Path) -> None:
+def write_ds(
+    ds: xarray.Dataset, fout: str | Path, block_size: int | None = None
+) -> WriteStats:
     for v in ds:
         if ds[v].dtype == 'float64':
             ds[v].encoding['_FillValue'] = 1.0e20
-    ds.to_netcdf(
+    return stream_netcdf(
+        ds,
         fout,
-        format='NETCDF3_64BIT',
-        engine='netcdf4',
         encoding={'time': {'dtype': 'float64', 'calendar': 'gregorian'}},
-        unlimited_dims=['time'],
+        unlimited_dim='time',
+        block_size=block_size,
     )
 
+
+# Set to zarr to store intermediates that are only read with xarray as zarr.
+INTERMEDIATE_FORMAT = environ.get('WORKFLOW_INTERMEDIATE_FORMAT', 'netcdf4')
+
+
+@dataclass(frozen=True)
+class StorageFormat:
+    """
+    How a stage stores its output. Final products read by MOM6 need to be
+    uncompressed NETCDF3_64BIT, but intermediates that are only read by
+    later stages can be chunked and compressed netcdf4 or zarr.
+    netcdf_format: format passed to to_netcdf, or None for zarr.
+    complevel: zlib compression level for netcdf4 (0 is uncompressed).
+    """
+
+    name: str
+    netcdf_format: str | None = 'NETCDF3_64BIT'
+    complevel: int = 0
+
+    @property
+    def is_zarr(self) -> bool:
+        return self.netcdf_format is None
+
+    @property
+    def suffix(self) -> str:
+        return '.zarr' if self.is_zarr else '.nc'
+
+    @property
+    def compressed(self) -> bool:
+        return self.netcdf_format == 'NETCDF4' and self.complevel > 0
+
+    @property
+    def nco_flags(self) -> str:
+        """Options for nco commands (e.g., ncrcat) to write this format."""
+        if self.is_zarr:
+            raise ValueError('nco can not write zarr')
+        if self.netcdf_format == 'NETCDF4':
+            return f'-4 -L {self.complevel}' if self.compressed else '-4'
+        return '-6' if self.netcdf_format == 'NETCDF3_64BIT' else '-3'
+
+    @property
+    def cdo_flags(self) -> str:
+        """Options for cdo to write this format."""
+        if self.is_zarr:
+            raise ValueError('cdo can not write zarr')
+        if self.netcdf_format == 'NETCDF4':
+            return f'-f nc4 -z zip_{self.complevel}' if self.compressed else '-f nc4'
+        return '-f nc2' if self.netcdf_format == 'NETCDF3_64BIT' else '-f nc'
+
+    def encoding(
+        self, ds: xarray.Dataset, encoding: dict[str, dict[str, Any]] | None = None
+    ) -> dict[str, dict[str, Any]]:
+        """
+        Add the compression settings for this format to the encoding
+        for each data variable. Settings already in encoding take precedence.
+        """
+        encoding = {k: dict(v) for k, v in (encoding or {}).items()}
+        if self.compressed:
+            for name, var in ds.data_vars.items():
+                if var.ndim > 0 and var.dtype.kind in 'fiu':
+                    encoding[name] = {
+                        'zlib': True,
+                        'complevel': self.complevel,
+                        'shuffle': True,
+                        **encoding.get(name, {}),
+                    }
+        return encoding
+
+    def write(
+        self,
+        ds: xarray.Dataset,
+        fout: str | Path,
+        encoding: dict[str, dict[str, Any]] | None = None,
+        unlimited_dim: str = 'time',
+        block_size: int | None = None,
+    ) -> WriteStats:
+        encoding = self.encoding(ds, encoding)
+        if self.is_zarr:
+            tstart = time.perf_counter()
+            ds.to_zarr(fout, mode='w', encoding=encoding)
+            stats = WriteStats(ds.nbytes, time.perf_counter() - tstart)
+            logger.info(
+                'Wrote {b:.1f} MB to {f} at {t:.1f} MB/s',
+                b=stats.nbytes / 1e6,
+                f=fout,
+                t=stats.throughput,
+            )
+            return stats
+        return stream_netcdf(
+            ds,
+            fout,
+            encoding=encoding,
+            unlimited_dim=unlimited_dim,
+            block_size=block_size,
+            file_format=self.netcdf_format,
+        )
+
+
+MOM_INPUT = StorageFormat('mom_input')
+NETCDF4_INTERMEDIATE = StorageFormat('netcdf4', 'NETCDF4', complevel=1)
+ZARR_INTERMEDIATE = StorageFormat('zarr', None)
+
+
+def storage_format(final: bool, allow_zarr: bool = False) -> StorageFormat:
+    """
+    Choose the format for the output of a stage.
+    final: the output is read by MOM6, so it is written as NETCDF3_64BIT.
+    allow_zarr: the output is only read by xarray (not by nco or cdo), so it
+        can be zarr if WORKFLOW_INTERMEDIATE_FORMAT=zarr.
+    """
+    if final:
+        return MOM_INPUT
+    if allow_zarr and INTERMEDIATE_FORMAT == 'zarr':
+        return ZARR_INTERMEDIATE
+    return NETCDF4_INTERMEDIATE
@@ -0,0 +1,245 @@
+"""
+In-memory equivalents of the cdo and nco operators used by the setup
+scripts. Each function takes and returns xarray objects and stays lazy
+for dask arrays, so a chain of operations is only computed once, when
+the result is written, instead of writing a temporary file per operator.
+"""
+import ast
+from collections.abc import Sequence
+from functools import partial
+
+import numpy as np
+import xarray
+from scipy.ndimage import distance_transform_edt
+
+type XarrayData = xarray.Dataset | xarray.DataArray
+
+# Functions that can be called in an expression passed to evaluate.
+EXPR_FUNCTIONS = {
+    'abs': np.abs,
+    'exp': np.exp,
+    'log': np.log,
+    'log10': np.log10,
+    'sqrt': np.sqrt,
+    'sin': np.sin,
+    'cos': np.cos,
+    'tan': np.tan,
+    'min': np.minimum,
+    'max': np.maximum,
+    'where': xarray.where,
+}
+
+_EXPR_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.BoolOp,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.operator,
+    ast.unaryop,
+    ast.cmpop,
+    ast.boolop,
+)
+
+
+def sel_lonlat_box(
+    data: XarrayData,
+    lonmin: float,
+    lonmax: float,
+    latmin: float,
+    latmax: float,
+    *,
+    lon: str = 'longitude',
+    lat: str = 'latitude',
+) -> XarrayData:
+    """
+    Select the points inside a longitude/latitude box, like cdo sellonlatbox.
+    Longitudes outside [lonmin, lonmin + 360) are shifted by multiples of 360
+    into that range, and the result is sorted by longitude, so boxes that
+    cross the edge of the source grid are handled.
+    """
+    lons = data[lon].values
+    if lonmax < lonmin:
+        lonmax += 360
+    in_range = (lons >= lonmin) & (lons < lonmin + 360)
+    shifted = np.where(in_range, lons, (lons - lonmin) % 360 + lonmin)
+    keep = np.flatnonzero(shifted <= lonmax)
+    keep = keep[np.argsort(shifted[keep], kind='stable')]
+    lats = data[lat].values
+    keep_lat = np.flatnonzero((lats >= latmin) & (lats <= latmax))
+    subset = data.isel({lon: keep, lat: keep_lat})
+    if not in_range[keep].all():
+        subset = subset.assign_coords(
+            {lon: subset[lon].copy(data=shifted[keep])}
+        )
+    return subset
+
+
+def sel_levidx(
+    data: XarrayData, first: int, last: int, dim: str = 'depth'
+) -> XarrayData:
+    """Select levels first to last (1-based and inclusive, like cdo sellevidx)."""
+    return data.isel({dim: slice(first - 1, last)})
+
+
+def flip(data: XarrayData, dim: str) -> XarrayData:
+    """Reverse the order of dim, like ncpdq -a -dim."""
+    return data.isel({dim: slice(None, None, -1)})
+
+
+def set_range_to_constant(
+    da: xarray.DataArray, low: float, high: float, value: float
+) -> xarray.DataArray:
+    """
+    Set values in [low, high] to value, like cdo setrtoc.
+    Missing values stay missing.
+    """
+    return da.where((da < low) | (da > high) | da.isnull(), value)
+
+
+def _fill_nearest(
+    arr: np.ndarray, sampling: tuple[float, float] | None = None
+) -> np.ndarray:
+    """
+    Fill NaNs in each 2D plane (the last two axes) with the nearest
+    valid point, where sampling is the distance between points along
+    each axis (by default, distance is in grid points). Planes that share
+    a mask reuse the nearest-point indices, since the land mask rarely
+    changes with time.
+    """
+    # C order, so that reshape returns a view and the planes are filled in place.
+    out = np.array(arr, copy=True, order='C')
+    planes = out.reshape(-1, *out.shape[-2:])
+    prev_missing = None
+    indices = None
+    for plane in planes:
+        missing = np.isnan(plane)
+        if not missing.any() or missing.all():
+            continue
+        if prev_missing is None or not np.array_equal(missing, prev_missing):
+            indices = distance_transform_edt(
+                missing, sampling=sampling, return_distances=False, return_indices=True
+            )
+            prev_missing = missing
+        plane[...] = plane[tuple(indices)]
+    return out
+
+
+def _lat_lon_sampling(
+    da: xarray.DataArray, dims: Sequence[str]
+) -> tuple[float, float] | None:
+    """
+    Distance between grid points along the latitude and longitude dims,
+    in degrees of latitude, or None if dims don't have 1D coordinates.
+    """
+    lat_dim, lon_dim = dims
+    if lat_dim not in da.coords or lon_dim not in da.coords:
+        return None
+    lat, lon = da[lat_dim].values, da[lon_dim].values
+    if lat.ndim != 1 or lon.ndim != 1 or lat.size < 2 or lon.size < 2:
+        return None
+    dlat = float(np.abs(np.median(np.diff(lat))))
+    dlon = float(np.abs(np.median(np.diff(lon))))
+    return (dlat, dlon * float(np.cos(np.deg2rad(np.mean(lat)))))
+
+
+def fill_missing_nearest(
+    da: xarray.DataArray, dims: Sequence[str] = ('latitude', 'longitude')
+) -> xarray.DataArray:
+    """
+    Fill missing values with the value of the nearest valid point
+    in the plane given by dims (latitude, longitude), like cdo setmisstonn.
+    Distance is measured with the grid spacing, with longitude spacing
+    scaled by the cosine of the mean latitude of the plane, so that
+    distances are close to distances on the sphere. cdo uses the great
+    circle distance to each point, so the chosen point can still differ
+    far from the mean latitude, or when several points are almost as close.
+    If dims don't have 1D coordinates, distance is in grid points.
+    Planes with no valid points are left missing.
+    Dask arrays stay lazy; only dims need to be in a single chunk.
+    """
+    if da.chunks is not None:
+        da = da.chunk(dict.fromkeys(dims, -1))
+    filled = xarray.apply_ufunc(
+        partial(_fill_nearest, sampling=_lat_lon_sampling(da, dims)),
+        da,
+        input_core_dims=[list(dims)],
+        output_core_dims=[list(dims)],
+        dask='parallelized',
+        output_dtypes=[da.dtype],
+        keep_attrs=True,
+    )
+    return filled.transpose(*da.dims)
+
+
+def concat_records(
+    datasets: Sequence[xarray.Dataset], dim: str = 'time'
+) -> xarray.Dataset:
+    """
+    Concatenate datasets along the record dimension, like ncrcat.
+    Variables without dim are taken from the first dataset.
+    """
+    return xarray.concat(
+        datasets,
+        dim,
+        data_vars='minimal',
+        coords='minimal',
+        compat='override',
+        combine_attrs='override',
+    )
+
+
+def _parse_expression(expression: str) -> list[tuple[str, ast.Expression]]:
+    statements = []
+    for statement in expression.split(';'):
+        if statement.strip() == '':
+            continue
+        name, sep, rhs = statement.partition('=')
+        name = name.strip()
+        if sep == '' or not name.isidentifier():
+            raise ValueError(f'Expected name=expression, got {statement!r}')
+        tree = ast.parse(rhs.strip(), mode='eval')
+        for node in ast.walk(tree):
+            if not isinstance(node, _EXPR_NODES):
+                raise ValueError(
+                    f'Unsupported syntax {type(node).__name__} in {statement!r}'
+                )
+            if isinstance(node, ast.Call) and not (
+                isinstance(node.func, ast.Name) and node.func.id in EXPR_FUNCTIONS
+            ):
+                raise ValueError(f'Unsupported function call in {statement!r}')
+        statements.append((name, tree))
+    return statements
+
+
+def evaluate(
+    ds: xarray.Dataset, expression: str, keep: bool = False
+) -> xarray.Dataset:
+    """
+    Evaluate semicolon-separated assignments like cdo expr, for example
+    '_mr=0.622*svp/(msl-svp);sphum=_mr/(1+_mr)'.
+    Each assignment can use the variables in ds, earlier assignments,
+    and the functions in EXPR_FUNCTIONS.
+    Names starting with an underscore are temporary and are not returned.
+    Returns the assigned variables, or ds with the assigned variables
+    added if keep (like cdo aexpr).
+    """
+    namespace = dict(ds.data_vars)
+    assigned = {}
+    for name, tree in _parse_expression(expression):
+        # Safe to eval, since only whitelisted syntax and functions are allowed.
+        value = eval(
+            compile(tree, '<expression>', 'eval'),
+            {'__builtins__': {}, **EXPR_FUNCTIONS},
+            namespace,
+        )
+        namespace[name] = value
+        if not name.startswith('_'):
+            assigned[name] = value
+    if keep:
+        return ds.assign(assigned)
+    return xarray.Dataset(assigned, attrs=ds.attrs)
@@ -1,8 +1,17 @@
 import errno
+import json
+import os
+import time
 from calendar import isleap, monthrange
+from dataclasses import dataclass, field
 from functools import partial
+from hashlib import sha1
 from pathlib import Path, PurePath
 
+from loguru import logger
+
+from .catalog import CATALOG_DIR
+
 # Top level path to all SPEAR medium reforecast data on archive
 SPEAR_ROOT = (
     Path('/archive')
@@ -13,6 +22,14 @@ SPEAR_ROOT = (
     / 's_j11_OTA_IceAtmRes_L33'
 )
 
+# Location to store manifests of SPEAR archive directories.
+MANIFEST_DIR = CATALOG_DIR.parent / 'spear_manifest'
+
+# Default number of seconds that a saved listing is trusted without
+# checking the directory on archive, which can be overridden by setting
+# SPEAR_MANIFEST_MAX_AGE in the environment.
+DEFAULT_MAX_AGE = float(os.environ.get('SPEAR_MANIFEST_MAX_AGE', str(24 * 3600)))
+
 
 def get_spear_file(
     ystart: int, mstart: int, domain: str, freq: str, var: str
@@ -57,6 +74,37 @@ def get_spear_file(
     return PurePath(fname)
 
 
+def _spear_subdir(ystart: int, mstart: int) -> str:
+    """
+    Directory under SPEAR_ROOT for a forecast start.
+
+    For year 1991-2014
+    iyyyymm01__OTA_IceAtmRes_L33
+
+    For year 2015-2019:
+    iyyyymm01__OTA_IceAtmRes_L33_update
+
+    For year 2020:
+    iyyyymm01__OTA_IceAtmRes_L33_rerun
+
+    For 2021 (updated Apr 2022)
+    iyyyymm01__OTA_IceAtmRes_L33_update
+
+    For 2022 onward
+    iyyyymm01__OTA_IceAtmRes_L33
+    """
+    subdir = f'i{ystart}{mstart:02d}01_OTA_IceAtmRes_L33'
+    if ystart == 2020:
+        subdir += '_rerun'
+    elif ystart in range(2015, 2020) or ystart == 2021:
+        subdir += '_update'
+    return subdir
+
+
+def _spear_ens(ens: int | str) -> str:
+    return str(ens) if ens == 'pp_ensemble' else f'pp_ens_{int(ens):02d}'
+
+
 def get_spear_path(
     ystart: int,
     mstart: int,
@@ -65,6 +113,8 @@ def get_spear_path(
     var: str,
     ens: int | str = 'pp_ensemble',
     root: Path = SPEAR_ROOT,
+    *,
+    manifest: 'SpearManifest | None' = None,
 ) -> Path:
     """
     Find the complete path to SPEAR post-processed forecast output on archive.
@@ -76,43 +126,156 @@ def get_spear_path(
     variable: post-processed diagnostic variable
     ens: ensemble member; either an integer, to get a single member,
       or "pp_ensemble" to get the post-processed ensemble mean.
+    manifest: if given, check that the file exists using the manifest
+      of root instead of checking archive.
     """
-    if ens != 'pp_ensemble':
-        ens = f'pp_ens_{int(ens):02d}'
-
-    subdir = f'i{ystart}{mstart:02d}01_OTA_IceAtmRes_L33'
     fname = get_spear_file(ystart, mstart, domain, freq, var)
-    subpath = PurePath(str(ens)) / domain / 'ts' / freq / '1yr' / fname
+    subpath = PurePath(_spear_ens(ens)) / domain / 'ts' / freq / '1yr' / fname
+    final_path = root / _spear_subdir(ystart, mstart) / subpath
+    if manifest is not None:
+        exists = manifest.contains(final_path)
+    else:
+        exists = final_path.is_file()
+    if not exists:
+        raise FileNotFoundError(
+            errno.ENOENT,
+            'Could not find right plain directory, _update, or _rerun.',
+            final_path.as_posix(),
+        )
+    return final_path
+
 
+@dataclass
+class SpearManifest:
+    """
+    Record of the directories and files under a SPEAR archive root,
+    so that finding files for many starts, members, and variables
+    does not require checking archive for every file.
+    Each directory is listed once, the first time a file in it is needed,
+    and the listings are saved to index (by default, a file in MANIFEST_DIR
+    named after root) with the modification time of each directory.
+    A saved listing is trusted without touching archive for max_age seconds
+    after the directory was last checked. After that, the directory's
+    modification time is checked the first time it is used in a process,
+    and it is listed again if it has been modified. A directory is also
+    checked whenever a file is not found in its listing.
     """
-    For year 1991-2014
-    iyyyymm01__OTA_IceAtmRes_L33
 
-    For year 2015-2019:
-    iyyyymm01__OTA_IceAtmRes_L33_update
+    root: Path = SPEAR_ROOT
+    index: Path | None = None
+    max_age: float = DEFAULT_MAX_AGE
+    listings: dict[str, list[str]] = field(default_factory=dict)
+    mtimes: dict[str, float | None] = field(default_factory=dict)
+    # Time when each directory's modification time was last checked.
+    checked_at: dict[str, float] = field(default_factory=dict)
+    _sets: dict[str, set[str]] = field(default_factory=dict, init=False, repr=False)
+    _checked: set[str] = field(default_factory=set, init=False, repr=False)
+    _changed: bool = field(default=False, init=False, repr=False)
 
-    For year 2020:
-    iyyyymm01__OTA_IceAtmRes_L33_rerun
+    def __post_init__(self) -> None:
+        if self.index is None:
+            key = sha1(self.root.as_posix().encode()).hexdigest()[0:16]
+            self.index = MANIFEST_DIR / f'{key}.json'
+        if self.index.is_file():
+            with open(self.index) as f:
+                saved = json.load(f)
+            if saved.get('root') == self.root.as_posix():
+                self.listings = saved['listings']
+                self.mtimes = saved.get('mtimes', {})
+                self.checked_at = saved.get('checked_at', {})
+        self._sets = {k: set(v) for k, v in self.listings.items()}
 
-    For 2021 (updated Apr 2022)
-    iyyyymm01__OTA_IceAtmRes_L33_update
+    def save(self) -> None:
+        if not self._changed:
+            return
+        self.index.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.index.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(
+                {
+                    'root': self.root.as_posix(),
+                    'listings': self.listings,
+                    'mtimes': self.mtimes,
+                    'checked_at': self.checked_at,
+                },
+                f,
+                separators=(',', ':'),
+            )
+        tmp.replace(self.index)
+        self._changed = False
 
-    For 2022 onward
-    iyyyymm01__OTA_IceAtmRes_L33
-    """
+    def _mtime(self, key: str) -> float | None:
+        """Modification time of a directory, or None if it doesn't exist."""
+        try:
+            return (self.root / key).stat().st_mtime
+        except FileNotFoundError:
+            return None
 
-    if ystart == 2020:
-        subdir += '_rerun'
-    elif ystart in range(2015, 2020) or ystart == 2021:
-        subdir += '_update'
-    final_path = root / subdir / subpath
-    if not final_path.is_file():
-        raise FileNotFoundError(
-            errno.ENOENT,
-            'Could not find right plain directory, _update, or _rerun.',
-            final_path.as_posix(),
+    def _list(self, key: str, mtime: float | None) -> set[str]:
+        directory = self.root / key
+        logger.debug('Listing {d}', d=directory)
+        names = sorted(os.listdir(directory)) if mtime is not None else []
+        self.listings[key] = names
+        self.mtimes[key] = mtime
+        self._sets[key] = set(names)
+        self._changed = True
+        return self._sets[key]
+
+    def _check(self, key: str) -> set[str]:
+        """Listing of a directory, listed again if it has been modified."""
+        mtime = self._mtime(key)
+        self._checked.add(key)
+        self.checked_at[key] = time.time()
+        self._changed = True
+        if key in self._sets and key in self.mtimes and self.mtimes[key] == mtime:
+            return self._sets[key]
+        return self._list(key, mtime)
+
+    def _fresh(self, key: str) -> bool:
+        """Whether the saved listing of a directory can be used unchecked."""
+        return (
+            key in self._sets
+            and time.time() - self.checked_at.get(key, 0.0) < self.max_age
         )
-    return final_path
+
+    def contains(self, path: Path) -> bool:
+        """Whether path (a file under root) exists."""
+        key = path.parent.relative_to(self.root).as_posix()
+        if key not in self._checked:
+            if not self._fresh(key):
+                return path.name in self._check(key)
+            self._checked.add(key)
+        if path.name not in self._sets[key]:
+            return path.name in self._check(key)
+        return True
+
+    def resolve(
+        self,
+        starts: list[tuple[int, int]],
+        domain: str,
+        freq: str,
+        variables: list[str],
+        ens: int | str = 'pp_ensemble',
+    ) -> dict[tuple[int, int], list[Path]]:
+        """
+        Find the paths to the files for several variables
+        for each (year, month) forecast start.
+        """
+        paths = {
+            (ystart, mstart): get_spear_paths(
+                variables,
+                ystart,
+                mstart,
+                domain,
+                freq,
+                ens=ens,
+                root=self.root,
+                manifest=self,
+            )
+            for ystart, mstart in starts
+        }
+        self.save()
+        return paths
 
 
 def get_spear_files(variables: list[str], *args, **kwargs) -> list[PurePath]:
@@ -139,16 +302,17 @@ if __name__ == '__main__':
     args = parser.parse_args()
     config = load_config(args.config)
 
-    fnames = []
     # If called from command line, this will return all files
     # for years and months in the following ranges
-    for ystart in range(
-        config.retrospective_forecasts.first_year,
-        config.retrospective_forecasts.last_year + 1,
-    ):
-        for mstart in config.retrospective_forecasts.months:
-            fname = get_spear_path(
-                ystart, mstart, args.domain, args.freq, args.var, ens=args.ensemble
-            ).as_posix()
-            fnames.append(fname)
-    print(' '.join(fnames))
+    starts = [
+        (ystart, mstart)
+        for ystart in range(
+            config.retrospective_forecasts.first_year,
+            config.retrospective_forecasts.last_year + 1,
+        )
+        for mstart in config.retrospective_forecasts.months
+    ]
+    resolved = SpearManifest().resolve(
+        starts, args.domain, args.freq, [args.var], ens=args.ensemble
+    )
+    print(' '.join(p.as_posix() for paths in resolved.values() for p in paths))
@@ -0,0 +1,163 @@
+import sqlite3
+import time
+from contextlib import closing
+from dataclasses import dataclass, field
+from os import environ
+from pathlib import Path
+from threading import Lock
+
+from loguru import logger
+
+# Default limit on the total size of staged files, which can be
+# overridden by setting HSMGET_CACHE_BYTES in the environment.
+DEFAULT_BUDGET = int(environ.get('HSMGET_CACHE_BYTES', str(200 * 1024**3)))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS staged (
+    archive_path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    staged_path TEXT NOT NULL,
+    last_access REAL NOT NULL
+)
+"""
+
+
+def _total_size(con: sqlite3.Connection) -> int:
+    return con.execute('SELECT COALESCE(SUM(size), 0) FROM staged').fetchone()[0]
+
+
+@dataclass
+class StagingCache:
+    """
+    Persistent index of files that have been staged from archive,
+    keyed by the archive path, size, and modification time, so that
+    a file is only staged again if it changed on archive or it was removed.
+    evict deletes the least recently used files when the total size
+    of staged files exceeds budget (bytes).
+    """
+
+    index: Path
+    budget: int = DEFAULT_BUDGET
+    hits: int = 0
+    misses: int = 0
+    evicted_bytes: int = 0
+    _lock: Lock = field(default_factory=Lock, init=False, repr=False)
+
+    def _connect(self) -> sqlite3.Connection:
+        self.index.parent.mkdir(parents=True, exist_ok=True)
+        # A long timeout lets several jobs share the same index.
+        con = sqlite3.connect(self.index, timeout=120)
+        con.execute(_SCHEMA)
+        return con
+
+    def lookup(self, archive_path: Path, count: bool = True) -> Path | None:
+        """
+        Return the staged copy of archive_path if it is still valid,
+        or None if the file needs to be staged.
+        If count, the lookup is added to the hit and miss counters.
+        """
+        stat = archive_path.stat()
+        with closing(self._connect()) as con, con:
+            row = con.execute(
+                'SELECT size, mtime, staged_path FROM staged WHERE archive_path = ?',
+                (archive_path.as_posix(),),
+            ).fetchone()
+            staged = None
+            if row is not None:
+                size, mtime, staged_path = row
+                staged_path = Path(staged_path)
+                if (
+                    size == stat.st_size
+                    and mtime == stat.st_mtime
+                    and staged_path.is_file()
+                    and staged_path.stat().st_size == size
+                ):
+                    staged = staged_path
+                    if count:
+                        con.execute(
+                            'UPDATE staged SET last_access = ? '
+                            'WHERE archive_path = ?',
+                            (time.time(), archive_path.as_posix()),
+                        )
+                else:
+                    logger.debug('Stale cache entry for {p}', p=archive_path)
+                    con.execute(
+                        'DELETE FROM staged WHERE archive_path = ?',
+                        (archive_path.as_posix(),),
+                    )
+        if count:
+            with self._lock:
+                if staged is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        return staged
+
+    def add(self, archive_path: Path, staged_path: Path) -> None:
+        """Record that archive_path has been staged to staged_path."""
+        stat = archive_path.stat()
+        with closing(self._connect()) as con, con:
+            con.execute(
+                'INSERT OR REPLACE INTO staged VALUES (?, ?, ?, ?, ?)',
+                (
+                    archive_path.as_posix(),
+                    stat.st_size,
+                    stat.st_mtime,
+                    staged_path.as_posix(),
+                    time.time(),
+                ),
+            )
+
+    @property
+    def total_bytes(self) -> int:
+        with closing(self._connect()) as con:
+            return _total_size(con)
+
+    def evict(
+        self, keep: list[Path] | None = None, only: list[Path] | None = None
+    ) -> None:
+        """
+        Delete the least recently used staged files until the total size
+        is within the budget. Staged files in keep are never deleted,
+        and if only is given, no files other than those are deleted.
+        """
+        keep_str = {p.as_posix() for p in keep} if keep is not None else set()
+        only_str = {p.as_posix() for p in only} if only is not None else None
+        with closing(self._connect()) as con, con:
+            total = _total_size(con)
+            if total <= self.budget:
+                return
+            rows = con.execute(
+                'SELECT archive_path, size, staged_path FROM staged '
+                'ORDER BY last_access'
+            ).fetchall()
+            for archive_path, size, staged_path in rows:
+                if total <= self.budget:
+                    break
+                if staged_path in keep_str or (
+                    only_str is not None and staged_path not in only_str
+                ):
+                    continue
+                logger.debug('Evicting {p}', p=staged_path)
+                Path(staged_path).unlink(missing_ok=True)
+                con.execute(
+                    'DELETE FROM staged WHERE archive_path = ?', (archive_path,)
+                )
+                total -= size
+                with self._lock:
+                    self.evicted_bytes += size
+        if total > self.budget:
+            logger.warning(
+                'Staged files in use ({t} bytes) exceed the cache budget ({b} bytes)',
+                t=total,
+                b=self.budget,
+            )
+
+    def log_stats(self) -> None:
+        logger.info(
+            'Staging cache: {h} hits, {m} misses, {e} bytes evicted',
+            h=self.hits,
+            m=self.misses,
+            e=self.evicted_bytes,
+        )
@@ -0,0 +1,159 @@
+import errno
+import json
+import mmap
+import os
+import tarfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from hashlib import sha1
+from pathlib import Path
+
+from loguru import logger
+
+from .catalog import CATALOG_DIR
+
+# Location to store tar indexes, next to the pp catalogs,
+# since history directories on archive are usually not writable.
+INDEX_DIR = CATALOG_DIR.parent / 'tar_index'
+
+# Size of reads when copying a member out of a tar file.
+_COPY_BYTES = 16 * 1024**2
+
+
+def _member_name(name: str) -> str:
+    """Member names are stored without the leading ./ used by frepp."""
+    return name.removeprefix('./')
+
+
+@dataclass
+class TarIndex:
+    """
+    Index of the name, data offset, and size of every file in an
+    uncompressed tar file (e.g., a history file like 19930101.nc.tar),
+    so that a member can be read by seeking straight to its data
+    instead of scanning through the tar headers.
+    The index is built the first time that it is needed and saved to index
+    (by default, a file in INDEX_DIR named after the tar file).
+    It is rebuilt if the size or modification time of the tar file changes.
+    """
+
+    tar_path: Path
+    index: Path | None = None
+    members: dict[str, list[int]] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        if self.index is None:
+            key = sha1(self.tar_path.as_posix().encode()).hexdigest()[0:16]
+            self.index = INDEX_DIR / f'{key}.json'
+        if self.index.is_file():
+            with open(self.index) as f:
+                saved = json.load(f)
+            same_tar = saved.get('tar_path') == self.tar_path.as_posix()
+            if same_tar and saved.get('stat') == self._stat():
+                self.members = saved['members']
+
+    def _stat(self) -> list[float]:
+        stat = self.tar_path.stat()
+        return [stat.st_size, stat.st_mtime]
+
+    def save(self) -> None:
+        self.index.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.index.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(
+                {
+                    'tar_path': self.tar_path.as_posix(),
+                    'stat': self._stat(),
+                    'members': self.members,
+                },
+                f,
+                separators=(',', ':'),
+            )
+        tmp.replace(self.index)
+
+    def build(self) -> None:
+        """Read the tar headers and save the offset and size of each member."""
+        if not self.tar_path.is_file():
+            raise FileNotFoundError(
+                errno.ENOENT, 'Could not find tar file', str(self.tar_path)
+            )
+        logger.debug('Indexing {t}', t=self.tar_path)
+        members = {}
+        with tarfile.open(self.tar_path, mode='r:') as tar:
+            for info in tar:
+                if info.isreg():
+                    members[_member_name(info.name)] = [info.offset_data, info.size]
+        self.members = members
+        self.save()
+
+    def member(self, name: str) -> tuple[int, int]:
+        """Offset and size in bytes of the data for a member."""
+        if len(self.members) == 0:
+            self.build()
+        try:
+            offset, size = self.members[_member_name(name)]
+        except KeyError:
+            raise FileNotFoundError(
+                errno.ENOENT, 'Could not find member in tar file', name
+            ) from None
+        return offset, size
+
+    def extract(self, names: list[str], dest: Path) -> list[Path]:
+        """
+        Copy members to the directory dest, reading them in the order that
+        they are stored so that the tar file is only read forward once.
+        Returns the paths to the extracted files, in the same order as names.
+        """
+        located = sorted((self.member(n), _member_name(n)) for n in names)
+        dest.mkdir(parents=True, exist_ok=True)
+        with open(self.tar_path, 'rb') as src:
+            for (offset, size), name in located:
+                out = dest / name
+                tmp = out.with_suffix(f'{out.suffix}.{os.getpid()}.tmp')
+                src.seek(offset)
+                remaining = size
+                with open(tmp, 'wb') as dst:
+                    while remaining > 0:
+                        buf = src.read(min(_COPY_BYTES, remaining))
+                        if len(buf) == 0:
+                            raise OSError(
+                                errno.EIO, 'Tar file ended inside member', name
+                            )
+                        dst.write(buf)
+                        remaining -= len(buf)
+                tmp.replace(out)
+        return [dest / _member_name(n) for n in names]
+
+    @contextmanager
+    def open_member(self, name: str) -> Iterator[memoryview]:
+        """
+        Memory-map the bytes of a member, without copying them out of the
+        tar file. Only the parts of the member that are read are loaded.
+        """
+        offset, size = self.member(name)
+        # mmap offsets must be a multiple of the allocation granularity.
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        with (
+            open(self.tar_path, 'rb') as f,
+            mmap.mmap(
+                f.fileno(), offset - start + size, offset=start, access=mmap.ACCESS_READ
+            ) as mm,
+        ):
+            view = memoryview(mm)[offset - start :]
+            try:
+                yield view
+            finally:
+                view.release()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tar_files', nargs='+', type=Path)
+    args = parser.parse_args()
+    for tar_file in args.tar_files:
+        tar_index = TarIndex(tar_file)
+        tar_index.build()
+        logger.info(f'Indexed {len(tar_index.members)} files in {tar_file}')
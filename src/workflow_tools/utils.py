@@ -1,9 +1,17 @@
+import os
 import re
-from subprocess import CompletedProcess, run
+import tempfile
+import time
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import cache
+from pathlib import Path
+from subprocess import CalledProcessError, CompletedProcess, Popen, run
+from threading import BoundedSemaphore, Lock
 from typing import Any
 
 import numpy as np
-import pandas as pd
 import xarray
 from loguru import logger
 
@@ -21,47 +29,279 @@ def run_cmd(cmd: str, escape: bool = False, **kwargs: Any) -> CompletedProcess:
         esc_cmd = cmd
     return run(esc_cmd, shell=True, check=True, **kwargs)
 
-def pad_ds(ds: xarray.Dataset) -> xarray.Dataset:
-    if not isinstance(ds.time.values[0], np.datetime64):
-        # use python datetimes
-        ds['time'] = ds['time'].to_index().to_datetimeindex()
 
-    # convert time bounds to days
-    if 'time_bnds' in ds:
-        ds['time_bnds'] = (ds['time_bnds'].astype('int') / (1e9 * 24 * 60 * 60)).astype(
-            'int'
+# Default limits on how many commands using each tool can run at once.
+# Tools that are not listed are limited to CommandExecutor.default_limit.
+TOOL_LIMITS = {
+    'dmget': 1,
+    'hsmget': 2,
+    'tar': 2,
+    'gcp': 4,
+    'cdo': 4,
+    'ncks': 4,
+    'ncrcat': 4,
+    'ncea': 4,
+    'ncpdq': 4,
+}
+
+
+@dataclass
+class CommandResult:
+    args: list[str]
+    returncode: int
+    stdout: str
+    stderr: str
+    wall: float
+    user: float
+    system: float
+    attempts: int = 1
+
+    @property
+    def cpu(self) -> float:
+        return self.user + self.system
+
+
+@dataclass
+class ToolStats:
+    count: int = 0
+    failures: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+
+
+def _run_args(args: list[str], cwd: Path | None) -> CommandResult:
+    """
+    Run a command without a shell and measure the wall time
+    and the CPU time used by the command.
+    """
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        tstart = time.perf_counter()
+        proc = Popen(args, stdout=out, stderr=err, cwd=cwd)
+        # Wait with wait4 instead of Popen.wait to get the resource usage
+        # of this command alone.
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - tstart
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        out.seek(0)
+        err.seek(0)
+        return CommandResult(
+            args=args,
+            returncode=proc.returncode,
+            stdout=out.read().decode(errors='replace'),
+            stderr=err.read().decode(errors='replace'),
+            wall=wall,
+            user=usage.ru_utime,
+            system=usage.ru_stime,
         )
 
-    # Pad by duplicating the first data point and
-    # inserting it as one day before the oringal start
-    tfirst = ds.isel(time=0).copy()
-    for var in ['time', 'average_T1', 'average_T2']:
-        if var in tfirst:
-            tfirst[var] = tfirst[var] - np.timedelta64(1, 'D')
-    if 'time_bnds' in tfirst:
-        tfirst['time_bnds'] = tfirst['time_bnds'] - 1
-
-    # Pad by duplicating the last data point and inserting it as one day after the end
-    tlast = ds.isel(time=-1).copy()
-    for var in ['time', 'average_T1', 'average_T2']:
-        if var in tlast:
-            tlast[var] = tlast[var] + np.timedelta64(1, 'D')
-    if 'time_bnds' in tlast:
-        tlast['time_bnds'] = tlast['time_bnds'] + 1
-
-    # Combine the duplicated and original data
-    tcomb = xarray.concat((tfirst, ds, tlast), dim='time').transpose(
-        'time', 'lat', 'lon', 'bnds'
+
+@dataclass
+class CommandExecutor:
+    """
+    Runs external commands (cdo, nco, dmget, tar, ...) from a shared pool
+    of threads, returning futures so that stages can overlap external work.
+    Commands are argument lists and are run without a shell, so file
+    names do not need escaping.
+    limits: maximum number of commands using each tool that can run at once.
+    retries: number of times to retry a failed command, waiting
+        backoff * 2**attempt seconds before each retry.
+    The wall and CPU time of every command are added up for each tool.
+    """
+
+    max_workers: int = 16
+    limits: dict[str, int] = field(default_factory=lambda: dict(TOOL_LIMITS))
+    default_limit: int = 4
+    retries: int = 0
+    backoff: float = 5.0
+    stats: dict[str, ToolStats] = field(default_factory=dict)
+    _pool: ThreadPoolExecutor | None = field(default=None, init=False, repr=False)
+    _semaphores: dict[str, BoundedSemaphore] = field(
+        default_factory=dict, init=False, repr=False
     )
+    _lock: Lock = field(default_factory=Lock, init=False, repr=False)
+
+    def _semaphore(self, tool: str) -> BoundedSemaphore:
+        with self._lock:
+            if tool not in self._semaphores:
+                self._semaphores[tool] = BoundedSemaphore(
+                    self.limits.get(tool, self.default_limit)
+                )
+            return self._semaphores[tool]
+
+    def set_limit(self, tool: str, limit: int) -> None:
+        """Change the limit for a tool, for commands that start after this."""
+        with self._lock:
+            self.limits[tool] = limit
+            self._semaphores.pop(tool, None)
+
+    def _record(self, tool: str, result: CommandResult) -> None:
+        with self._lock:
+            stats = self.stats.setdefault(tool, ToolStats())
+            stats.count += 1
+            stats.failures += result.returncode != 0
+            stats.wall += result.wall
+            stats.cpu += result.cpu
+
+    def _run(
+        self,
+        args: list[str],
+        check: bool,
+        retries: int,
+        retry_if: Callable[[CommandResult], bool] | None,
+        cwd: Path | None,
+    ) -> CommandResult:
+        tool = Path(args[0]).name
+        for attempt in range(retries + 1):
+            with self._semaphore(tool):
+                logger.debug(' '.join(args))
+                result = _run_args(args, cwd)
+            result.attempts = attempt + 1
+            self._record(tool, result)
+            logger.debug(
+                '{t} finished with code {c} in {w:.1f} s ({u:.1f} s CPU)',
+                t=tool,
+                c=result.returncode,
+                w=result.wall,
+                u=result.cpu,
+            )
+            if result.returncode == 0:
+                break
+            if attempt < retries and (retry_if is None or retry_if(result)):
+                wait = self.backoff * 2**attempt
+                logger.warning(
+                    '{t} failed with code {c}; retrying in {w:.0f} s',
+                    t=tool,
+                    c=result.returncode,
+                    w=wait,
+                )
+                time.sleep(wait)
+            else:
+                break
+        if check and result.returncode != 0:
+            raise CalledProcessError(
+                result.returncode, args, output=result.stdout, stderr=result.stderr
+            )
+        return result
+
+    def submit(
+        self,
+        args: Sequence[str | Path],
+        check: bool = True,
+        retries: int | None = None,
+        retry_if: Callable[[CommandResult], bool] | None = None,
+        cwd: Path | None = None,
+    ) -> Future[CommandResult]:
+        """
+        Start running a command, once the limit for its tool allows it.
+        If check, the future raises CalledProcessError if the command fails.
+        retries: override the number of retries for this command.
+        retry_if: only retry failures for which this returns True.
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._pool.submit(
+            self._run,
+            [str(a) for a in args],
+            check,
+            self.retries if retries is None else retries,
+            retry_if,
+            cwd,
+        )
+
+    def run(self, args: Sequence[str | Path], **kwargs: Any) -> CommandResult:
+        """Run a command and wait for it to finish."""
+        return self.submit(args, **kwargs).result()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop the pool of threads, waiting for running commands if wait.
+        A later submit starts a new pool.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+    def __enter__(self) -> 'CommandExecutor':
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.shutdown()
+
+    def log_stats(self) -> None:
+        for tool, stats in sorted(self.stats.items()):
+            logger.info(
+                '{t}: {n} commands ({f} failed), {w:.1f} s wall, {c:.1f} s CPU',
+                t=tool,
+                n=stats.count,
+                f=stats.failures,
+                w=stats.wall,
+                c=stats.cpu,
+            )
 
-    if 'time_bnds' in tcomb:
-        tcomb['time_bnds'] = tcomb['time_bnds'] + 1
 
-    tcomb['time'].attrs = ds['time'].attrs
+@cache
+def shared_executor() -> CommandExecutor:
+    """The CommandExecutor shared by all stages in a process."""
+    return CommandExecutor()
 
-    tcomb['lat_bnds'] = (('lat', 'bnds'), tcomb['lat_bnds'].isel(time=0).data)
-    tcomb['lon_bnds'] = (('lon', 'bnds'), tcomb['lon_bnds'].isel(time=0).data)
-    return tcomb
+
+def _pad_records(values: np.ndarray) -> np.ndarray:
+    """
+    Repeat the first and last records of an array (along the first axis),
+    allocating the padded output once.
+    """
+    padded = np.empty((values.shape[0] + 2, *values.shape[1:]), dtype=values.dtype)
+    padded[1:-1] = values
+    padded[0] = values[0]
+    padded[-1] = values[-1]
+    return padded
+
+
+def pad_ds(ds: xarray.Dataset) -> xarray.Dataset:
+    """
+    Pad a dataset by duplicating the first and last records in time, and
+    inserting them one day before the original start and one day after the end.
+    Each variable with a time dimension is copied once into an output array
+    that has room for the two extra records.
+    Time bounds are converted to days.
+    """
+    one_day = np.timedelta64(1, 'D')
+    time = ds['time'].values
+    if not isinstance(time[0], np.datetime64):
+        # use python datetimes
+        time = ds['time'].to_index().to_datetimeindex().values
+    time = _pad_records(time)
+    time[0] -= one_day
+    time[-1] += one_day
+
+    padded = ds.drop_dims('time').assign_coords(time=('time', time, ds['time'].attrs))
+    for name, source in ds.variables.items():
+        if 'time' not in source.dims or name == 'time':
+            continue
+        var = source.transpose('time', ...)
+        values = _pad_records(var.values)
+        encoding = var.encoding
+        if name in ['average_T1', 'average_T2']:
+            values[0] -= one_day
+            values[-1] += one_day
+            encoding = {}
+        elif name == 'time_bnds':
+            # convert time bounds to days
+            values = (
+                values.astype('datetime64[ns]').astype('int64') / (1e9 * 24 * 60 * 60)
+            ).astype('int')
+            values += 1
+            values[0] -= 1
+            values[-1] += 1
+            encoding = {}
+        new_var = xarray.Variable(var.dims, values, var.attrs, encoding)
+        if name in ds.coords:
+            padded = padded.assign_coords({name: new_var})
+        else:
+            padded[name] = new_var
+    return padded.transpose('time', 'lat', 'lon', 'bnds')
 
 
 def modulo(ds: xarray.Dataset) -> xarray.Dataset:
@@ -83,25 +323,93 @@ def flatten(lst: list[Any]) -> list[Any]:
     return flat_list
 
 
+def _circular_mean(arr: np.ndarray, window: int) -> np.ndarray:
+    """
+    Centered moving average over 2 * window + 1 points along the last axis,
+    wrapping around the ends and skipping NaNs.
+    Uses differences of cumulative sums so the cost does not depend on window.
+    """
+    valid = np.isfinite(arr)
+    padded = np.concatenate(
+        [arr[..., -window:], arr, arr[..., :window]], axis=-1, dtype='float64'
+    )
+    valid = np.concatenate([valid[..., -window:], valid, valid[..., :window]], axis=-1)
+    width = 2 * window + 1
+    totals = np.zeros((*padded.shape[:-1], padded.shape[-1] + 1))
+    counts = np.zeros(totals.shape, dtype='int64')
+    np.cumsum(np.where(valid, padded, 0.0), axis=-1, out=totals[..., 1:])
+    np.cumsum(valid, axis=-1, out=counts[..., 1:])
+    total = totals[..., width:] - totals[..., :-width]
+    count = counts[..., width:] - counts[..., :-width]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def _circular_smooth(
+    arr: np.ndarray, window: int, passes: int, dtype: np.dtype
+) -> np.ndarray:
+    for _ in range(passes):
+        arr = _circular_mean(arr, window)
+    return arr.astype(dtype, copy=False)
+
+
 def smooth_climatology(
     da: XarrayData, window: int = 5, dim: str = 'dayofyear'
-) -> xarray.DataArray:
-    smooth = da.copy()
-    for _ in range(2):
-        smooth = xarray.concat(
-            [
-                smooth.isel(**{dim: slice(-window, None)}),
-                smooth,
-                smooth.isel(**{dim: slice(None, window)}),
-            ],
-            dim,
-        )
-        smooth = (
-            smooth.rolling(**{dim: (window * 2 + 1)}, center=True, min_periods=1)
-            .mean()
-            .isel(**{dim: slice(window, -window)})
+) -> XarrayData:
+    """
+    Smooth a climatology with two passes of a centered moving average
+    over 2 * window + 1 points, wrapping around the ends of dim.
+    NaNs are skipped, like rolling(..., min_periods=1).mean().
+    Dask arrays stay lazy; only dim needs to be in a single chunk.
+    """
+    if isinstance(da, xarray.Dataset):
+        return da.map(
+            lambda v: smooth_climatology(v, window=window, dim=dim)
+            if dim in v.dims
+            else v,
+            keep_attrs=True,
         )
-    return smooth
+    dtype = da.dtype if da.dtype.kind == 'f' else np.dtype('float64')
+    if da.chunks is not None:
+        da = da.chunk({dim: -1})
+    smooth = xarray.apply_ufunc(
+        _circular_smooth,
+        da,
+        input_core_dims=[[dim]],
+        output_core_dims=[[dim]],
+        dask='parallelized',
+        output_dtypes=[dtype],
+        kwargs={'window': window, 'passes': 2, 'dtype': dtype},
+        keep_attrs=True,
+    )
+    return smooth.transpose(*da.dims)
+
+
+def forecast_target_times(
+    inits: np.ndarray, leads: np.ndarray, lead_units: str = 'months'
+) -> np.ndarray:
+    """
+    Valid times for every (init, lead) pair, as an array with
+    shape (len(inits), len(leads)).
+    Monthly leads keep the day of the month, rolling back to the end of the
+    month if needed (like pd.DateOffset(months=lead)).
+    """
+    inits = np.asarray(inits, dtype='datetime64[ns]')[:, None]
+    leads = np.asarray(leads, dtype='int64')[None, :]
+    if lead_units == 'days':
+        return inits + leads.astype('timedelta64[D]')
+    if lead_units != 'months':
+        raise ValueError(f'Unknown lead units: {lead_units}')
+    month_start = inits.astype('datetime64[M]')
+    target_month = month_start + leads.astype('timedelta64[M]')
+    days_in_month = (
+        (target_month + np.timedelta64(1, 'M')).astype('datetime64[D]')
+        - target_month.astype('datetime64[D]')
+    )
+    offset = inits - month_start.astype('datetime64[ns]')
+    day = np.minimum(offset.astype('timedelta64[D]'), days_in_month - 1)
+    time_of_day = offset - offset.astype('timedelta64[D]').astype('timedelta64[ns]')
+    return target_month.astype('datetime64[ns]') + day + time_of_day
 
 
 def match_obs_to_forecasts(
@@ -109,22 +417,36 @@ def match_obs_to_forecasts(
     forecasts: XarrayData,
     init_dim: str = 'init',
     lead_dim: str = 'lead',
+    lead_units: str | None = None,
 ) -> XarrayData:
-    matching_obs = []
-    for lead in forecasts[lead_dim]:
-        # TODO: this is hard-coded to assume monthly data
-        target_times = forecasts[init_dim].to_index() + pd.DateOffset(months=lead)
-        try:
-            match = obs.sel(time=target_times)
-        except KeyError as err:
-            missing_times = [t for t in target_times if t not in obs['time']]
-            logger.info(
-                f'These forecast times are not in the observations: {missing_times}'
-            )
-            raise err
-        match['time'] = forecasts['init'].values
-        match['lead'] = lead
-        matching_obs.append(match)
-    matching_obs = xarray.concat(matching_obs, dim='lead').rename({'time': 'init'})
-    matching_obs = matching_obs.transpose('init', 'lead', ...)
+    """
+    Select the observations at the valid time of each forecast init and lead,
+    returning data with dimensions (init, lead, ...).
+    lead_units: months or days. By default, this is taken from the
+        units attribute of the lead coordinate (or months if there is none).
+    """
+    if lead_units is None:
+        lead_units = forecasts[lead_dim].attrs.get('units', 'months')
+    target_times = forecast_target_times(
+        forecasts[init_dim].values, forecasts[lead_dim].values, lead_units
+    )
+    positions = obs.indexes['time'].get_indexer(target_times.ravel())
+    if (positions < 0).any():
+        missing_times = np.unique(target_times.ravel()[positions < 0])
+        logger.info(
+            'These forecast times are not in the observations: '
+            f'{np.datetime_as_string(missing_times, unit="s").tolist()}'
+        )
+        raise KeyError(f'{len(missing_times)} forecast times not in observations')
+    indexer = xarray.DataArray(
+        positions.reshape(target_times.shape), dims=(init_dim, lead_dim)
+    )
+    matching_obs = (
+        obs.isel(time=indexer)
+        .drop_vars('time')
+        .assign_coords(
+            {init_dim: forecasts[init_dim].values, lead_dim: forecasts[lead_dim]}
+        )
+    )
+    matching_obs = matching_obs.transpose(init_dim, lead_dim, ...)
     return matching_obs